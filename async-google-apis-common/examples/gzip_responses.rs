@@ -0,0 +1,153 @@
+//! Measures the bytes on the wire and the latency of requests for a large list response, with and
+//! without asking for gzip compression (as generated services do by default), against a local
+//! stand-in server whose bandwidth is limited to `BANDWIDTH`.
+//!
+//! Run with `cargo run --release --example gzip_responses`.
+
+use async_google_apis_common::*;
+
+use std::io::Write;
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::sync::Arc;
+use tokio::io::{AsyncReadExt, AsyncWriteExt};
+
+/// Similar to the items of a typical list response.
+#[derive(Serialize, Deserialize, Debug, Clone, Default)]
+#[serde(rename_all = "camelCase")]
+struct File {
+    id: String,
+    name: String,
+    mime_type: String,
+    size: String,
+    modified_time: String,
+    owners: Vec<String>,
+}
+
+#[derive(Serialize, Deserialize, Debug, Clone, Default)]
+#[serde(rename_all = "camelCase")]
+struct FileList {
+    files: Vec<File>,
+    next_page_token: Option<String>,
+}
+
+const FILES: usize = 1000;
+const REQUESTS: usize = 20;
+/// Bytes per second sent by the stand-in server.
+const BANDWIDTH: usize = 10 * 1024 * 1024;
+const WRITE_CHUNK: usize = 64 * 1024;
+
+fn file_list() -> FileList {
+    FileList {
+        files: (0..FILES)
+            .map(|i| File {
+                id: format!("1{:032x}", i * 7919),
+                name: format!("Quarterly report {} (final).pdf", i),
+                mime_type: "application/pdf".into(),
+                size: format!("{}", 100_000 + i * 37),
+                modified_time: format!("2021-03-{:02}T12:{:02}:00.000Z", 1 + i % 28, i % 60),
+                owners: vec![format!("user{}@example.com", i % 17)],
+            })
+            .collect(),
+        next_page_token: Some("CkQKDggBEgoxNjE1OTEyMzQ1".into()),
+    }
+}
+
+/// Respond to every request with `body`, gzip-compressed if the request asks for it. The bytes
+/// sent are counted in `sent`.
+async fn serve(
+    listener: tokio::net::TcpListener,
+    body: Arc<Vec<u8>>,
+    gzipped: Arc<Vec<u8>>,
+    sent: Arc<AtomicUsize>,
+) {
+    loop {
+        let (mut conn, _) = listener.accept().await.unwrap();
+        let (body, gzipped, sent) = (body.clone(), gzipped.clone(), sent.clone());
+        tokio::spawn(async move {
+            loop {
+                let mut request = vec![];
+                let mut buf = [0; 4096];
+                while !request.ends_with(b"\r\n\r\n") {
+                    match conn.read(&mut buf).await {
+                        Ok(0) | Err(_) => return,
+                        Ok(n) => request.extend_from_slice(&buf[..n]),
+                    }
+                }
+                let request = String::from_utf8_lossy(&request).to_lowercase();
+                let gzip = request.lines().any(|l| l == "accept-encoding: gzip")
+                    && request
+                        .lines()
+                        .any(|l| l.starts_with("user-agent:") && l.contains("gzip"));
+
+                let (body, encoding) = if gzip {
+                    (&gzipped, "Content-Encoding: gzip\r\n")
+                } else {
+                    (&body, "")
+                };
+                let mut response = format!(
+                    "HTTP/1.1 200 OK\r\nContent-Type: application/json; charset=UTF-8\r\n{}Content-Length: {}\r\n\r\n",
+                    encoding,
+                    body.len()
+                )
+                .into_bytes();
+                response.extend_from_slice(body);
+                for chunk in response.chunks(WRITE_CHUNK) {
+                    if conn.write_all(chunk).await.is_err() {
+                        return;
+                    }
+                    tokio::time::sleep(std::time::Duration::from_secs_f64(
+                        chunk.len() as f64 / BANDWIDTH as f64,
+                    ))
+                    .await;
+                }
+                sent.fetch_add(response.len(), Ordering::Relaxed);
+            }
+        });
+    }
+}
+
+#[tokio::main(flavor = "current_thread")]
+async fn main() {
+    let body = serde_json::to_vec(&file_list()).unwrap();
+    let mut encoder = flate2::write::GzEncoder::new(vec![], flate2::Compression::default());
+    encoder.write_all(&body).unwrap();
+    let gzipped = encoder.finish().unwrap();
+
+    let listener = tokio::net::TcpListener::bind("127.0.0.1:0").await.unwrap();
+    let url = format!("http://{}/files", listener.local_addr().unwrap());
+    let sent = Arc::new(AtomicUsize::new(0));
+    tokio::spawn(serve(
+        listener,
+        Arc::new(body),
+        Arc::new(gzipped),
+        sent.clone(),
+    ));
+
+    let conn = hyper_rustls::HttpsConnectorBuilder::new()
+        .with_native_roots()
+        .https_or_http()
+        .enable_http1()
+        .build();
+    let cl: TlsClient = hyper::Client::builder().build(conn);
+
+    for gzip in [false, true] {
+        let mut headers = vec![];
+        if gzip {
+            accept_gzip(&mut headers);
+        }
+        sent.store(0, Ordering::Relaxed);
+        let started = std::time::Instant::now();
+        for _ in 0..REQUESTS {
+            let list: FileList = do_request(&cl, &url, &headers, "GET", None::<EmptyRequest>)
+                .await
+                .unwrap();
+            assert_eq!(list.files.len(), FILES);
+        }
+        println!(
+            "{:>8}: {:>7} bytes per response, {:>8.2?} per request",
+            if gzip { "gzip" } else { "identity" },
+            sent.load(Ordering::Relaxed) / REQUESTS,
+            started.elapsed() / REQUESTS as u32
+        );
+    }
+}
@@ -0,0 +1,150 @@
+//! Counts the allocations needed to build a request URL the way generated code did before (with
+//! `format!()` and intermediate strings), and the way it does now (writing into one buffer).
+//!
+//! Run with `cargo run --release --example url_allocations`.
+
+use async_google_apis_common::*;
+
+use std::alloc::{GlobalAlloc, Layout, System};
+use std::fmt::Write;
+use std::sync::atomic::{AtomicUsize, Ordering};
+
+struct CountingAllocator;
+
+static ALLOCATIONS: AtomicUsize = AtomicUsize::new(0);
+
+unsafe impl GlobalAlloc for CountingAllocator {
+    unsafe fn alloc(&self, layout: Layout) -> *mut u8 {
+        ALLOCATIONS.fetch_add(1, Ordering::Relaxed);
+        System.alloc(layout)
+    }
+    unsafe fn dealloc(&self, ptr: *mut u8, layout: Layout) {
+        System.dealloc(ptr, layout)
+    }
+    unsafe fn realloc(&self, ptr: *mut u8, layout: Layout, new_size: usize) -> *mut u8 {
+        ALLOCATIONS.fetch_add(1, Ordering::Relaxed);
+        System.realloc(ptr, layout, new_size)
+    }
+}
+
+#[global_allocator]
+static GLOBAL: CountingAllocator = CountingAllocator;
+
+/// Similar to the parameters of a typical `get` method.
+struct Params {
+    bucket: String,
+    object: String,
+    generation: Option<String>,
+    projection: Option<String>,
+    user_project: Option<String>,
+}
+
+const BASE_URL: &str = "https://storage.googleapis.com/storage/v1/";
+
+/// The query string, as previously generated.
+struct OldQuery<'a>(&'a Params);
+
+impl<'a> std::fmt::Display for OldQuery<'a> {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        for (name, value) in [
+            ("generation", &self.0.generation),
+            ("projection", &self.0.projection),
+            ("userProject", &self.0.user_project),
+        ] {
+            if let Some(ref v) = value {
+                write!(
+                    f,
+                    "&{}={}",
+                    name,
+                    percent_encode(format!("{}", v).as_bytes(), NON_ALPHANUMERIC).to_string()
+                )?;
+            }
+        }
+        Ok(())
+    }
+}
+
+/// The query string, as generated now.
+struct NewQuery<'a>(&'a Params);
+
+impl<'a> std::fmt::Display for NewQuery<'a> {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        for (name, value) in [
+            ("&generation=", &self.0.generation),
+            ("&projection=", &self.0.projection),
+            ("&userProject=", &self.0.user_project),
+        ] {
+            if let Some(ref v) = value {
+                f.write_str(name)?;
+                write_encoded(f, v)?;
+            }
+        }
+        Ok(())
+    }
+}
+
+fn old_url(base_url: &String, params: &Params) -> String {
+    // Previously, base_url() cloned the base URL on every call.
+    let base = if base_url.ends_with("/") {
+        base_url.clone()
+    } else {
+        base_url.clone() + "/"
+    };
+    let rel_path = format!(
+        "b/{bucket}/o/{object}",
+        bucket = percent_encode(format!("{}", params.bucket).as_bytes(), NON_ALPHANUMERIC),
+        object = percent_encode(format!("{}", params.object).as_bytes(), NON_ALPHANUMERIC)
+    );
+    let path = base + rel_path.as_str();
+    let url_params = format!("?{params}", params = OldQuery(params));
+    path + &url_params
+}
+
+fn new_url(base_url: &String, params: &Params) -> Result<String> {
+    let mut url = String::with_capacity(BASE_URL.len() + 5 + 128);
+    url.push_str(base_url);
+    url.push_str("b/");
+    write_encoded(&mut url, &params.bucket)?;
+    url.push_str("/o/");
+    write_encoded(&mut url, &params.object)?;
+    url.push_str("?");
+    write_display(&mut url, &NewQuery(params))?;
+    Ok(url)
+}
+
+fn measure<F: FnMut() -> String>(name: &str, rounds: usize, mut f: F) -> String {
+    let before = ALLOCATIONS.load(Ordering::Relaxed);
+    let start = std::time::Instant::now();
+    let mut url = String::new();
+    for _ in 0..rounds {
+        url = std::hint::black_box(f());
+    }
+    let elapsed = start.elapsed();
+    let allocations = ALLOCATIONS.load(Ordering::Relaxed) - before;
+    let mut line = String::new();
+    write!(
+        line,
+        "{:<4} {:>6.1} allocations/call {:>8.1} ns/call",
+        name,
+        allocations as f64 / rounds as f64,
+        elapsed.as_nanos() as f64 / rounds as f64
+    )
+    .unwrap();
+    println!("{}", line);
+    url
+}
+
+fn main() {
+    let base_url = BASE_URL.to_string();
+    let params = Params {
+        bucket: "my-bucket".into(),
+        object: "path/to/some object.txt".into(),
+        generation: Some("1612345678901234".into()),
+        projection: Some("full".into()),
+        user_project: Some("my-project".into()),
+    };
+    let rounds = 100_000;
+    let old = measure("old", rounds, || old_url(&base_url, &params));
+    let new = measure("new", rounds, || new_url(&base_url, &params).unwrap());
+    assert_eq!(old, new);
+}
@@ -0,0 +1,511 @@
+//! Batch requests: Several API calls sent as one `multipart/mixed` HTTP request.
+//!
+//! Generated services provide a `batch()` method returning a builder, which queues calls using the
+//! same parameters as the service's methods. Each queued call returns a `BatchHandle`, which is
+//! used to obtain its typed response from the `BatchResponses` once the batch has been executed.
+
+use crate::*;
+
+use std::io::Write;
+
+/// The maximum number of calls in one batch request. Larger batches are split into several HTTP
+/// requests.
+pub const MAX_BATCH_SIZE: usize = 100;
+
+const BATCH_BOUNDARY: &'static str = "batch_Zq4TmH7bXr2LcW9kVnP3sYd6";
+
+/// Refers to the response of a call queued in a `Batch`.
+#[derive(Debug)]
+pub struct BatchHandle<Response> {
+    index: usize,
+    _marker: std::marker::PhantomData<Response>,
+}
+
+/// Calls queued for sending them as batch request.
+#[derive(Debug)]
+pub struct Batch {
+    url: String,
+    /// HTTP requests (request line, headers, and body) of the queued calls.
+    calls: Vec<Vec<u8>>,
+}
+
+impl Batch {
+    /// Create a batch to be sent to the batch endpoint `url` of an API.
+    pub fn new(url: String) -> Batch {
+        Batch {
+            url: url,
+            calls: vec![],
+        }
+    }
+
+    /// Number of calls queued.
+    pub fn len(&self) -> usize {
+        self.calls.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.calls.is_empty()
+    }
+
+    /// Queue a call, taking the same arguments as `do_request()`.
+    pub fn add<
+        Req: Serialize + std::fmt::Debug,
+        Resp: DeserializeOwned + Default,
+        H: ToHeaderValue,
+    >(
+        &mut self,
+        path: &str,
+        headers: &[(hyper::header::HeaderName, H)],
+        http_method: &str,
+        rq: Option<Req>,
+    ) -> Result<BatchHandle<Resp>> {
+        use anyhow::Context;
+        use std::str::FromStr;
+
+        // Calls within a batch are addressed by path and query only.
+        let uri = hyper::Uri::from_str(path)?;
+        let path = uri.path_and_query().map(|pq| pq.as_str()).unwrap_or("/");
+        let body = match rq {
+            Some(rq) => serde_json::to_string(&rq).context(format!("{:?}", rq))?,
+            None => "".to_string(),
+        };
+
+        let mut call = Vec::with_capacity(path.len() + body.len() + 256);
+        write!(call, "{} {} HTTP/1.1\r\n", http_method, path)?;
+        for (k, v) in headers {
+            call.write_all(k.as_str().as_bytes())?;
+            call.write_all(b": ")?;
+            call.write_all(v.to_header_value()?.as_bytes())?;
+            call.write_all(b"\r\n")?;
+        }
+        if !body.is_empty() && body != "null" {
+            write!(
+                call,
+                "Content-Type: application/json\r\nContent-Length: {}\r\n\r\n{}",
+                body.len(),
+                body
+            )?;
+        } else {
+            call.write_all(b"\r\n")?;
+        }
+        self.calls.push(call);
+        Ok(BatchHandle {
+            index: self.calls.len() - 1,
+            _marker: Default::default(),
+        })
+    }
+
+    /// Format the calls in `calls`, which start at index `offset`, as `multipart/mixed` body.
+    fn format_body(offset: usize, calls: &[Vec<u8>]) -> Vec<u8> {
+        let mut body = Vec::with_capacity(calls.iter().map(|c| c.len() + 128).sum());
+        for (i, call) in calls.iter().enumerate() {
+            write!(
+                body,
+                "--{}\r\nContent-Type: application/http\r\nContent-ID: <{}>\r\n\r\n",
+                BATCH_BOUNDARY,
+                offset + i
+            )
+            .unwrap();
+            body.extend_from_slice(call);
+            body.extend_from_slice(b"\r\n");
+        }
+        write!(body, "--{}--\r\n", BATCH_BOUNDARY).unwrap();
+        body
+    }
+
+    /// Send all queued calls, using one HTTP request per `MAX_BATCH_SIZE` calls. The `Authorization`
+    /// headers are sent with each call.
+    ///
+    /// An error is only returned if a batch request failed as a whole; errors of individual calls
+    /// are returned by `BatchResponses::get()`.
+    pub async fn execute(self, cl: &TlsClient) -> Result<BatchResponses> {
+        let mut responses = Vec::with_capacity(self.calls.len());
+        for (n, calls) in self.calls.chunks(MAX_BATCH_SIZE).enumerate() {
+            let offset = n * MAX_BATCH_SIZE;
+            let body = Batch::format_body(offset, calls);
+            let http_request = hyper::Request::builder()
+                .uri(&self.url)
+                .method("POST")
+                .header(
+                    hyper::header::CONTENT_TYPE,
+                    format!("multipart/mixed; boundary={}", BATCH_BOUNDARY),
+                )
+                .header(hyper::header::CONTENT_LENGTH, body.len())
+                .body(hyper::Body::from(body))?;
+
+            debug!(
+                "Batch::execute: Launching HTTP request with {} calls: {:?}",
+                calls.len(),
+                http_request
+            );
+
+            let http_response = cl.request(http_request).await?;
+            let status = http_response.status();
+
+            debug!(
+                "Batch::execute: HTTP response with status {} received: {:?}",
+                status, http_response
+            );
+
+            let content_type = http_response
+                .headers()
+                .get(hyper::header::CONTENT_TYPE)
+                .map(|ct| ct.to_str().unwrap_or("").to_string())
+                .unwrap_or_default();
+            let response_body = hyper::body::to_bytes(http_response.into_body()).await?;
+            if !status.is_success() {
+                return Err(
+                    ApiError::HTTPResponseError(status, body_to_str(response_body)).into(),
+                );
+            }
+            let boundary = boundary_of(&content_type).ok_or_else(|| {
+                ApiError::BatchResponseError(format!(
+                    "Unexpected Content-Type of batch response: {}",
+                    content_type
+                ))
+            })?;
+
+            let mut chunk_responses: Vec<Option<BatchPart>> = calls.iter().map(|_| None).collect();
+            for (i, part) in parse_batch_response(boundary, &response_body)?
+                .into_iter()
+                .enumerate()
+            {
+                // Responses are usually in order, but the Content-ID is authoritative.
+                let index = match part.id {
+                    Some(id) if id >= offset && id - offset < calls.len() => id - offset,
+                    _ => i,
+                };
+                if index < chunk_responses.len() {
+                    chunk_responses[index] = Some(part);
+                }
+            }
+            responses.extend(chunk_responses);
+        }
+        Ok(BatchResponses {
+            responses: responses,
+        })
+    }
+}
+
+/// The responses to the calls of an executed `Batch`.
+#[derive(Debug)]
+pub struct BatchResponses {
+    responses: Vec<Option<BatchPart>>,
+}
+
+impl BatchResponses {
+    /// Number of calls in the batch.
+    pub fn len(&self) -> usize {
+        self.responses.len()
+    }
+
+    /// Return the response to the call `handle` refers to, or the error returned for it.
+    pub fn get<Resp: DeserializeOwned + Default>(
+        &mut self,
+        handle: BatchHandle<Resp>,
+    ) -> Result<Resp> {
+        let part = match self.responses.get_mut(handle.index).and_then(Option::take) {
+            Some(part) => part,
+            None => {
+                return Err(ApiError::BatchResponseError(format!(
+                    "No response for call {} of batch",
+                    handle.index
+                ))
+                .into())
+            }
+        };
+        if !part.status.is_success() {
+            Err(ApiError::HTTPResponseError(part.status, body_to_str(part.body)).into())
+        } else if part.body.len() > 0 {
+            serde_json::from_reader(part.body.as_ref())
+                .map_err(|e| anyhow::Error::from(e).context(body_to_str(part.body)))
+        } else {
+            Ok(Default::default())
+        }
+    }
+}
+
+/// The response to one call of a batch.
+#[derive(Debug)]
+struct BatchPart {
+    /// Index of the call, taken from the `Content-ID` header.
+    id: Option<usize>,
+    status: hyper::StatusCode,
+    body: hyper::body::Bytes,
+}
+
+/// Extract the boundary from a `multipart/mixed` Content-Type.
+fn boundary_of(content_type: &str) -> Option<&str> {
+    if !content_type.starts_with("multipart/mixed") {
+        return None;
+    }
+    content_type
+        .split(';')
+        .filter_map(|p| p.trim().strip_prefix("boundary="))
+        .next()
+        .map(|b| b.trim_matches('"'))
+}
+
+fn find(haystack: &[u8], needle: &[u8]) -> Option<usize> {
+    haystack.windows(needle.len()).position(|w| w == needle)
+}
+
+/// Split a block of headers from the content following it.
+fn split_headers(b: &[u8]) -> Option<(&[u8], &[u8])> {
+    match (find(b, b"\r\n\r\n"), find(b, b"\n\n")) {
+        (Some(i), Some(j)) if j < i => Some((&b[..j], &b[j + 2..])),
+        (Some(i), _) => Some((&b[..i], &b[i + 4..])),
+        (None, Some(j)) => Some((&b[..j], &b[j + 2..])),
+        (None, None) => None,
+    }
+}
+
+fn parse_batch_response(boundary: &str, body: &[u8]) -> Result<Vec<BatchPart>> {
+    let delimiter = format!("--{}", boundary);
+    let missing_boundary = || ApiError::BatchResponseError("Missing boundary".into());
+    let start = find(body, delimiter.as_bytes()).ok_or_else(missing_boundary)?;
+    let mut rest = &body[start + delimiter.len()..];
+    let mut parts = vec![];
+    // The final delimiter is followed by "--".
+    while !rest.starts_with(b"--") {
+        let end = find(rest, delimiter.as_bytes()).ok_or_else(missing_boundary)?;
+        parts.push(parse_batch_part(&rest[..end])?);
+        rest = &rest[end + delimiter.len()..];
+    }
+    Ok(parts)
+}
+
+/// Parse one part of a batch response, consisting of headers (including the `Content-ID`) and an
+/// HTTP response.
+fn parse_batch_part(part: &[u8]) -> Result<BatchPart> {
+    let invalid = || ApiError::BatchResponseError(body_to_str(part.to_vec().into()));
+    // The line break preceding a delimiter belongs to the delimiter.
+    let part = part.strip_prefix(b"\r\n").or_else(|| part.strip_prefix(b"\n")).unwrap_or(part);
+    let part = part.strip_suffix(b"\r\n").or_else(|| part.strip_suffix(b"\n")).unwrap_or(part);
+
+    let (headers, response) = split_headers(part).ok_or_else(invalid)?;
+    let id = std::str::from_utf8(headers)?
+        .lines()
+        .filter_map(|l| l.split_once(':'))
+        .filter(|(k, _)| k.trim().eq_ignore_ascii_case("content-id"))
+        .filter_map(|(_, v)| {
+            v.trim()
+                .trim_start_matches('<')
+                .trim_end_matches('>')
+                .trim_start_matches("response-")
+                .parse()
+                .ok()
+        })
+        .next();
+
+    // A response without body may lack the empty line after its headers.
+    let (response_headers, response_body) = split_headers(response).unwrap_or((response, b""));
+    let status_line = std::str::from_utf8(response_headers)?
+        .lines()
+        .next()
+        .unwrap_or("");
+    let status = status_line
+        .split_whitespace()
+        .nth(1)
+        .and_then(|s| s.parse().ok())
+        .and_then(|s| hyper::StatusCode::from_u16(s).ok())
+        .ok_or_else(invalid)?;
+    Ok(BatchPart {
+        id: id,
+        status: status,
+        body: hyper::body::Bytes::copy_from_slice(response_body),
+    })
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use tokio::io::{AsyncReadExt, AsyncWriteExt};
+
+    #[derive(Deserialize, Debug, Default)]
+    struct Item {
+        id: String,
+    }
+
+    /// Answer batch requests like an API's batch endpoint, with the responses in reverse order. Calls
+    /// of `/items/{n}` return the item `n`, except for `missing`, which is not found. The number of
+    /// batch requests is counted in `requests`.
+    async fn serve_batches(
+        listener: tokio::net::TcpListener,
+        missing: usize,
+        requests: std::sync::Arc<std::sync::atomic::AtomicUsize>,
+    ) {
+        loop {
+            let (mut conn, _) = listener.accept().await.unwrap();
+            let requests = requests.clone();
+            tokio::spawn(async move {
+                loop {
+                    let mut request = vec![];
+                    let mut buf = [0; 1];
+                    while !request.ends_with(b"\r\n\r\n") {
+                        match conn.read(&mut buf).await {
+                            Ok(0) | Err(_) => return,
+                            Ok(_) => request.extend_from_slice(&buf),
+                        }
+                    }
+                    // hyper sends header names in lower case.
+                    let head = String::from_utf8(request).unwrap();
+                    let len: usize = head
+                        .lines()
+                        .find_map(|l| l.strip_prefix("content-length: "))
+                        .unwrap()
+                        .parse()
+                        .unwrap();
+                    let boundary = head
+                        .lines()
+                        .find_map(|l| l.strip_prefix("content-type: "))
+                        .and_then(boundary_of)
+                        .unwrap()
+                        .to_string();
+                    let mut body = vec![0; len];
+                    conn.read_exact(&mut body).await.unwrap();
+                    requests.fetch_add(1, std::sync::atomic::Ordering::SeqCst);
+
+                    let body = String::from_utf8(body).unwrap();
+                    let mut parts = vec![];
+                    for part in body.split(&format!("--{}", boundary)) {
+                        let id = match part.lines().find_map(|l| l.strip_prefix("Content-ID: ")) {
+                            Some(id) => id.trim_matches(|c| c == '<' || c == '>'),
+                            None => continue,
+                        };
+                        let item: usize = part
+                            .lines()
+                            .find_map(|l| l.strip_prefix("GET /items/"))
+                            .and_then(|l| l.split(' ').next())
+                            .unwrap()
+                            .parse()
+                            .unwrap();
+                        let response = if item == missing {
+                            "HTTP/1.1 404 Not Found\r\n\r\n{\"error\": {\"code\": 404}}".to_string()
+                        } else {
+                            format!("HTTP/1.1 200 OK\r\n\r\n{{\"id\": \"{}\"}}", item)
+                        };
+                        parts.push(format!(
+                            "--batch_resp\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\n{}\r\n",
+                            id, response
+                        ));
+                    }
+                    parts.reverse();
+                    let body = parts.concat() + "--batch_resp--\r\n";
+                    let response = format!(
+                        "HTTP/1.1 200 OK\r\nContent-Type: multipart/mixed; boundary=batch_resp\r\nContent-Length: {}\r\n\r\n{}",
+                        body.len(),
+                        body
+                    );
+                    conn.write_all(response.as_bytes()).await.unwrap();
+                }
+            });
+        }
+    }
+
+    #[tokio::test]
+    async fn test_batch_execute() {
+        let listener = tokio::net::TcpListener::bind("127.0.0.1:0").await.unwrap();
+        let url = format!("http://{}", listener.local_addr().unwrap());
+        let requests = std::sync::Arc::new(std::sync::atomic::AtomicUsize::new(0));
+        tokio::spawn(serve_batches(listener, 123, requests.clone()));
+
+        let conn = hyper_rustls::HttpsConnectorBuilder::new()
+            .with_native_roots()
+            .https_or_http()
+            .enable_http1()
+            .build();
+        let cl: TlsClient = hyper::Client::builder().build(conn);
+        let headers: Vec<(hyper::header::HeaderName, String)> = vec![];
+        let mut batch = Batch::new(format!("{}/batch", url));
+        let n = MAX_BATCH_SIZE + 50;
+        let handles: Vec<BatchHandle<Item>> = (0..n)
+            .map(|i| {
+                batch
+                    .add(
+                        &format!("{}/items/{}", url, i),
+                        &headers,
+                        "GET",
+                        None::<EmptyRequest>,
+                    )
+                    .unwrap()
+            })
+            .collect();
+
+        let mut responses = batch.execute(&cl).await.unwrap();
+        assert_eq!(requests.load(std::sync::atomic::Ordering::SeqCst), 2);
+        assert_eq!(responses.len(), n);
+        for (i, handle) in handles.into_iter().enumerate() {
+            let item = responses.get(handle);
+            if i == 123 {
+                assert!(format!("{:?}", item.unwrap_err()).contains("404"));
+            } else {
+                assert_eq!(item.unwrap().id, i.to_string());
+            }
+        }
+    }
+
+    #[test]
+    fn test_parse_batch_response() {
+        let body = "--batch_abc\r\n\
+            Content-Type: application/http\r\n\
+            Content-ID: <response-1>\r\n\
+            \r\n\
+            HTTP/1.1 404 Not Found\r\n\
+            Content-Type: application/json; charset=UTF-8\r\n\
+            \r\n\
+            {\"error\": {\"code\": 404}}\r\n\
+            --batch_abc\r\n\
+            Content-Type: application/http\r\n\
+            Content-ID: <response-0>\r\n\
+            \r\n\
+            HTTP/1.1 200 OK\r\n\
+            Content-Type: application/json; charset=UTF-8\r\n\
+            \r\n\
+            {\"id\": \"abc\"}\r\n\
+            --batch_abc\r\n\
+            Content-Type: application/http\r\n\
+            Content-ID: <response-2>\r\n\
+            \r\n\
+            HTTP/1.1 204 No Content\r\n\
+            \r\n\
+            --batch_abc--\r\n";
+        let boundary = boundary_of("multipart/mixed; boundary=batch_abc").unwrap();
+        let parts = parse_batch_response(boundary, body.as_bytes()).unwrap();
+        assert_eq!(parts.len(), 3);
+        assert_eq!(parts[0].id, Some(1));
+        assert_eq!(parts[0].status, hyper::StatusCode::NOT_FOUND);
+        assert_eq!(parts[1].id, Some(0));
+        assert_eq!(parts[1].body.as_ref(), b"{\"id\": \"abc\"}");
+        assert_eq!(parts[2].status, hyper::StatusCode::NO_CONTENT);
+        assert!(parts[2].body.is_empty());
+    }
+
+    #[test]
+    fn test_batch_add() {
+        let mut batch = Batch::new("https://example.com/batch/test/v1".into());
+        let headers: Vec<(hyper::header::HeaderName, String)> =
+            vec![(hyper::header::AUTHORIZATION, "Bearer tok".into())];
+        let handle: BatchHandle<EmptyResponse> = batch
+            .add(
+                "https://example.com/test/v1/files/a%20b?fields=id",
+                &headers,
+                "PATCH",
+                Some(serde_json::json!({"name": "x"})),
+            )
+            .unwrap();
+        assert_eq!(handle.index, 0);
+        let body = String::from_utf8(Batch::format_body(0, &batch.calls)).unwrap();
+        assert_eq!(
+            body,
+            format!(
+                "--{b}\r\nContent-Type: application/http\r\nContent-ID: <0>\r\n\r\n\
+                PATCH /test/v1/files/a%20b?fields=id HTTP/1.1\r\n\
+                authorization: Bearer tok\r\n\
+                Content-Type: application/json\r\nContent-Length: 12\r\n\r\n\
+                {{\"name\":\"x\"}}\r\n--{b}--\r\n",
+                b = BATCH_BOUNDARY
+            )
+        );
+    }
+}
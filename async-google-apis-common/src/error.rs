@@ -10,6 +10,10 @@ pub enum ApiError {
     InputDataError(String),
     /// Data for download is available, but the caller hasn't supplied a destination to write to.
     DataAvailableError(String),
+    /// A batch response could not be parsed, or lacks the response to a call.
+    BatchResponseError(String),
+    /// A ranged download received data not matching the range requested.
+    RangeError(String),
 }
 
 impl std::error::Error for ApiError {}
@@ -0,0 +1,56 @@
+//! Field masks, selecting the fields returned in partial responses.
+
+/// A selection of fields, formatted as value of the `fields` parameter, e.g.
+/// `files(id,name),nextPageToken`.
+///
+/// Generated code contains a `<Type>Fields` builder for each type, which is converted into a
+/// `FieldMask` or `String`.
+#[derive(Debug, Clone, Default, PartialEq)]
+pub struct FieldMask {
+    mask: String,
+}
+
+impl FieldMask {
+    pub fn new() -> FieldMask {
+        FieldMask::default()
+    }
+
+    /// Select `field` (by its name in the API).
+    pub fn push(&mut self, field: &str) {
+        if !self.mask.is_empty() {
+            self.mask.push(',');
+        }
+        self.mask.push_str(field);
+    }
+
+    /// Select only the fields in `nested` of `field`. If `nested` is empty, `field` is selected as
+    /// a whole.
+    pub fn push_nested(&mut self, field: &str, nested: &FieldMask) {
+        self.push(field);
+        if !nested.mask.is_empty() {
+            self.mask.push('(');
+            self.mask.push_str(&nested.mask);
+            self.mask.push(')');
+        }
+    }
+
+    pub fn as_str(&self) -> &str {
+        &self.mask
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.mask.is_empty()
+    }
+}
+
+impl std::fmt::Display for FieldMask {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        f.write_str(&self.mask)
+    }
+}
+
+impl From<FieldMask> for String {
+    fn from(m: FieldMask) -> String {
+        m.mask
+    }
+}
@@ -7,10 +7,98 @@ pub trait AsyncWriteUnpin: tokio::io::AsyncWrite + std::marker::Unpin + Send + S
 impl<T> AsyncWriteUnpin for T
 where T: tokio::io::AsyncWrite + std::marker::Unpin + Send + Sync {}
 
-fn body_to_str(b: hyper::body::Bytes) -> String {
+/// Destinations of `Download::download_parallel()`, which writes at arbitrary offsets. Implemented
+/// e.g. by `tokio::fs::File` and `std::io::Cursor<&mut [u8]>`.
+pub trait AsyncSeekWriteUnpin:
+    tokio::io::AsyncWrite + tokio::io::AsyncSeek + std::marker::Unpin + Send + Sync
+{
+}
+
+impl<T> AsyncSeekWriteUnpin for T
+where T: tokio::io::AsyncWrite + tokio::io::AsyncSeek + std::marker::Unpin + Send + Sync {}
+
+/// Default size of the ranges fetched by `Download::download_parallel()`.
+pub const DOWNLOAD_RANGE_SIZE: u64 = 8 * 1024 * 1024;
+
+/// Number of attempts to fetch each range in `Download::download_parallel()`.
+const DOWNLOAD_RANGE_ATTEMPTS: usize = 3;
+
+pub(crate) fn body_to_str(b: hyper::body::Bytes) -> String {
     String::from_utf8(b.to_vec()).unwrap_or("[UTF-8 decode failed]".into())
 }
 
+/// User agent sent by `accept_gzip()`: Google APIs only compress responses if the user agent
+/// contains "gzip".
+pub const GZIP_USER_AGENT: &'static str =
+    concat!("async-google-apis/", env!("CARGO_PKG_VERSION"), " (gzip)");
+
+/// Add the headers asking for a gzip-compressed response to `headers`. Compressed responses are
+/// decompressed transparently by `do_request()` and `do_upload_multipart()`.
+pub fn accept_gzip(headers: &mut Vec<(hyper::header::HeaderName, hyper::header::HeaderValue)>) {
+    headers.push((
+        hyper::header::ACCEPT_ENCODING,
+        hyper::header::HeaderValue::from_static("gzip"),
+    ));
+    headers.push((
+        hyper::header::USER_AGENT,
+        hyper::header::HeaderValue::from_static(GZIP_USER_AGENT),
+    ));
+}
+
+fn is_gzip(headers: &hyper::HeaderMap) -> bool {
+    headers
+        .get(hyper::header::CONTENT_ENCODING)
+        .map(|ce| ce.as_bytes().eq_ignore_ascii_case(b"gzip"))
+        .unwrap_or(false)
+}
+
+/// Return the response body `b`, decompressed if `headers` say it is compressed.
+fn decoded_body(headers: &hyper::HeaderMap, b: hyper::body::Bytes) -> hyper::body::Bytes {
+    use std::io::Read;
+    if !is_gzip(headers) {
+        return b;
+    }
+    let mut decoded = vec![];
+    match flate2::read::GzDecoder::new(b.as_ref()).read_to_end(&mut decoded) {
+        Ok(_) => decoded.into(),
+        Err(_) => b,
+    }
+}
+
+/// Deserialize the JSON response body `b`. A compressed body is decompressed while it is
+/// deserialized, without buffering the decompressed body.
+fn parse_json_body<T: DeserializeOwned>(
+    headers: &hyper::HeaderMap,
+    b: hyper::body::Bytes,
+) -> Result<T> {
+    let result = if is_gzip(headers) {
+        serde_json::from_reader(std::io::BufReader::new(flate2::read::GzDecoder::new(
+            b.as_ref(),
+        )))
+    } else {
+        serde_json::from_reader(b.as_ref())
+    };
+    result.map_err(|e| anyhow::Error::from(e).context(body_to_str(decoded_body(headers, b))))
+}
+
+/// Values of request headers passed to the following functions: `String`s, or `HeaderValue`s,
+/// which are cheaper to clone (see `TokenCache`).
+pub trait ToHeaderValue {
+    fn to_header_value(&self) -> Result<hyper::header::HeaderValue>;
+}
+
+impl ToHeaderValue for String {
+    fn to_header_value(&self) -> Result<hyper::header::HeaderValue> {
+        Ok(hyper::header::HeaderValue::from_str(self)?)
+    }
+}
+
+impl ToHeaderValue for hyper::header::HeaderValue {
+    fn to_header_value(&self) -> Result<hyper::header::HeaderValue> {
+        Ok(self.clone())
+    }
+}
+
 /// This type is used as type parameter to the following functions, when `rq` is `None`.
 #[derive(Debug, Serialize)]
 pub struct EmptyRequest {}
@@ -32,10 +120,11 @@ pub enum DownloadResult<T: DeserializeOwned + std::fmt::Debug> {
 pub async fn do_request<
     Req: Serialize + std::fmt::Debug,
     Resp: DeserializeOwned + Clone + Default,
+    H: ToHeaderValue,
 >(
     cl: &TlsClient,
     path: &str,
-    headers: &[(hyper::header::HeaderName, String)],
+    headers: &[(hyper::header::HeaderName, H)],
     http_method: &str,
     rq: Option<Req>,
 ) -> Result<Resp> {
@@ -50,16 +139,17 @@ pub async fn do_request<
 pub async fn do_request_with_headers<
     Req: Serialize + std::fmt::Debug,
     Resp: DeserializeOwned + Clone + Default,
+    H: ToHeaderValue,
 >(
     cl: &TlsClient,
     path: &str,
-    headers: &[(hyper::header::HeaderName, String)],
+    headers: &[(hyper::header::HeaderName, H)],
     http_method: &str,
     rq: Option<Req>,
 ) -> Result<(Resp, hyper::HeaderMap)> {
     let mut reqb = hyper::Request::builder().uri(path).method(http_method);
     for (k, v) in headers {
-        reqb = reqb.header(k, v);
+        reqb = reqb.header(k, v.to_header_value()?);
     }
     reqb = reqb.header("Content-Type", "application/json");
     let body_str;
@@ -91,13 +181,14 @@ pub async fn do_request_with_headers<
     let headers = http_response.headers().clone();
     let response_body = hyper::body::to_bytes(http_response.into_body()).await?;
     if !status.is_success() {
-        Err(ApiError::HTTPResponseError(status, body_to_str(response_body)).into())
+        Err(
+            ApiError::HTTPResponseError(status, body_to_str(decoded_body(&headers, response_body)))
+                .into(),
+        )
     } else {
         // Evaluate body_to_str lazily
         if response_body.len() > 0 {
-            serde_json::from_reader(response_body.as_ref())
-                .map_err(|e| anyhow::Error::from(e).context(body_to_str(response_body)))
-                .map(|r| (r, headers))
+            parse_json_body(&headers, response_body).map(|r| (r, headers))
         } else {
             Ok((Default::default(), headers))
         }
@@ -108,27 +199,60 @@ pub async fn do_request_with_headers<
 pub async fn do_upload_multipart<
     Req: Serialize + std::fmt::Debug,
     Resp: DeserializeOwned + Clone,
+    H: ToHeaderValue,
 >(
     cl: &TlsClient,
     path: &str,
-    headers: &[(hyper::header::HeaderName, String)],
+    headers: &[(hyper::header::HeaderName, H)],
     http_method: &str,
     req: Option<Req>,
     data: hyper::body::Bytes,
+) -> Result<Resp> {
+    let (body, len, boundary) = multipart::format_multipart(&req, data)?;
+    send_multipart(cl, path, headers, http_method, body, Some(len), &boundary).await
+}
+
+/// Like `do_upload_multipart()`, but the data is read from `data` while it is sent, in chunks of
+/// `UPLOAD_CHUNK_SIZE`. Memory use doesn't depend on the size of the upload. The request is sent
+/// with chunked transfer encoding.
+pub async fn do_upload_multipart_stream<
+    Req: Serialize + std::fmt::Debug,
+    Resp: DeserializeOwned + Clone,
+    H: ToHeaderValue,
+    R: tokio::io::AsyncRead + Send + 'static,
+>(
+    cl: &TlsClient,
+    path: &str,
+    headers: &[(hyper::header::HeaderName, H)],
+    http_method: &str,
+    req: Option<Req>,
+    data: R,
+) -> Result<Resp> {
+    let (body, boundary) = multipart::stream_multipart(&req, data)?;
+    send_multipart(cl, path, headers, http_method, body, None, &boundary).await
+}
+
+async fn send_multipart<Resp: DeserializeOwned + Clone, H: ToHeaderValue>(
+    cl: &TlsClient,
+    path: &str,
+    headers: &[(hyper::header::HeaderName, H)],
+    http_method: &str,
+    body: hyper::Body,
+    len: Option<usize>,
+    boundary: &str,
 ) -> Result<Resp> {
     let mut reqb = hyper::Request::builder().uri(path).method(http_method);
     for (k, v) in headers {
-        reqb = reqb.header(k, v);
+        reqb = reqb.header(k, v.to_header_value()?);
+    }
+    if let Some(len) = len {
+        reqb = reqb.header("Content-Length", len);
     }
-
-    let data = multipart::format_multipart(&req, data)?;
-    reqb = reqb.header("Content-Length", data.as_ref().len());
     reqb = reqb.header(
         "Content-Type",
-        format!("multipart/related; boundary={}", multipart::MIME_BOUNDARY),
+        format!("multipart/related; boundary={}", boundary),
     );
 
-    let body = hyper::Body::from(data.as_ref().to_vec());
     let http_request = reqb.body(body)?;
     debug!(
         "do_upload_multipart: Launching HTTP request: {:?}",
@@ -140,13 +264,16 @@ pub async fn do_upload_multipart<
         "do_upload_multipart: HTTP response with status {} received: {:?}",
         status, http_response
     );
+    let headers = http_response.headers().clone();
     let response_body = hyper::body::to_bytes(http_response.into_body()).await?;
 
     if !status.is_success() {
-        Err(ApiError::HTTPResponseError(status, body_to_str(response_body)).into())
+        Err(
+            ApiError::HTTPResponseError(status, body_to_str(decoded_body(&headers, response_body)))
+                .into(),
+        )
     } else {
-        serde_json::from_reader(response_body.as_ref())
-            .map_err(|e| anyhow::Error::from(e).context(body_to_str(response_body)))
+        parse_json_body(&headers, response_body)
     }
 }
 
@@ -162,11 +289,17 @@ pub struct Download<'a, Request, Response> {
     http_method: String,
     uri: hyper::Uri,
     rq: Option<&'a Request>,
-    headers: Vec<(hyper::header::HeaderName, String)>,
+    headers: Vec<(hyper::header::HeaderName, hyper::header::HeaderValue)>,
+    range_size: u64,
 
     _marker: std::marker::PhantomData<Response>,
 }
 
+/// Return the total size from a `Content-Range: bytes 0-0/1234` header.
+fn parse_content_range_total(rng: &str) -> Option<u64> {
+    rng.strip_prefix("bytes ")?.rsplit('/').next()?.parse().ok()
+}
+
 impl<'a, Request: Serialize + std::fmt::Debug, Response: DeserializeOwned + std::fmt::Debug>
     Download<'a, Request, Response>
 {
@@ -200,7 +333,7 @@ impl<'a, Request: Serialize + std::fmt::Debug, Response: DeserializeOwned + std:
                 .uri(&uri)
                 .method(self.http_method.as_str());
             for (k, v) in self.headers.iter() {
-                reqb = reqb.header(k, v);
+                reqb = reqb.header(k, v.clone());
             }
 
             let body;
@@ -289,34 +422,242 @@ impl<'a, Request: Serialize + std::fmt::Debug, Response: DeserializeOwned + std:
             }
         }
     }
+
+    /// Set the size of the ranges fetched by `download_parallel()`; the default is
+    /// `DOWNLOAD_RANGE_SIZE`.
+    pub fn set_range_size(&mut self, size: u64) -> Result<&mut Self> {
+        if size == 0 {
+            Err(ApiError::InputDataError("Download: range size must not be zero.".into()).into())
+        } else {
+            self.range_size = size;
+            Ok(self)
+        }
+    }
+
+    /// Like `do_it()`, but download the data in ranges (see `set_range_size()`), fetching up to
+    /// `parallelism` ranges concurrently, and write each range at its offset into `dst`. This is
+    /// faster for large objects than a single connection.
+    ///
+    /// The size of the data is determined by requesting its first byte. Ranges that fail are
+    /// retried on their own, up to three times. Up to `parallelism` ranges are held in memory. If
+    /// the server doesn't support ranges, the data is downloaded in one piece, as by `do_it()`.
+    pub async fn download_parallel(
+        &mut self,
+        dst: &mut (dyn AsyncSeekWriteUnpin),
+        parallelism: usize,
+    ) -> Result<DownloadResult<Response>> {
+        use tokio::io::AsyncWriteExt;
+
+        let body = match self.rq {
+            Some(rq) => {
+                hyper::body::Bytes::from(serde_json::to_vec(rq).context(format!("{:?}", rq))?)
+            }
+            None => hyper::body::Bytes::new(),
+        };
+        let http_response = self.send_range(&body, 0, 0).await?;
+        let status = http_response.status();
+        debug!(
+            "Download::download_parallel: HTTP response with status {} received: {:?}",
+            status, http_response
+        );
+        // There is no first byte to return.
+        if status == hyper::StatusCode::RANGE_NOT_SATISFIABLE {
+            return Ok(DownloadResult::Downloaded);
+        }
+        if !status.is_success() {
+            return Err(ApiError::HTTPResponseError(
+                status,
+                body_to_str(hyper::body::to_bytes(http_response.into_body()).await?),
+            )
+            .into());
+        }
+        if let Some(ct) = http_response.headers().get(hyper::header::CONTENT_TYPE) {
+            if ct.to_str()?.contains("application/json") {
+                let response_body = hyper::body::to_bytes(http_response.into_body()).await?;
+                return serde_json::from_reader(response_body.as_ref())
+                    .map_err(|e| anyhow::Error::from(e).context(body_to_str(response_body)))
+                    .map(DownloadResult::Response);
+            }
+        }
+
+        let total = if status == hyper::StatusCode::PARTIAL_CONTENT {
+            http_response
+                .headers()
+                .get(hyper::header::CONTENT_RANGE)
+                .and_then(|rng| rng.to_str().ok())
+                .and_then(parse_content_range_total)
+        } else {
+            None
+        };
+        let mut response_body = http_response.into_body();
+        let total = match total {
+            Some(total) => total,
+            None => {
+                // The server ignored the Range header, and sends all data.
+                dst.seek(std::io::SeekFrom::Start(0)).await?;
+                while let Some(chunk) = tokio_stream::StreamExt::next(&mut response_body).await {
+                    dst.write_all(chunk?.as_ref()).await?;
+                }
+                dst.flush().await?;
+                return Ok(DownloadResult::Downloaded);
+            }
+        };
+        // Read the rest of the response, so that the connection can be reused.
+        hyper::body::to_bytes(response_body).await?;
+
+        let this = &*self;
+        let body = &body;
+        let range_size = self.range_size;
+        let ranges = (0..total)
+            .step_by(range_size as usize)
+            .map(|from| this.fetch_range(body, from, std::cmp::min(from + range_size, total) - 1));
+        let mut ranges =
+            futures::StreamExt::buffer_unordered(futures::stream::iter(ranges), parallelism.max(1));
+        while let Some(range) = tokio_stream::StreamExt::next(&mut ranges).await {
+            let (from, data) = range?;
+            dst.seek(std::io::SeekFrom::Start(from)).await?;
+            dst.write_all(data.as_ref()).await?;
+        }
+        dst.flush().await?;
+        Ok(DownloadResult::Downloaded)
+    }
+
+    /// Fetch the bytes `from..=to`, making up to `DOWNLOAD_RANGE_ATTEMPTS` attempts.
+    async fn fetch_range(
+        &self,
+        body: &hyper::body::Bytes,
+        from: u64,
+        to: u64,
+    ) -> Result<(u64, hyper::body::Bytes)> {
+        let mut attempt = 1;
+        loop {
+            match self.fetch_range_once(body, from, to).await {
+                Err(e) if attempt < DOWNLOAD_RANGE_ATTEMPTS => {
+                    warn!(
+                        "Download::download_parallel: Attempt {} to fetch bytes {}-{} failed: {:?}",
+                        attempt, from, to, e
+                    );
+                    attempt += 1;
+                }
+                result => return result.map(|data| (from, data)),
+            }
+        }
+    }
+
+    async fn fetch_range_once(
+        &self,
+        body: &hyper::body::Bytes,
+        from: u64,
+        to: u64,
+    ) -> Result<hyper::body::Bytes> {
+        let http_response = self.send_range(body, from, to).await?;
+        let status = http_response.status();
+        let data = hyper::body::to_bytes(http_response.into_body()).await?;
+        if status != hyper::StatusCode::PARTIAL_CONTENT {
+            return Err(ApiError::HTTPResponseError(status, body_to_str(data)).into());
+        }
+        if data.len() as u64 != to - from + 1 {
+            return Err(ApiError::RangeError(format!(
+                "Requested bytes {}-{}, but received {} bytes",
+                from,
+                to,
+                data.len()
+            ))
+            .into());
+        }
+        Ok(data)
+    }
+
+    /// Request the bytes `from..=to`, following redirects. Returns the first response that isn't a
+    /// redirect.
+    async fn send_range(
+        &self,
+        body: &hyper::body::Bytes,
+        from: u64,
+        to: u64,
+    ) -> Result<hyper::Response<hyper::Body>> {
+        use std::str::FromStr;
+
+        let mut uri = self.uri.clone();
+        for n_redirects in 0..=5 {
+            let mut reqb = hyper::Request::builder()
+                .uri(&uri)
+                .method(self.http_method.as_str());
+            for (k, v) in self.headers.iter() {
+                reqb = reqb.header(k, v.clone());
+            }
+            reqb = reqb.header(hyper::header::RANGE, format!("bytes={}-{}", from, to));
+            let http_request = reqb.body(hyper::Body::from(body.clone()))?;
+            debug!(
+                "Download::download_parallel: Redirect {}, Launching HTTP request: {:?}",
+                n_redirects, http_request
+            );
+
+            let http_response = self.cl.request(http_request).await?;
+            if !http_response.status().is_redirection() {
+                return Ok(http_response);
+            }
+            match http_response.headers().get(hyper::header::LOCATION) {
+                Some(location) => uri = hyper::Uri::from_str(location.to_str()?)?,
+                None => {
+                    return Err(ApiError::RedirectError(format!(
+                        "Redirect doesn't contain a Location: header"
+                    ))
+                    .into())
+                }
+            }
+        }
+        Err(ApiError::HTTPTooManyRedirectsError.into())
+    }
 }
 
 pub async fn do_download<
     'a,
     Req: Serialize + std::fmt::Debug,
     Resp: DeserializeOwned + std::fmt::Debug,
+    H: ToHeaderValue,
 >(
     cl: &'a TlsClient,
     path: &str,
-    headers: Vec<(hyper::header::HeaderName, String)>,
+    headers: Vec<(hyper::header::HeaderName, H)>,
     http_method: String,
     rq: Option<&'a Req>,
 ) -> Result<Download<'a, Req, Resp>> {
     use std::str::FromStr;
+    let headers = headers
+        .into_iter()
+        .map(|(k, v)| Ok((k, v.to_header_value()?)))
+        .collect::<Result<Vec<_>>>()?;
     Ok(Download {
         cl: cl,
         http_method: http_method,
         uri: hyper::Uri::from_str(path)?,
         rq: rq,
         headers: headers,
+        range_size: DOWNLOAD_RANGE_SIZE,
         _marker: Default::default(),
     })
 }
 
+/// Default size of the first chunk of resumable uploads.
+pub const RESUMABLE_CHUNKSIZE: usize = 5 * 1024 * 1024;
+/// Largest chunk size of resumable uploads created by generated methods.
+pub const RESUMABLE_MAX_CHUNKSIZE: usize = 64 * 1024 * 1024;
+/// Chunk sizes of resumable uploads must be multiples of this (except for the last chunk).
+const RESUMABLE_CHUNK_GRANULARITY: usize = 256 * 1024;
+/// Chunk sizes are adapted so that sending a chunk takes about this long.
+const RESUMABLE_CHUNK_DURATION: std::time::Duration = std::time::Duration::from_secs(2);
+
 /// A resumable upload in progress, useful for sending large objects.
+///
+/// Data is sent in chunks. The size of the chunks is adapted to the measured throughput, starting
+/// at `set_chunksize()` (by default, `RESUMABLE_CHUNKSIZE`) and bounded by the maximum chunk size
+/// given to `new()` or `set_max_chunksize()`. The next chunk is read while the current one is
+/// being sent, so up to two chunks are held in memory.
 pub struct ResumableUpload<'client, Response: DeserializeOwned> {
     dest: hyper::Uri,
     cl: &'client TlsClient,
+    chunksize: usize,
     max_chunksize: usize,
     _resp: std::marker::PhantomData<Response>,
 }
@@ -341,7 +682,23 @@ fn parse_response_range(rng: &str) -> Option<(usize, usize)> {
     }
 }
 
+/// Read exactly `n` bytes from `f` into `buf`, reusing its allocation.
+async fn read_chunk<R: tokio::io::AsyncRead + std::marker::Unpin>(
+    f: &mut R,
+    mut buf: Vec<u8>,
+    n: usize,
+) -> Result<Vec<u8>> {
+    use tokio::io::AsyncReadExt;
+    buf.clear();
+    buf.resize(n, 0);
+    f.read_exact(&mut buf).await?;
+    Ok(buf)
+}
+
 impl<'client, Response: DeserializeOwned> ResumableUpload<'client, Response> {
+    /// Create an upload to `to`, whose chunks have at most `max_chunksize` bytes. The first chunk
+    /// has `RESUMABLE_CHUNKSIZE` bytes, or `max_chunksize` if that is smaller (see
+    /// `set_chunksize()`).
     pub fn new(
         to: hyper::Uri,
         cl: &'client TlsClient,
@@ -350,68 +707,115 @@ impl<'client, Response: DeserializeOwned> ResumableUpload<'client, Response> {
         ResumableUpload {
             dest: to,
             cl: cl,
+            chunksize: std::cmp::min(RESUMABLE_CHUNKSIZE, max_chunksize),
             max_chunksize: max_chunksize,
             _resp: Default::default(),
         }
     }
-    pub fn set_max_chunksize(&mut self, size: usize) -> Result<&mut Self> {
-        if size % (1024 * 256) != 0 {
+
+    fn check_chunksize(size: usize) -> Result<()> {
+        if size == 0 || size % RESUMABLE_CHUNK_GRANULARITY != 0 {
             Err(ApiError::InputDataError(
-                "ResumableUpload: max_chunksize must be multiple of 256 KiB.".into(),
+                "ResumableUpload: chunk sizes must be multiples of 256 KiB.".into(),
             )
             .into())
         } else {
-            self.max_chunksize = size;
-            Ok(self)
+            Ok(())
+        }
+    }
+
+    /// Set the size of the first chunk; the following chunks are sized according to the
+    /// throughput. Must be a multiple of 256 KiB, and not larger than the maximum chunk size.
+    pub fn set_chunksize(&mut self, size: usize) -> Result<&mut Self> {
+        Self::check_chunksize(size)?;
+        if size > self.max_chunksize {
+            return Err(ApiError::InputDataError(format!(
+                "ResumableUpload: chunksize {} is larger than max_chunksize {}.",
+                size, self.max_chunksize
+            ))
+            .into());
         }
+        self.chunksize = size;
+        Ok(self)
     }
 
-    /// Upload data from a reader; use only if the reader cannot be seeked. Memory usage is higher,
-    /// because data needs to be cached if the server hasn't accepted all data.
+    /// Set the largest size of chunks. Must be a multiple of 256 KiB. Setting it to the size of
+    /// the first chunk disables adapting chunk sizes.
+    pub fn set_max_chunksize(&mut self, size: usize) -> Result<&mut Self> {
+        Self::check_chunksize(size)?;
+        self.max_chunksize = size;
+        self.chunksize = std::cmp::min(self.chunksize, size);
+        Ok(self)
+    }
+
+    /// Return the size of the chunks to send at `throughput` bytes per second: as much as can be
+    /// sent in `RESUMABLE_CHUNK_DURATION`, but at most twice the current `chunksize`.
+    fn adapt_chunksize(&self, chunksize: usize, throughput: f64) -> usize {
+        let target = (throughput * RESUMABLE_CHUNK_DURATION.as_secs_f64()) as usize;
+        let target = std::cmp::min(target, 2 * chunksize);
+        let target = target / RESUMABLE_CHUNK_GRANULARITY * RESUMABLE_CHUNK_GRANULARITY;
+        std::cmp::max(target, RESUMABLE_CHUNK_GRANULARITY).min(self.max_chunksize)
+    }
+
+    /// Send `chunk`, which starts at `from` of `size` bytes in total. Returns the response and the
+    /// time it took.
+    async fn send_chunk(
+        &self,
+        chunk: hyper::body::Bytes,
+        from: usize,
+        size: usize,
+    ) -> Result<(hyper::Response<hyper::Body>, std::time::Duration)> {
+        let started = std::time::Instant::now();
+        let reqb = hyper::Request::builder()
+            .uri(self.dest.clone())
+            .method(hyper::Method::PUT)
+            .header(hyper::header::CONTENT_LENGTH, chunk.len())
+            .header(
+                hyper::header::CONTENT_RANGE,
+                format_content_range(from, from + chunk.len() - 1, size),
+            )
+            .header(hyper::header::CONTENT_TYPE, "application/octet-stream");
+        let request = reqb.body(hyper::Body::from(chunk))?;
+        debug!("upload_file: Launching HTTP request: {:?}", request);
+
+        let response = self.cl.request(request).await?;
+        debug!("upload_file: Received response: {:?}", response);
+        Ok((response, started.elapsed()))
+    }
+
+    /// Upload `size` bytes from a reader. At most two chunks are held in memory: the one being
+    /// sent, and the next one, which is read meanwhile. Chunks the server didn't accept completely
+    /// are sent again from memory.
     pub async fn upload<R: tokio::io::AsyncRead + std::marker::Unpin>(
         &self,
         mut f: R,
         size: usize,
     ) -> Result<Response> {
-        use tokio::io::AsyncReadExt;
-
+        let mut chunksize = self.chunksize;
         // Cursor to current position in stream.
         let mut current = 0;
-        // Buffer portion that we couldn't send previously.
-        let mut previously_unsent = None;
+        // Number of bytes read from `f`.
+        let mut read = std::cmp::min(chunksize, size);
+        // Chunks read, but not yet accepted by the server; the first one is sent next.
+        let mut pending = std::collections::VecDeque::with_capacity(2);
+        pending.push_back(hyper::body::Bytes::from(
+            read_chunk(&mut f, vec![], read).await?,
+        ));
+        // Allocation of a chunk that was sent, reused for reading.
+        let mut spare = vec![];
         loop {
-            let chunksize = if (size - current) > self.max_chunksize {
-                self.max_chunksize
-            } else {
-                size - current
-            };
-
-            let mut buf: Vec<u8>;
-            let read_from_stream;
-            if let Some(buf2) = previously_unsent.take() {
-                buf = buf2;
-                read_from_stream = buf.len();
-            } else {
-                buf = vec![0 as u8; chunksize];
-                // Move buffer into body.
-                read_from_stream = f.read_exact(&mut buf).await?;
-                buf.resize(read_from_stream, 0);
-            }
-
-            let reqb = hyper::Request::builder()
-                .uri(self.dest.clone())
-                .method(hyper::Method::PUT)
-                .header(hyper::header::CONTENT_LENGTH, read_from_stream)
-                .header(
-                    hyper::header::CONTENT_RANGE,
-                    format_content_range(current, current + read_from_stream - 1, size),
-                )
-                .header(hyper::header::CONTENT_TYPE, "application/octet-stream");
-            let request = reqb.body(hyper::Body::from(buf[..].to_vec()))?;
-            debug!("upload_file: Launching HTTP request: {:?}", request);
-
-            let response = self.cl.request(request).await?;
-            debug!("upload_file: Received response: {:?}", response);
+            let chunk = pending.pop_front().unwrap();
+            let read_ahead = pending.is_empty() && read < size;
+            let next_len = std::cmp::min(chunksize, size - read);
+            let (sent, next) =
+                futures::join!(self.send_chunk(chunk.clone(), current, size), async {
+                    if read_ahead {
+                        Some(read_chunk(&mut f, std::mem::take(&mut spare), next_len).await)
+                    } else {
+                        None
+                    }
+                });
+            let (response, elapsed) = sent?;
 
             let status = response.status();
             // 308 means: continue upload.
@@ -422,26 +826,21 @@ impl<'client, Response: DeserializeOwned> ResumableUpload<'client, Response> {
                 );
             }
 
-            let sent;
+            let mut sent = chunk.len();
             if let Some(rng) = response.headers().get(hyper::header::RANGE) {
                 if let Some((_, to)) = parse_response_range(rng.to_str()?) {
                     sent = to + 1 - current;
-                    if sent < read_from_stream {
-                        previously_unsent = Some(buf.split_off(sent));
-                    }
-                    current = to + 1;
-                } else {
-                    sent = read_from_stream;
-                    current += read_from_stream;
                 }
-            } else {
-                sent = read_from_stream;
-                current += read_from_stream;
             }
+            current += sent;
 
             debug!(
-                "upload_file: Sent {} bytes (successful: {}) of total {} to {}",
-                chunksize, sent, size, self.dest
+                "upload_file: Sent {} bytes (successful: {}) of total {} to {} in {:?}",
+                chunk.len(),
+                sent,
+                size,
+                self.dest,
+                elapsed
             );
 
             if current >= size {
@@ -462,91 +861,116 @@ impl<'client, Response: DeserializeOwned> ResumableUpload<'client, Response> {
                     });
                 }
             }
-        }
-    }
-    /// Upload content from a file. This is most efficient if you have an actual file, as seek can
-    /// be used in case the server didn't accept all data.
-    pub async fn upload_file(&self, mut f: tokio::fs::File) -> Result<Response> {
-        use tokio::io::AsyncReadExt;
 
-        let len = f.metadata().await?.len() as usize;
-        let mut current = 0;
-        loop {
-            let chunksize = if (len - current) > self.max_chunksize {
-                self.max_chunksize
-            } else {
-                len - current
-            };
-
-            f.seek(std::io::SeekFrom::Start(current as u64)).await?;
-
-            let mut buf = vec![0 as u8; chunksize];
-            // Move buffer into body.
-            let read_from_stream = f.read_exact(&mut buf).await?;
-            buf.resize(read_from_stream, 0);
-
-            let reqb = hyper::Request::builder()
-                .uri(self.dest.clone())
-                .method(hyper::Method::PUT)
-                .header(hyper::header::CONTENT_LENGTH, read_from_stream)
-                .header(
-                    hyper::header::CONTENT_RANGE,
-                    format_content_range(current, current + read_from_stream - 1, len),
-                )
-                .header(hyper::header::CONTENT_TYPE, "application/octet-stream");
-            let request = reqb.body(hyper::Body::from(buf))?;
-            debug!("upload_file: Launching HTTP request: {:?}", request);
-
-            let response = self.cl.request(request).await?;
-            debug!("upload_file: Received response: {:?}", response);
-
-            let status = response.status();
-            // 308 means: continue upload.
-            if !status.is_success() && status.as_u16() != 308 {
-                debug!("upload_file: Encountered error: {}", status);
-                return Err(ApiError::HTTPResponseError(status, status.to_string())).context(
-                    body_to_str(hyper::body::to_bytes(response.into_body()).await?),
-                );
+            if let Some(next) = next {
+                let next = next?;
+                read += next.len();
+                pending.push_back(hyper::body::Bytes::from(next));
             }
-
-            let sent;
-            if let Some(rng) = response.headers().get(hyper::header::RANGE) {
-                if let Some((_, to)) = parse_response_range(rng.to_str()?) {
-                    sent = to + 1 - current;
-                    current = to + 1;
-                } else {
-                    sent = read_from_stream;
-                    current += read_from_stream;
-                }
+            if sent < chunk.len() {
+                pending.push_front(chunk.slice(sent..));
             } else {
-                // This can also happen if response code is 200.
-                sent = read_from_stream;
-                current += read_from_stream;
+                // Doesn't copy, as the request (holding the other reference) has been sent.
+                spare = Vec::from(chunk);
+            }
+            if sent > 0 {
+                chunksize = self.adapt_chunksize(chunksize, sent as f64 / elapsed.as_secs_f64());
             }
+        }
+    }
 
-            debug!(
-                "upload_file: Sent {} bytes (successful: {}) of total {} to {}",
-                chunksize, sent, len, self.dest
-            );
+    /// Upload content from a file, from its beginning. Like `upload()`, data the server didn't
+    /// accept is sent again from memory; the file is not seeked back to read it again.
+    pub async fn upload_file(&self, mut f: tokio::fs::File) -> Result<Response> {
+        let len = f.metadata().await?.len() as usize;
+        f.seek(std::io::SeekFrom::Start(0)).await?;
+        self.upload(f, len).await
+    }
+}
 
-            if current >= len {
-                let headers = response.headers().clone();
-                let response_body = hyper::body::to_bytes(response.into_body()).await?;
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use tokio::io::{AsyncReadExt, AsyncWriteExt};
 
-                if !status.is_success() {
-                    return Err(Error::from(ApiError::HTTPResponseError(
-                        status,
-                        body_to_str(response_body),
-                    ))
-                    .context(format!("{:?}", headers)));
+    /// Serve `data` to requests with a `Range` header, like a storage server. The first request for
+    /// the range starting at `fail_at` fails.
+    async fn serve_ranges(listener: tokio::net::TcpListener, data: Vec<u8>, fail_at: usize) {
+        let failed = std::sync::Arc::new(std::sync::atomic::AtomicBool::new(false));
+        loop {
+            let (mut conn, _) = listener.accept().await.unwrap();
+            let (data, failed) = (data.clone(), failed.clone());
+            tokio::spawn(async move {
+                let mut request = vec![];
+                let mut buf = [0; 1024];
+                while !request.ends_with(b"\r\n\r\n") {
+                    let n = conn.read(&mut buf).await.unwrap();
+                    if n == 0 {
+                        return;
+                    }
+                    request.extend_from_slice(&buf[..n]);
+                }
+                let request = String::from_utf8(request).unwrap().to_lowercase();
+                let range = request
+                    .lines()
+                    .find_map(|l| l.strip_prefix("range: bytes="))
+                    .unwrap();
+                let mut bounds = range.split('-').map(|b| b.parse::<usize>().unwrap());
+                let (from, to) = (bounds.next().unwrap(), bounds.next().unwrap());
+                let to = std::cmp::min(to, data.len() - 1);
+                let mut response;
+                if from == fail_at && !failed.swap(true, std::sync::atomic::Ordering::SeqCst) {
+                    response =
+                        b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n".to_vec();
                 } else {
-                    return serde_json::from_reader(response_body.as_ref()).map_err(|e| {
-                        anyhow::Error::from(e)
-                            .context(body_to_str(response_body))
-                            .context(format!("{:?}", headers))
-                    });
+                    response = format!(
+                        "HTTP/1.1 206 Partial Content\r\nContent-Range: bytes {}-{}/{}\r\nContent-Length: {}\r\n\r\n",
+                        from,
+                        to,
+                        data.len(),
+                        to - from + 1
+                    )
+                    .into_bytes();
+                    response.extend_from_slice(&data[from..=to]);
                 }
-            }
+                conn.write_all(&response).await.unwrap();
+            });
         }
     }
+
+    #[test]
+    fn test_parse_content_range_total() {
+        assert_eq!(parse_content_range_total("bytes 0-0/1234"), Some(1234));
+        assert_eq!(parse_content_range_total("bytes */0"), Some(0));
+        assert_eq!(parse_content_range_total("bytes 0-0/*"), None);
+    }
+
+    #[tokio::test]
+    async fn test_download_parallel() {
+        let data: Vec<u8> = (0..100_000u32).map(|i| (i % 251) as u8).collect();
+        let listener = tokio::net::TcpListener::bind("127.0.0.1:0").await.unwrap();
+        let url = format!("http://{}/object", listener.local_addr().unwrap());
+        tokio::spawn(serve_ranges(listener, data.clone(), 30_000));
+
+        let conn = hyper_rustls::HttpsConnectorBuilder::new()
+            .with_native_roots()
+            .https_or_http()
+            .enable_http1()
+            .build();
+        let cl: TlsClient = hyper::Client::builder().build(conn);
+        let headers: Vec<(hyper::header::HeaderName, hyper::header::HeaderValue)> = vec![];
+        let mut download: Download<EmptyRequest, EmptyResponse> =
+            do_download(&cl, &url, headers, "GET".into(), None)
+                .await
+                .unwrap();
+        download.set_range_size(10_000).unwrap();
+
+        let mut buf = vec![0; data.len()];
+        let result = download
+            .download_parallel(&mut std::io::Cursor::new(&mut buf[..]), 4)
+            .await
+            .unwrap();
+        assert!(matches!(result, DownloadResult::Downloaded));
+        assert_eq!(buf, data);
+    }
 }
@@ -5,17 +5,32 @@
 //! [async-google-apis](https://github.com/dermesser/async-google-apis) on github. It is a code
 //! generator, which generates code that utilizes this crate.
 
+mod batch;
+pub use batch::*;
 mod error;
 pub use error::*;
+mod fields;
+pub use fields::*;
 mod http;
 pub use http::*;
+mod token;
+pub use token::*;
+mod url;
+pub use url::*;
+mod vecmap;
+pub use vecmap::*;
 
 mod multipart;
+pub use multipart::UPLOAD_CHUNK_SIZE;
+mod paginate;
+pub use paginate::*;
 
+pub use futures;
 pub use hyper;
 pub use log::{debug, error, info, trace, warn};
 pub use serde;
 pub use serde_json;
+pub use tokio;
 pub use yup_oauth2;
 
 pub use anyhow::{Error, Result};
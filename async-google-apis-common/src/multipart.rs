@@ -1,39 +1,124 @@
 //! Format and stream a multipart/related request, for uploads.
 
+use futures::stream::{self, StreamExt};
 use hyper::{self, body::Bytes};
-use radix64::STD;
 use serde::Serialize;
-use std::io::Write;
+use tokio::io::AsyncReadExt;
 
 use anyhow::Context;
 
-pub const MIME_BOUNDARY: &'static str = "PB0BHe6XN3O6Q4bpnWQgS1pKfMfglTZdifFvh8YIc2APj4Cz3C";
+/// Size of the chunks in which streamed data is read and sent.
+pub const UPLOAD_CHUNK_SIZE: usize = 256 * 1024;
 
+/// Return a random boundary for a multipart body. As the data is sent as is, a fixed boundary could
+/// occur in it, ending its part early.
+fn random_boundary() -> String {
+    use std::hash::{BuildHasher, Hasher};
+    // RandomState is seeded randomly, so its hashers yield random numbers.
+    let state = std::collections::hash_map::RandomState::new();
+    let nanos = std::time::SystemTime::now()
+        .duration_since(std::time::UNIX_EPOCH)
+        .map(|d| d.as_nanos())
+        .unwrap_or(0);
+    let mut boundary = String::with_capacity(48);
+    for i in 0..3u8 {
+        let mut hasher = state.build_hasher();
+        hasher.write_u8(i);
+        hasher.write_u128(nanos);
+        boundary.push_str(&format!("{:016x}", hasher.finish()));
+    }
+    boundary
+}
+
+/// Whether `boundary` occurs in `data`.
+fn contains_boundary(data: &[u8], boundary: &str) -> bool {
+    let boundary = boundary.as_bytes();
+    data.windows(boundary.len()).any(|w| w == boundary)
+}
+
+/// Return the parts of a multipart body with `boundary` preceding and following the (binary) data.
+fn format_multipart_frame<Req: Serialize + std::fmt::Debug>(
+    req: &Req,
+    boundary: &str,
+) -> anyhow::Result<(Bytes, Bytes)> {
+    let meta = serde_json::to_string(req).context(format!("{:?}", req))?;
+    let head = format!(
+        "--{boundary}\nContent-Type: application/json; charset=UTF-8\n\n{meta}\n\n--{boundary}\nContent-Type: application/octet-stream\n\n",
+        boundary = boundary,
+        meta = meta
+    );
+    let tail = format!("\n\n--{}--\n", boundary);
+    Ok((Bytes::from(head), Bytes::from(tail)))
+}
+
+/// Return a multipart body containing the metadata `req` and `data`, its length, and its boundary.
+/// `data` is sent as is, without copying it.
 pub fn format_multipart<Req: Serialize + std::fmt::Debug>(
     req: &Req,
     data: Bytes,
-) -> anyhow::Result<Bytes> {
-    let meta = serde_json::to_string(req).context(format!("{:?}", req))?;
-    let mut buf = Vec::with_capacity(meta.len() + (1.5 * (data.len() as f64)) as usize);
-
-    // Write metadata.
-    buf.write(format!("--{}\n", MIME_BOUNDARY).as_bytes())
-        .unwrap();
-    buf.write("Content-Type: application/json; charset=UTF-8\n\n".as_bytes())
-        .unwrap();
-    buf.write(meta.as_bytes())?;
-
-    buf.write(format!("\n\n--{}\n", MIME_BOUNDARY).as_bytes())
-        .unwrap();
-    buf.write("Content-Transfer-Encoding: base64\n\n".as_bytes())
-        .unwrap();
-
-    // Write data contents.
-    let mut ew = radix64::io::EncodeWriter::new(STD, buf);
-    ew.write(data.as_ref())?;
-
-    let mut buf = ew.finish()?;
-    buf.write(format!("\n\n--{}--\n", MIME_BOUNDARY).as_bytes())
-        .unwrap();
-    Ok(Bytes::from(buf))
+) -> anyhow::Result<(hyper::Body, usize, String)> {
+    let mut boundary = random_boundary();
+    while contains_boundary(&data, &boundary) {
+        boundary = random_boundary();
+    }
+    let (head, tail) = format_multipart_frame(req, &boundary)?;
+    let len = head.len() + data.len() + tail.len();
+    let parts: Vec<std::io::Result<Bytes>> = vec![Ok(head), Ok(data), Ok(tail)];
+    Ok((hyper::Body::wrap_stream(stream::iter(parts)), len, boundary))
+}
+
+/// Return a multipart body containing the metadata `req` and the data read from `data`, and its
+/// boundary. The data is read in chunks of `UPLOAD_CHUNK_SIZE` while the body is sent, so that at
+/// most a few chunks are held in memory at any time.
+pub fn stream_multipart<Req: Serialize + std::fmt::Debug, R: tokio::io::AsyncRead + Send + 'static>(
+    req: &Req,
+    data: R,
+) -> anyhow::Result<(hyper::Body, String)> {
+    let boundary = random_boundary();
+    let (head, tail) = format_multipart_frame(req, &boundary)?;
+    let body = stream::once(async { Ok(head) })
+        .chain(read_chunks(data))
+        .chain(stream::once(async { Ok(tail) }));
+    Ok((hyper::Body::wrap_stream(body), boundary))
+}
+
+/// Return a stream of the chunks read from `r`, each of `UPLOAD_CHUNK_SIZE` bytes except the last
+/// one. The stream ends after the first error.
+fn read_chunks<R: tokio::io::AsyncRead + Send + 'static>(
+    r: R,
+) -> impl futures::Stream<Item = std::io::Result<Bytes>> + Send {
+    stream::unfold(Some(Box::pin(r)), |r| async move {
+        let mut r = r?;
+        let mut buf = vec![0; UPLOAD_CHUNK_SIZE];
+        let mut len = 0;
+        while len < buf.len() {
+            match r.read(&mut buf[len..]).await {
+                Ok(0) => break,
+                Ok(n) => len += n,
+                Err(e) => return Some((Err(e), None)),
+            }
+        }
+        if len == 0 {
+            return None;
+        }
+        buf.truncate(len);
+        Some((Ok(Bytes::from(buf)), Some(r)))
+    })
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_boundary() {
+        let data = Bytes::from(vec![b'-'; 1024]);
+        let (_, len, boundary) = format_multipart(&Some("meta"), data.clone()).unwrap();
+        let (_, _, other) = format_multipart(&Some("meta"), data).unwrap();
+        assert_ne!(boundary, other);
+        assert!(len > 1024 + 2 * boundary.len());
+        let framed = format!("abc--{}--", boundary);
+        assert!(contains_boundary(framed.as_bytes(), &boundary));
+        assert!(!contains_boundary(b"abc", &boundary));
+    }
 }
@@ -0,0 +1,98 @@
+//! Streams over the items of all pages returned by list methods.
+
+use crate::*;
+
+use std::collections::VecDeque;
+use std::future::Future;
+use std::pin::Pin;
+use std::task::{Context, Poll};
+
+/// A stream of the items of all pages of a list method, created by `page_stream()`.
+pub struct PageStream<F, Fut, Item> {
+    fetch: F,
+    prefetch: usize,
+    /// The pages fetched, but not yet consumed; the first one is the one currently consumed.
+    pages: VecDeque<std::vec::IntoIter<Item>>,
+    /// The page currently being fetched.
+    in_flight: Option<Pin<Box<Fut>>>,
+    next_page_token: Option<String>,
+    /// Set once the last page has been fetched, or fetching a page failed.
+    exhausted: bool,
+    /// Returned once the items of all pages fetched before have been consumed.
+    error: Option<Error>,
+}
+
+/// Return a stream of the items of all pages returned by `fetch`.
+///
+/// `fetch` is called with the token of the page to fetch (`None` for the first page), and returns
+/// the items of a page and the token of the next one, if there is one. While the items of a page
+/// are consumed, up to `prefetch` following pages are fetched; with a `prefetch` of 0, the next page
+/// is only fetched once the current one has been consumed.
+pub fn page_stream<F, Fut, Item>(prefetch: usize, fetch: F) -> PageStream<F, Fut, Item>
+where
+    F: FnMut(Option<String>) -> Fut,
+    Fut: Future<Output = Result<(Vec<Item>, Option<String>)>>,
+{
+    PageStream {
+        fetch: fetch,
+        prefetch: prefetch,
+        pages: VecDeque::new(),
+        in_flight: None,
+        next_page_token: None,
+        exhausted: false,
+        error: None,
+    }
+}
+
+// No field is pinned structurally: the future being polled is boxed.
+impl<F, Fut, Item> Unpin for PageStream<F, Fut, Item> {}
+
+impl<F, Fut, Item> futures::Stream for PageStream<F, Fut, Item>
+where
+    F: FnMut(Option<String>) -> Fut,
+    Fut: Future<Output = Result<(Vec<Item>, Option<String>)>>,
+{
+    type Item = Result<Item>;
+
+    fn poll_next(self: Pin<&mut Self>, cx: &mut Context<'_>) -> Poll<Option<Self::Item>> {
+        let this = self.get_mut();
+        loop {
+            if let Some(fut) = this.in_flight.as_mut() {
+                if let Poll::Ready(result) = fut.as_mut().poll(cx) {
+                    this.in_flight = None;
+                    match result {
+                        Ok((items, next_page_token)) => {
+                            this.pages.push_back(items.into_iter());
+                            this.exhausted = next_page_token.is_none();
+                            this.next_page_token = next_page_token;
+                        }
+                        Err(e) => {
+                            this.exhausted = true;
+                            this.error = Some(e);
+                        }
+                    }
+                }
+            }
+            if this.in_flight.is_none() && !this.exhausted && this.pages.len() <= this.prefetch {
+                this.in_flight = Some(Box::pin((this.fetch)(this.next_page_token.take())));
+                // Poll the new future right away, so that the request is sent.
+                continue;
+            }
+            if let Some(page) = this.pages.front_mut() {
+                if let Some(item) = page.next() {
+                    return Poll::Ready(Some(Ok(item)));
+                }
+                this.pages.pop_front();
+                continue;
+            }
+            if let Some(e) = this.error.take() {
+                return Poll::Ready(Some(Err(e)));
+            }
+            return if this.in_flight.is_some() {
+                Poll::Pending
+            } else {
+                Poll::Ready(None)
+            };
+        }
+    }
+}
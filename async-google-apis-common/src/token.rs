@@ -0,0 +1,148 @@
+use crate::*;
+
+use std::sync::{Arc, Mutex};
+
+/// Cached tokens are refreshed in the background once they expire within this many seconds.
+const REFRESH_AHEAD_SECS: i64 = 5 * 60;
+/// Cached tokens are not used anymore once they expire within this many seconds.
+const EXPIRY_MARGIN_SECS: i64 = 30;
+
+/// The scopes a token is requested for.
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Hash)]
+enum Scopes {
+    /// The default scopes of a method.
+    Default(&'static [&'static str]),
+    /// The scopes set by `TokenCache::set_scopes()`.
+    Custom,
+}
+
+struct CachedHeader {
+    header: hyper::header::HeaderValue,
+    /// Unix time after which the token is refreshed in the background.
+    refresh_at: i64,
+    /// Unix time after which the token is not used anymore.
+    expires_at: i64,
+    refreshing: bool,
+}
+
+struct State {
+    custom_scopes: Option<Vec<String>>,
+    headers: HashMap<Scopes, CachedHeader>,
+}
+
+struct Inner {
+    authenticator: Box<dyn 'static + DerefAuth>,
+    state: Mutex<State>,
+}
+
+/// Caches the `Authorization` header used by the methods of a generated service.
+///
+/// Obtaining a token from the authenticator on every call means locking its token storage and
+/// formatting a new header. Instead, the header is cached per set of scopes, and cloning it is
+/// cheap. Shortly before a token expires, it is refreshed in the background, so that calls
+/// usually don't have to wait for the authenticator. Clones share the same cache.
+#[derive(Clone)]
+pub struct TokenCache {
+    inner: Arc<Inner>,
+}
+
+fn unix_now() -> i64 {
+    std::time::SystemTime::now()
+        .duration_since(std::time::UNIX_EPOCH)
+        .map(|d| d.as_secs() as i64)
+        .unwrap_or(0)
+}
+
+impl TokenCache {
+    pub fn new<A: 'static + DerefAuth>(authenticator: A) -> TokenCache {
+        TokenCache {
+            inner: Arc::new(Inner {
+                authenticator: Box::new(authenticator),
+                state: Mutex::new(State {
+                    custom_scopes: None,
+                    headers: HashMap::new(),
+                }),
+            }),
+        }
+    }
+
+    /// Request tokens for `scopes` instead of the default scopes of each method.
+    pub fn set_scopes(&self, scopes: Vec<String>) {
+        let mut state = self.inner.state.lock().unwrap();
+        state.custom_scopes = Some(scopes);
+        state.headers.remove(&Scopes::Custom);
+    }
+
+    /// Return the `Authorization` header for a method with `default_scopes`, or for the scopes set
+    /// with `set_scopes()`.
+    pub async fn header(
+        &self,
+        default_scopes: &'static [&'static str],
+    ) -> Result<hyper::header::HeaderValue> {
+        let now = unix_now();
+        let scopes;
+        {
+            let mut state = self.inner.state.lock().unwrap();
+            scopes = if state.custom_scopes.is_some() {
+                Scopes::Custom
+            } else {
+                Scopes::Default(default_scopes)
+            };
+            if let Some(cached) = state.headers.get_mut(&scopes) {
+                if now < cached.expires_at {
+                    if now >= cached.refresh_at && !cached.refreshing {
+                        cached.refreshing = true;
+                        let cache = self.clone();
+                        tokio::spawn(async move {
+                            if let Err(e) = cache.refresh(scopes).await {
+                                warn!("TokenCache: refreshing token failed: {}", e);
+                            }
+                        });
+                    }
+                    return Ok(cached.header.clone());
+                }
+            }
+        }
+        self.refresh(scopes).await
+    }
+
+    /// Obtain a new token for `scopes` from the authenticator, and cache it.
+    async fn refresh(&self, scopes: Scopes) -> Result<hyper::header::HeaderValue> {
+        let token = match scopes {
+            Scopes::Default(s) => self.inner.authenticator.token(s).await,
+            Scopes::Custom => {
+                let custom = self.inner.state.lock().unwrap().custom_scopes.clone();
+                self.inner
+                    .authenticator
+                    .token(custom.as_deref().unwrap_or(&[]))
+                    .await
+            }
+        };
+        let token = match token {
+            Ok(token) => token,
+            Err(e) => {
+                if let Some(cached) = self.inner.state.lock().unwrap().headers.get_mut(&scopes) {
+                    cached.refreshing = false;
+                }
+                return Err(e.into());
+            }
+        };
+        let mut header =
+            hyper::header::HeaderValue::from_str(&format!("Bearer {}", token.as_str()))?;
+        header.set_sensitive(true);
+        let expires = token
+            .expiration_time()
+            .map(|t| t.unix_timestamp())
+            .unwrap_or(i64::MAX);
+        self.inner.state.lock().unwrap().headers.insert(
+            scopes,
+            CachedHeader {
+                header: header.clone(),
+                refresh_at: expires.saturating_sub(REFRESH_AHEAD_SECS),
+                expires_at: expires.saturating_sub(EXPIRY_MARGIN_SECS),
+                refreshing: false,
+            },
+        );
+        Ok(header)
+    }
+}
@@ -0,0 +1,34 @@
+//! Helpers for building request URLs without intermediate allocations.
+
+use crate::*;
+
+use std::fmt::Write;
+
+/// Percent-encodes everything written to it into the wrapped writer.
+struct PercentEncoder<'a, W: ?Sized>(&'a mut W);
+
+impl<'a, W: Write + ?Sized> Write for PercentEncoder<'a, W> {
+    fn write_str(&mut self, s: &str) -> std::fmt::Result {
+        for chunk in percent_encode(s.as_bytes(), NON_ALPHANUMERIC) {
+            self.0.write_str(chunk)?;
+        }
+        Ok(())
+    }
+}
+
+/// Write `v` to `w`, percent-encoding it on the fly (instead of formatting it into a `String` and
+/// encoding that).
+pub fn write_encoded<W: Write + ?Sized, T: std::fmt::Display + ?Sized>(
+    w: &mut W,
+    v: &T,
+) -> std::fmt::Result {
+    write!(PercentEncoder(w), "{}", v)
+}
+
+/// Write `v` to `w` using its `Display` implementation, e.g. a parameters struct as query string.
+pub fn write_display<W: Write + ?Sized, T: std::fmt::Display + ?Sized>(
+    w: &mut W,
+    v: &T,
+) -> std::fmt::Result {
+    write!(w, "{}", v)
+}
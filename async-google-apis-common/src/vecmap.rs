@@ -0,0 +1,76 @@
+//! A map stored as vector, for small maps in generated types (see the generator's `--map-repr`).
+
+use crate::*;
+
+/// A map represented as vector of entries in the order they were received, serialized as JSON
+/// object. For the handful of entries typical for maps in API types, this is smaller and faster to
+/// build than a `HashMap`. Lookups are linear.
+#[derive(Debug, Clone, PartialEq)]
+pub struct VecMap<K, V>(pub Vec<(K, V)>);
+
+impl<K, V> Default for VecMap<K, V> {
+    fn default() -> Self {
+        VecMap(vec![])
+    }
+}
+
+impl<K, V> VecMap<K, V> {
+    /// Return the value of the first entry with `key`.
+    pub fn get<Q: ?Sized + PartialEq>(&self, key: &Q) -> Option<&V>
+    where
+        K: std::borrow::Borrow<Q>,
+    {
+        self.0.iter().find(|(k, _)| k.borrow() == key).map(|(_, v)| v)
+    }
+}
+
+impl<K, V> std::ops::Deref for VecMap<K, V> {
+    type Target = Vec<(K, V)>;
+    fn deref(&self) -> &Self::Target {
+        &self.0
+    }
+}
+
+impl<K, V> std::ops::DerefMut for VecMap<K, V> {
+    fn deref_mut(&mut self) -> &mut Self::Target {
+        &mut self.0
+    }
+}
+
+impl<K: Serialize, V: Serialize> Serialize for VecMap<K, V> {
+    fn serialize<S: serde::Serializer>(&self, serializer: S) -> std::result::Result<S::Ok, S::Error> {
+        use serde::ser::SerializeMap;
+        let mut map = serializer.serialize_map(Some(self.0.len()))?;
+        for (k, v) in self.0.iter() {
+            map.serialize_entry(k, v)?;
+        }
+        map.end()
+    }
+}
+
+struct VecMapVisitor<K, V>(std::marker::PhantomData<(K, V)>);
+
+impl<'de, K: Deserialize<'de>, V: Deserialize<'de>> serde::de::Visitor<'de> for VecMapVisitor<K, V> {
+    type Value = VecMap<K, V>;
+
+    fn expecting(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        f.write_str("a map")
+    }
+
+    fn visit_map<A: serde::de::MapAccess<'de>>(
+        self,
+        mut access: A,
+    ) -> std::result::Result<Self::Value, A::Error> {
+        let mut entries = Vec::with_capacity(access.size_hint().unwrap_or(0));
+        while let Some(entry) = access.next_entry()? {
+            entries.push(entry);
+        }
+        Ok(VecMap(entries))
+    }
+}
+
+impl<'de, K: Deserialize<'de>, V: Deserialize<'de>> Deserialize<'de> for VecMap<K, V> {
+    fn deserialize<D: serde::Deserializer<'de>>(deserializer: D) -> std::result::Result<Self, D::Error> {
+        deserializer.deserialize_map(VecMapVisitor(std::marker::PhantomData))
+    }
+}
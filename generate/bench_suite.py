@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#
+# (c) 2020, 2021 Lewin Bormann <lbo@spheniscida.de>
+#
+# Benchmark suite for the generator.
+#
+# The generator is run on pinned discovery documents (benchmarks/fixtures), without fetching
+# anything or running rustfmt. The time spent in each phase of the generator and the peak memory
+# usage are measured per document and compared against a stored baseline
+# (benchmarks/baseline.json); the suite fails if an API got slower or needs more memory than the
+# baseline allows. So that a baseline can be used on other machines, times are compared relative to
+# a calibration workload (see calibrate()) run along with the benchmarks.
+#
+# The checked-in fixtures are synthetic documents exercising every feature of the generator:
+# test_v1 (small) and big_v1 (test_v1 with its schemas and resources repeated 60 times). Use --pin to
+# add the current documents of real APIs, and --save_baseline to record a baseline for them.
+
+import argparse
+import contextlib
+import glob
+import gzip
+import io
+import json
+import os
+from os import path
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import generate
+import phases
+
+# The APIs used by the example crates, and compute as a very large one.
+FIXTURE_APIS = "drive:v3,storage:v1,youtube:v3,calendar:v3,compute:v1"
+BENCH_DIR = path.join(path.dirname(path.abspath(__file__)), "benchmarks")
+FIXTURES_DIR = path.join(BENCH_DIR, "fixtures")
+BASELINE_PATH = path.join(BENCH_DIR, "baseline.json")
+
+# Phases of generate.PROFILED_PHASES (fetch isn't run here), and loading the fixture, in the order they are reported.
+REPORTED_PHASES = ["load", "schemas", "params", "services", "render", "write", "other"]
+
+
+def fixture_name(path_):
+    return path.basename(path_).split(".")[0]
+
+
+def pin_fixtures(discovery_base, apis, directory):
+    """Fetch the current discovery documents of `apis` and store them as fixtures in `directory`."""
+    os.makedirs(directory, exist_ok=True)
+    for doc in generate.fetch_discovery_base(discovery_base, apis):
+        try:
+            discdoc = generate.fetch_discovery_doc(doc["discoveryRestUrl"], max_age=0)
+        except Exception as e:
+            print("Error while fetching document for", doc["id"], ":", repr(e))
+            continue
+        if "error" in discdoc:
+            print("Error while fetching document for", doc["id"], ":", discdoc["error"])
+            continue
+        with gzip.open(path.join(directory, doc["id"].replace(":", "_") + ".json.gz"), "wt") as f:
+            json.dump(discdoc, f, sort_keys=True)
+        print("Pinned", doc["id"], "revision", discdoc.get("revision", "?"))
+    generate.save_cache()
+
+
+def load_fixture(path_):
+    with (gzip.open(path_, "rt") if path_.endswith(".gz") else open(path_, "r")) as f:
+        return json.load(f)
+
+
+def run_generator(discdoc):
+    """Run generate_all() on `discdoc` in a temporary directory, discarding its output."""
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+            os.chdir(tmp)
+            os.makedirs("gen")
+            generate.generate_all(discdoc)
+    finally:
+        os.chdir(cwd)
+
+
+def bench_fixture(path_, rounds):
+    """Benchmark the generator on the fixture at `path_`, taking the fastest of `rounds` runs.
+
+    Returns:
+        dict with elements total (seconds), phases (dict mapping phases to seconds), and peak_mb
+        (peak memory usage in MiB).
+    """
+    best = None
+    for _ in range(rounds):
+        timer = phases.PhaseTimer()
+        before = time.perf_counter()
+        with timer.instrument(generate, generate.PROFILED_PHASES):
+            with timer.phase("load"):
+                discdoc = load_fixture(path_)
+            with timer.phase("other"):
+                run_generator(discdoc)
+        total = time.perf_counter() - before
+        if best is None or total < best["total"]:
+            best = {"total": total, "phases": {phase: r["time"] for (phase, r) in timer.report().items()}}
+    # Memory is measured in a separate run, as tracing allocations slows down everything.
+    tracemalloc.start()
+    try:
+        run_generator(load_fixture(path_))
+        best["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+    return best
+
+
+def calibrate(rounds):
+    """Return the time taken by a fixed workload (the best of `rounds` runs), which doesn't depend on
+    the generator. It consists of what the generator mostly does: handling JSON, dicts, and
+    strings."""
+    doc = {"items": [{"id": "item{}".format(i), "size": i * 37, "tags": ["a", "b", "c"]} for i in range(2000)]}
+    best = None
+    for _ in range(rounds):
+        before = time.perf_counter()
+        for _ in range(10):
+            items = json.loads(json.dumps(doc))["items"]
+            "\n".join("{}: {}".format(k, v) for it in sorted(items, key=lambda it: it["id"]) for (k, v) in it.items())
+        elapsed = time.perf_counter() - before
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def find_regressions(results, baseline, tolerance):
+    """Return messages for all APIs whose relative time (see calibrate()) or peak memory exceeds the
+    baseline by more than `tolerance` (a fraction)."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in ("relative", "peak_mb"):
+            if metric not in baseline[name]:
+                continue
+            if result[metric] > baseline[name][metric] * (1 + tolerance):
+                regressions.append("{}: {} is {:.3f}, baseline {:.3f} (+{:.0f}%)".format(
+                    name, metric, result[metric], baseline[name][metric],
+                    100 * (result[metric] / baseline[name][metric] - 1)))
+    return regressions
+
+
+def print_results(results, baseline):
+    print()
+    print("{:<16}".format("API") + "".join("{:>10}".format(p) for p in REPORTED_PHASES) +
+          "{:>10} {:>10} {:>10}".format("total [s]", "peak [MB]", "baseline"))
+    for name, result in sorted(results.items()):
+        vs = "-"
+        if "relative" in baseline.get(name, {}):
+            vs = "{:+.0f}%".format(100 * (result["relative"] / baseline[name]["relative"] - 1))
+        print("{:<16}".format(name) + "".join("{:>10.3f}".format(result["phases"].get(p, 0))
+                                              for p in REPORTED_PHASES) +
+              "{:>10.3f} {:>10.1f} {:>10}".format(result["total"], result["peak_mb"], vs))
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the generator on pinned discovery documents.")
+    p.add_argument("--fixtures", default=FIXTURES_DIR, help="Directory with discovery documents (*.json[.gz])")
+    p.add_argument("--pin", default=False, help="Fetch and store the fixtures for --apis, then exit", action="store_true")
+    p.add_argument("--apis", default=FIXTURE_APIS, help="APIs to pin (comma-separated)")
+    p.add_argument("--discovery_base",
+                   default="https://www.googleapis.com/discovery/v1/apis",
+                   help="Base Discovery document.")
+    p.add_argument("--rounds", default=3, type=int, help="Take the best of this many rounds")
+    p.add_argument("--baseline", default=BASELINE_PATH, help="Baseline to compare against")
+    p.add_argument("--save_baseline", default=False, help="Store the results as new baseline", action="store_true")
+    p.add_argument("--tolerance",
+                   default=0.25,
+                   type=float,
+                   help="Allowed slowdown (relative to the calibration workload) or memory increase over the baseline")
+    p.add_argument("--json", default="", help="Also write the results to this file")
+
+    args = p.parse_args()
+
+    if args.pin:
+        pin_fixtures(args.discovery_base, args.apis.split(","), args.fixtures)
+        return
+
+    fixtures = sorted(glob.glob(path.join(args.fixtures, "*.json")) + glob.glob(path.join(args.fixtures, "*.json.gz")))
+    if not fixtures:
+        print("No fixtures in", args.fixtures, "- run with --pin first.")
+        sys.exit(2)
+    try:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    calibration = calibrate(args.rounds)
+    print("Calibration: {:.3f} s".format(calibration))
+    results = {}
+    for fixture in fixtures:
+        print("Benchmarking", fixture_name(fixture))
+        result = bench_fixture(fixture, args.rounds)
+        result.update(calibration=calibration, relative=result["total"] / calibration)
+        results[fixture_name(fixture)] = result
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved baseline to", args.baseline)
+        return
+
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for r in regressions:
+        print("REGRESSION:", r)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
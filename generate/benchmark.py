@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# (c) 2020, 2021 Lewin Bormann <lbo@spheniscida.de>
+#
+# Benchmark for the render phase of the generator.
+#
+# The generator is run once per API to record every (template, data) pair it renders. The
+# recorded calls are then replayed through chevron.render() and through the compiled templates
+# of mustache.py, and the outputs are compared byte by byte.
+
+import argparse
+import copy
+import os
+import tempfile
+import time
+
+import chevron
+
+import generate
+import mustache
+
+
+def record_render_calls(discdoc):
+    """Run generate_all() on `discdoc` and return a list of all (template, data) pairs rendered."""
+    calls = []
+
+    def recorder(template, data):
+        calls.append((template, copy.deepcopy(data)))
+        return mustache.render(template, data)
+
+    orig_render = generate.render
+    generate.render = recorder
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            os.makedirs("gen")
+            generate.generate_all(discdoc)
+    finally:
+        os.chdir(cwd)
+        generate.render = orig_render
+    return calls
+
+
+def time_renderer(renderer, calls, rounds):
+    best = None
+    for _ in range(rounds):
+        before = time.perf_counter()
+        out = [renderer(t, d) for (t, d) in calls]
+        elapsed = time.perf_counter() - before
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark chevron against compiled templates.")
+    p.add_argument("--discovery_base",
+                   default="https://www.googleapis.com/discovery/v1/apis",
+                   help="Base Discovery document.")
+    p.add_argument("--apis", default="drive:v3,storage:v1,youtube:v3", help="APIs to benchmark (comma-separated)")
+    p.add_argument("--doc", default="", help="Benchmark these Discovery documents instead (comma-separated)")
+    p.add_argument("--rounds", default=3, type=int, help="Take the best of this many rounds")
+
+    args = p.parse_args()
+
+    if args.doc:
+        discdocs = [generate.fetch_discovery_doc(d) for d in args.doc.split(",")]
+    else:
+        discdocs = [
+            generate.fetch_discovery_doc(d["discoveryRestUrl"])
+            for d in generate.fetch_discovery_base(args.discovery_base, args.apis.split(","))
+        ]
+
+    results = []
+    for discdoc in discdocs:
+        calls = record_render_calls(discdoc)
+        t_chevron, out_chevron = time_renderer(chevron.render, calls, args.rounds)
+        t_compiled, out_compiled = time_renderer(mustache.render, calls, args.rounds)
+        results.append((discdoc["id"], len(calls), t_chevron, t_compiled, out_chevron == out_compiled))
+
+    print()
+    print("{:<24} {:>8} {:>12} {:>12} {:>8} {:>10}".format("API", "renders", "chevron [s]", "compiled [s]",
+                                                          "speedup", "identical"))
+    for (api, n, t_chevron, t_compiled, identical) in results:
+        print("{:<24} {:>8} {:>12.3f} {:>12.3f} {:>7.1f}x {:>10}".format(api, n, t_chevron, t_compiled,
+                                                                          t_chevron / t_compiled, str(identical)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#
+# (c) 2020, 2021 Lewin Bormann <lbo@spheniscida.de>
+#
+# Cache for discovery documents.
+#
+# Documents are stored as zlib-compressed pickles, which load considerably faster than JSON, in
+# files named after a hash of their URL. A small JSON index holds the metadata of every entry
+# (HTTP validators, time of the last fetch and of the last use) as well as the lists of APIs from
+# global discovery documents, so that listing or looking up APIs doesn't need to load any
+# document at all.
+
+import hashlib
+import json
+import os
+from os import path
+import pickle
+import threading
+import time
+import zlib
+
+# Bump this if the format of data files changes; existing entries are discarded then.
+FORMAT_VERSION = 2
+
+
+class Cache:
+    """A cache of JSON documents, keyed by URL. Methods are thread-safe.
+
+    The index is only written by save(), so that a cache can be used read-only from several
+    processes at once.
+    """
+    def __init__(self, directory="cache"):
+        self.directory = directory
+        self.index_path = path.join(directory, "index.json")
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        except Exception:
+            self.index = {}
+        if self.index.get("version") != FORMAT_VERSION:
+            self.index = {"version": FORMAT_VERSION, "entries": {}, "apis": {}}
+
+    def _data_path(self, key):
+        return path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()[:32] + ".pickle.z")
+
+    def get(self, key):
+        """Return the cached document for `key`, or None."""
+        with self.lock:
+            entry = self.index["entries"].get(key)
+            if entry is None:
+                return None
+            entry["last_used"] = time.time()
+        try:
+            with open(self._data_path(key), "rb") as f:
+                return pickle.loads(zlib.decompress(f.read()))
+        except Exception as e:
+            print("Reading", key, "from cache failed:", e)
+            return None
+
+    def meta(self, key):
+        """Return the metadata of the entry for `key`: a dict with etag, last_modified (HTTP
+        validators), fetched and last_used (timestamps). Empty if `key` is not cached."""
+        with self.lock:
+            return dict(self.index["entries"].get(key, {}))
+
+    def put(self, key, doc, etag=None, last_modified=None):
+        os.makedirs(self.directory, exist_ok=True)
+        data_path = self._data_path(key)
+        with open(data_path + ".new", "wb") as f:
+            f.write(zlib.compress(pickle.dumps(doc, pickle.HIGHEST_PROTOCOL), 1))
+        os.replace(data_path + ".new", data_path)
+        now = time.time()
+        with self.lock:
+            self.index["entries"][key] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "fetched": now,
+                "last_used": now
+            }
+
+    def touch(self, key):
+        """Mark the entry for `key` as fresh, e.g. after it has been revalidated."""
+        with self.lock:
+            if key in self.index["entries"]:
+                self.index["entries"][key]["fetched"] = time.time()
+
+    def is_stale(self, key, max_age):
+        """Whether the entry for `key` was fetched more than `max_age` seconds ago."""
+        return time.time() - self.meta(key).get("fetched", 0) > max_age
+
+    def apis(self, key):
+        """Return the list of APIs stored by set_apis() for `key`, or None."""
+        with self.lock:
+            return self.index["apis"].get(key)
+
+    def set_apis(self, key, items):
+        """Store the `items` of the global discovery document `key` in the index."""
+        with self.lock:
+            self.index["apis"][key] = [{
+                "id": it["id"],
+                "title": it.get("title", ""),
+                "discoveryRestUrl": it["discoveryRestUrl"]
+            } for it in items]
+
+    def evict(self, max_unused):
+        """Remove all entries that haven't been used in `max_unused` seconds.
+
+        Returns the number of removed entries.
+        """
+        now = time.time()
+        with self.lock:
+            unused = [k for (k, e) in self.index["entries"].items() if now - e.get("last_used", 0) > max_unused]
+            for key in unused:
+                del self.index["entries"][key]
+                self.index["apis"].pop(key, None)
+                try:
+                    os.remove(self._data_path(key))
+                except FileNotFoundError:
+                    pass
+        return len(unused)
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            with open(self.index_path + ".new", "w") as f:
+                json.dump(self.index, f)
+            os.replace(self.index_path + ".new", self.index_path)
@@ -12,21 +12,76 @@
 
 
 import argparse
-import chevron
+import concurrent.futures
+import contextlib
+import cProfile
+import fnmatch
+import functools
+import hashlib
+import io
 import json
 import re
 import requests
+import shutil
 
 import os
 from os import path
 import subprocess
+import sys
+import time
+import tracemalloc
 
+import cache
+from mustache import render
+import phases
 from templates import *
 
 
 def optionalize(name, optional=True):
     return "Option<{}>".format(name) if optional else name
 
+
+# Rust types of string fields, by --string-repr.
+STRING_REPRS = {"string": "String", "box": "Box<str>", "arc": "std::sync::Arc<str>"}
+# Rust types of maps (objects with additionalProperties), by --map-repr.
+MAP_REPRS = {"hashmap": "HashMap<{},{}>", "btreemap": "std::collections::BTreeMap<{},{}>", "vec": "VecMap<{},{}>"}
+# "box": optional struct fields larger than this many bytes are boxed (0: never; see box_large_fields()).
+# Boxing changes the types of fields, and is therefore off unless enabled.
+DEFAULT_REPRS = {"string": "string", "map": "hashmap", "box": 0}
+
+
+def parse_box_thresholds(value):
+    """Parse the --box-threshold argument: a threshold for all APIs (e.g. `128`) and/or thresholds
+    for single APIs (e.g. `drive:v3=128,storage:v1=256`).
+
+    Returns a dict mapping API IDs ("" for all APIs) to thresholds.
+    """
+    thresholds = {}
+    for item in value.split(","):
+        if item:
+            api, _, threshold = item.rpartition("=")
+            thresholds[api] = int(threshold)
+    return thresholds
+
+
+def api_reprs(reprs, api_id):
+    """Return the representations `reprs` for the API `api_id`, with its box threshold selected
+    from per-API thresholds (see parse_box_thresholds())."""
+    reprs = dict(reprs or DEFAULT_REPRS)
+    if isinstance(reprs["box"], dict):
+        reprs["box"] = reprs["box"].get(api_id, reprs["box"].get("", 0))
+    return reprs
+
+
+def string_type(reprs=None):
+    """Return the Rust type of strings for the representations `reprs` (see DEFAULT_REPRS)."""
+    return STRING_REPRS[(reprs or DEFAULT_REPRS)["string"]]
+
+
+def map_type(value, reprs=None):
+    """Return the Rust type of maps with string keys and `value`s for the representations `reprs`."""
+    return MAP_REPRS[(reprs or DEFAULT_REPRS)["map"]].format(string_type(reprs), value)
+
 # Rust keywords
 keywords = {"as", "break", "const", "continue", "crate", "else", "enum", "extern", "false",
             "fn", "for", "if", "impl", "in", "let", "loop", "match", "mod", "move", "mut",
@@ -75,7 +130,228 @@ def global_params_name(api_name):
     return snake_to_camel(api_name + "Params")
 
 
-def parse_schema_types(name, schema, optional=True, parents=[]):
+def schema_refs(schema, by_value=True):
+    """Yield tuples ($ref, by_value) for all references in a schema, in the same places as
+    parse_schema_types() would translate them.
+
+    `by_value` is False for references below an array or a map, as those are stored on the heap.
+    """
+    if "$ref" in schema:
+        yield schema["$ref"], by_value
+    elif schema.get("type") == "object":
+        if "properties" in schema:
+            for prop in schema["properties"].values():
+                yield from schema_refs(prop, by_value)
+        elif "additionalProperties" in schema:
+            yield from schema_refs(schema["additionalProperties"], False)
+    elif schema.get("type") == "array":
+        yield from schema_refs(schema["items"], False)
+
+
+def strongly_connected_components(graph):
+    """Find the strongly connected components of `graph` using Tarjan's algorithm.
+
+    Arguments:
+        graph: dict mapping each node to an iterable of its successors.
+
+    Returns:
+        dict mapping each node to the index of its component.
+    """
+    index = {}
+    lowlink = {}
+    component = {}
+    stack = []
+    on_stack = set()
+    for root in graph:
+        if root in index:
+            continue
+        # Iterative DFS; each work item is a node and an iterator over its remaining successors.
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(graph[succ])))
+                    break
+                if succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component[member] = index[node]
+                        if member == node:
+                            break
+    return component
+
+
+def recursive_refs(schemas):
+    """Determine which references between schemas need to be boxed.
+
+    A struct can't contain itself by value, directly or through other structs. References stored
+    by value (i.e., not in a Vec or HashMap) that point into the same strongly connected component
+    of the schema reference graph close such a cycle, and are therefore translated to `Box<...>`.
+
+    Returns:
+        dict mapping each schema name to the set of references that need to be boxed where
+        they occur by value within that schema.
+    """
+    graph = {
+        name: sorted({ref for (ref, by_value) in schema_refs(schema) if by_value and ref in schemas})
+        for (name, schema) in schemas.items()
+    }
+    component = strongly_connected_components(graph)
+    return {
+        name: frozenset(ref for ref in refs if component[ref] == component[name])
+        for (name, refs) in graph.items()
+    }
+
+
+def resource_methods(resource):
+    """Yield all methods of `resource` and its subresources."""
+    yield from resource.get("methods", {}).values()
+    for subresource in resource.get("resources", {}).values():
+        yield from resource_methods(subresource)
+
+
+def reachable_schemas(schemas, methods):
+    """Return the names of all schemas used by `methods`, directly or through other schemas."""
+    refs = [method[k]["$ref"] for method in methods for k in ("request", "response") if "$ref" in method.get(k, {})]
+    return referenced_schemas(schemas, refs)
+
+
+def referenced_schemas(schemas, names):
+    """Return `names` and the names of all schemas they use, directly or through other schemas."""
+    todo = list(names)
+    reachable = set()
+    while todo:
+        name = todo.pop()
+        if name in reachable or name not in schemas:
+            continue
+        reachable.add(name)
+        todo.extend(ref for (ref, _) in schema_refs(schemas[name]))
+    return reachable
+
+
+def select_methods(resource, patterns, prefix=""):
+    """Return a copy of `resource` with only the methods (and subresources with methods) whose path
+    (e.g. `files.revisions.list`) matches any of the fnmatch-style `patterns`.
+    """
+    selected = {k: v for (k, v) in resource.items() if k not in ("methods", "resources")}
+    methods = {
+        name: method
+        for (name, method) in resource.get("methods", {}).items()
+        if any(fnmatch.fnmatchcase(prefix + name, pat) for pat in patterns)
+    }
+    if methods:
+        selected["methods"] = methods
+    resources = {}
+    for name, subresource in resource.get("resources", {}).items():
+        subresource = select_methods(subresource, patterns, prefix=prefix + name + ".")
+        if "methods" in subresource or "resources" in subresource:
+            resources[name] = subresource
+    if resources:
+        selected["resources"] = resources
+    return selected
+
+
+def prune_discdoc(discdoc, patterns):
+    """Return a copy of `discdoc` with only the methods matching `patterns` (see select_methods()),
+    and only the schemas these methods use.
+    """
+    pruned = select_methods(discdoc, patterns)
+    schemas = discdoc.get("schemas", {})
+    methods = list(resource_methods(pruned))
+    reachable = reachable_schemas(schemas, methods)
+    pruned["schemas"] = {name: schema for (name, schema) in schemas.items() if name in reachable}
+    print("Selected {} of {} methods and {} of {} schemas".format(len(methods), len(list(resource_methods(discdoc))),
+                                                                  len(reachable), len(schemas)))
+    return pruned
+
+
+def feature_name(resource):
+    """Name of the Cargo feature enabling `resource` (see --features)."""
+    return rust_identifier(resource)
+
+
+def schema_features(discdoc):
+    """Determine which features (i.e., resources) need each schema.
+
+    Returns:
+        dict mapping each schema name to a frozenset of features. The set is empty for schemas that
+        are always needed (because the top-level methods use them) or not used by any method, and
+        for all schemas used by those.
+    """
+    schemas = discdoc.get("schemas", {})
+    features = {name: set() for name in schemas}
+    for resource, methods in discdoc.get("resources", {}).items():
+        for name in reachable_schemas(schemas, resource_methods(methods)):
+            features[name].add(feature_name(resource))
+    for name in reachable_schemas(schemas, discdoc.get("methods", {}).values()):
+        features[name] = set()
+    for name in referenced_schemas(schemas, [name for (name, f) in features.items() if not f]):
+        features[name] = set()
+    return {name: frozenset(f) for (name, f) in features.items()}
+
+
+def cfg_features(features):
+    """Return the condition of a #[cfg] attribute enabling code if any of `features` is enabled."""
+    conds = ['feature = "{}"'.format(f) for f in sorted(features)]
+    return conds[0] if len(conds) == 1 else "any({})".format(", ".join(conds))
+
+
+@contextlib.contextmanager
+def type_gate(types, features):
+    """Mark the types generated within the context as compiled only if any of `features` is enabled
+    (see dedup_type())."""
+    if types is None or not features:
+        yield
+        return
+    types["gate"] = features
+    try:
+        yield
+    finally:
+        types["gate"] = frozenset()
+
+
+@contextlib.contextmanager
+def cfg_module(f, name, features, types=None):
+    """Wrap everything written to `f` within the context into a module `name`, which is only
+    compiled (and re-exported) if any of `features` is enabled. Nothing is wrapped if `features` is
+    empty.
+
+    Types are only deduplicated within the same module (see dedup_type()).
+    """
+    if not features:
+        yield
+        return
+    cfg = {"name": name, "cfg": cfg_features(features)}
+    f.write(render(CfgModuleBeginTmpl, cfg))
+    try:
+        with type_gate(types, features):
+            yield
+    finally:
+        f.write(render(CfgModuleEndTmpl, cfg))
+
+
+def parse_schema_types(name,
+                       schema,
+                       optional=True,
+                       boxed_refs=frozenset(),
+                       nested=False,
+                       types=None,
+                       reprs=None):
     """Translate a JSON schema type into Rust types, recursively.
 
     This function takes a schema entry from the `schemas` section of a Discovery document,
@@ -84,6 +360,12 @@ def parse_schema_types(name, schema, optional=True, parents=[]):
     Arguments:
         name: Name of the property. If the property is an object with fixed fields, generate a struct with this name.
         schema: A JSON object from a discovery document representing a type.
+        boxed_refs: References that need to be boxed if they occur by value (see recursive_refs()).
+        nested: Whether this schema is nested within another one.
+        types: A type cache (see new_type_cache()). If given, enums and nested structs identical
+            to a previously generated one are not generated again; the existing type is used
+            instead, and an alias is returned in place of the new type.
+        reprs: The Rust types used for strings and maps (see DEFAULT_REPRS).
 
     Returns:
         (tuple, [dict], enums)
@@ -101,7 +383,7 @@ def parse_schema_types(name, schema, optional=True, parents=[]):
     try:
         if "$ref" in schema:
             # We just assume that there is already a type generated for the reference.
-            if schema["$ref"] not in parents:
+            if schema["$ref"] not in boxed_refs:
                 return optionalize(schema["$ref"], optional), structs, enums
             return optionalize("Box<" + schema["$ref"] + ">", optional), structs, enums
         if "type" in schema and schema["type"] == "object":
@@ -117,7 +399,10 @@ def parse_schema_types(name, schema, optional=True, parents=[]):
                     subtyp, substructs, subenums = parse_schema_types(name + capitalize_first(pn),
                                                                       pp,
                                                                       optional=True,
-                                                                      parents=parents + [name])
+                                                                      boxed_refs=boxed_refs,
+                                                                      nested=True,
+                                                                      types=types,
+                                                                      reprs=reprs)
                     if type(subtyp) is tuple:
                         subtyp, comment = subtyp
                     else:
@@ -141,6 +426,10 @@ def parse_schema_types(name, schema, optional=True, parents=[]):
                     })
                     structs.extend(substructs)
                     enums.extend(subenums)
+                if nested:
+                    # Only nested structs can be replaced; top-level schemas are referenced by name.
+                    struct = dedup_type(types, struct_key(struct), struct)
+                    typ = struct.get("alias", typ)
                 structs.append(struct)
                 return (optionalize(typ, optional), schema.get("description", "")), structs, enums
 
@@ -148,20 +437,23 @@ def parse_schema_types(name, schema, optional=True, parents=[]):
                 field, substructs, subenums = parse_schema_types(name,
                                                                  schema["additionalProperties"],
                                                                  optional=False,
-                                                                 parents=parents + [name])
+                                                                 nested=True,
+                                                                 types=types,
+                                                                 reprs=reprs)
                 structs.extend(substructs)
                 if type(field) is tuple:
                     typ = field[0]
                 else:
                     typ = field
-                return (optionalize("HashMap<String," + typ + ">", optional), schema.get("description",
-                                                                                         "")), structs, subenums
+                return (optionalize(map_type(typ, reprs), optional), schema.get("description", "")), structs, subenums
 
         if schema["type"] == "array":
             typ, substructs, subenums = parse_schema_types(name,
                                                            schema["items"],
                                                            optional=False,
-                                                           parents=parents + [name])
+                                                           nested=True,
+                                                           types=types,
+                                                           reprs=reprs)
             if type(typ) is tuple:
                 typ = typ[0]
             return (optionalize("Vec<" + typ + ">", optional), schema.get("description",
@@ -170,7 +462,7 @@ def parse_schema_types(name, schema, optional=True, parents=[]):
         if schema["type"] == "string":
 
             # Builds a line of a rust type
-            def build(intt, typ="String"):
+            def build(intt, typ=string_type(reprs)):
                 return (optionalize(typ, optional), intt + ": " + schema.get("description", "")), structs, enums
 
             if "format" in schema:
@@ -203,10 +495,11 @@ def parse_schema_types(name, schema, optional=True, parents=[]):
                     "jsonvalue": ev,
                     "desc": schema.get("enumDescriptions", [""] * (i))[i]
                 } for (i, ev) in enumerate(sorted(schema.get("enum", [])))]
-                templ_params = {"name": name_, "values": values}
+                templ_params = dedup_type(types, enum_key(values), {"name": name_, "values": values})
+                name_ = templ_params.get("alias", name_)
                 return (optionalize(name_, optional), schema.get("description", "")), structs, [templ_params]
 
-            return (optionalize("String", optional), schema.get("description", "")), structs, enums
+            return (optionalize(string_type(reprs), optional), schema.get("description", "")), structs, enums
 
         if schema["type"] == "boolean":
             return (optionalize("bool", optional), schema.get("description", "")), structs, enums
@@ -230,7 +523,8 @@ def parse_schema_types(name, schema, optional=True, parents=[]):
                 return build("u64")
 
         if schema["type"] == "any":
-            return (optionalize("String", optional), "ANY data: " + schema.get("description", "")), structs, enums
+            return (optionalize(string_type(reprs), optional), "ANY data: " + schema.get("description",
+                                                                                         "")), structs, enums
 
         raise Exception("unimplemented schema type!", name)
     except KeyError as e:
@@ -238,8 +532,42 @@ def parse_schema_types(name, schema, optional=True, parents=[]):
         raise e
 
 
-def generate_params_structs(resources, super_name="", global_params=None):
-    """Generate parameter structs and enums from the resources list.
+def new_type_cache():
+    """Return a new type cache for deduplicating types within one API.
+
+    `types` maps the feature gate and structural key of a generated enum or struct to its name;
+    `deduplicated` counts the types that were replaced by an existing one. `gate` is the set of
+    features of the types currently being generated (see cfg_module()).
+    """
+    return {"types": {}, "deduplicated": 0, "gate": frozenset()}
+
+
+def enum_key(values):
+    return ("enum", tuple((v["jsonvalue"], v["desc"]) for v in values))
+
+
+def struct_key(struct):
+    return ("struct", struct["description"],
+            tuple((f["name"], f["original_name"], f["typ"], f["attr"], f["comment"]) for f in struct["fields"]))
+
+
+def dedup_type(types, key, typ):
+    """Return `typ` (an enum or struct dict) if no identical type has been generated before.
+
+    Otherwise, return an alias dict {name, alias} referring to the previously generated type. Only
+    types that are compiled whenever `typ` is (those with the same or no feature gate) are reused.
+    """
+    if types is None:
+        return typ
+    existing = types["types"].get((frozenset(), key)) or types["types"].setdefault((types["gate"], key), typ["name"])
+    if existing == typ["name"]:
+        return typ
+    types["deduplicated"] += 1
+    return {"name": typ["name"], "alias": existing}
+
+
+def generate_params_structs(f, resources, super_name="", global_params=None, types=None, reprs=None):
+    """Generate parameter structs and enums from the resources list, and write them to `f`.
 
     Every resource usually has a set of parameters, which are translated into a
     Rust struct by this function. Any enum types are extracted and represented
@@ -247,15 +575,9 @@ def generate_params_structs(resources, super_name="", global_params=None):
 
     Parameter types also come with a `Display` implementation.
 
-    Returns a tuple of (struct template dicts, enum template dicts).
-
-    The struct template dicts are to be rendered using the SchemaStructTmpl,
-    the enum template dicts need to be rendered with the SchemaEnumTmpl
-    template.
+    The struct dicts are rendered using the SchemaStructTmpl and SchemaDisplayTmpl
+    templates, the enum dicts using the SchemaEnumTmpl template.
     """
-    frags = []
-    structs = []
-    enums = []
     for resourcename, resource in sorted(resources.items()):
         for methodname, method in sorted(resource.get("methods", {}).items()):
             param_type_name = snake_to_camel(super_name + capitalize_first(resourcename) +
@@ -280,8 +602,9 @@ def generate_params_structs(resources, super_name="", global_params=None):
             if "parameters" in method:
                 for paramname, param in sorted(method["parameters"].items()):
                     (typ, desc), substructs, subenums = parse_schema_types(capitalize_first(resourcename)+capitalize_first(methodname)+capitalize_first(paramname),
-                            param, optional=False, parents=[])
-                    enums.extend(subenums)
+                            param, optional=False, types=types, reprs=reprs)
+                    for e in subenums:
+                        write_enum(f, e)
                     field = {
                         "name": rust_identifier(paramname),
                         "original_name": paramname,
@@ -298,55 +621,90 @@ def generate_params_structs(resources, super_name="", global_params=None):
                                 opt_time_query_parameters.append(field)
                             else:
                                 opt_query_parameters.append(field)
-            frags.append(chevron.render(SchemaStructTmpl, struct))
             struct["required_fields"] = req_query_parameters
             struct["optional_fields"] = opt_query_parameters
             struct["datetime_fields"] = opt_time_query_parameters
-            frags.append(chevron.render(SchemaDisplayTmpl, struct))
-            structs.append(struct)
+            write_struct(f, struct, display=True)
         # Generate parameter types for subresources.
-        subfrags, subenums = generate_params_structs(resource.get("resources", {}),
-                super_name=super_name + "_" + resourcename,
-                global_params=global_params)
-        frags.extend(subfrags)
-        enums.extend(subenums)
-        structs.extend(subfrags)
-    return structs, enums
+        generate_params_structs(f,
+                                resource.get("resources", {}),
+                                super_name=super_name + "_" + resourcename,
+                                global_params=global_params,
+                                types=types,
+                                reprs=reprs)
+
+
+def page_items(discdoc, method, reprs=None):
+    """Return the (Rust) name of the field holding the items of a page, and the type of the items, if
+    `method` is a list method taking a `pageToken` and returning a `nextPageToken`. Otherwise,
+    return None.
+    """
+    page_token = method.get("parameters", {}).get("pageToken", {})
+    if page_token.get("location") != "query" or page_token.get("required", False) or "response" not in method:
+        return None
+    name = method["response"]["$ref"]
+    properties = discdoc.get("schemas", {}).get(name, {}).get("properties", {})
+    if properties.get("nextPageToken", {}).get("type") != "string":
+        return None
+    # The items are in the only array field, or in `items` if there are several.
+    arrays = [pn for pn, pp in sorted(properties.items()) if pp.get("type") == "array"]
+    if "items" in arrays:
+        arrays = ["items"]
+    if len(arrays) != 1:
+        return None
+    (typ, _), _, _ = parse_schema_types(replace_keywords(name) + capitalize_first(arrays[0]),
+                                        properties[arrays[0]],
+                                        optional=False,
+                                        nested=True,
+                                        reprs=reprs)
+    return rust_identifier(replace_keywords(arrays[0])), typ[len("Vec<"):-len(">")]
 
 
-def resolve_parameters(string, paramsname="params"):
-    """Returns a Rust syntax for formatting the given string with API
-    parameters, and a list of (snake-case) API parameters that are used. This
-    is typically used to format URL paths containing required parameters for an
-    API call.
-    """
-    pat = re.compile('\{\+?(\w+)\}')
-    params = re.findall(pat, string)
-    snakeparams = [rust_identifier(p) for p in params]
-    format_params = ",".join([
-        "{}=percent_encode(format!(\"{{}}\", {}.{}).as_bytes(), NON_ALPHANUMERIC)".format(p, paramsname, sp)
-        for (p, sp) in zip(params, snakeparams)
-    ])
-    string = string.replace("{+", "{")
-    # Some required parameters are in the URL. This rust syntax formats the relative URL part appropriately.
-    return "format!(\"{}\", {})".format(string, format_params), snakeparams
+# Methods of the generated batch types. Batch methods for API methods of the same name get a `_call`
+# suffix.
+BATCH_RESERVED_NAMES = {"len", "execute"}
+
+# Bytes reserved for the query string and path parameters when building a request URL.
+URL_PARAMS_CAPACITY = 128
 
 
-def generate_service(resource, methods, discdoc, generate_subresources=True):
-    """Generate the code for all methods in a resource.
+def resolve_parameters(string, discdoc, paramsname="params", service="self"):
+    """Returns Rust statements appending the URL for the given path (containing
+    API parameters) to `url`, the capacity to reserve for `url`, and a list of
+    (snake-case) API parameters that are used. This is typically used to format
+    URL paths containing required parameters for an API call.
 
-    Returns a rendered string with source code.
+    Absolute paths are relative to the root URL, others relative to the base
+    URL of the API (taken from the service object `service`).
+    """
+    pat = re.compile('\{\+?(\w+)\}')
+    url_field, url = ("root_url", discdoc["rootUrl"].rstrip("/")) if string.startswith("/") else ("base_url",
+                                                                                                discdoc["baseUrl"])
+    statements = ["url.push_str(&{}.{});".format(service, url_field)]
+    snakeparams = []
+    pos = 0
+    for m in pat.finditer(string):
+        if m.start() > pos:
+            statements.append("url.push_str(\"{}\");".format(string[pos:m.start()]))
+        snakeparams.append(rust_identifier(m.group(1)))
+        statements.append("write_encoded(&mut url, &{}.{})?;".format(paramsname, snakeparams[-1]))
+        pos = m.end()
+    if pos < len(string):
+        statements.append("url.push_str(\"{}\");".format(string[pos:]))
+    capacity = len(url) + len(pat.sub("", string)) + URL_PARAMS_CAPACITY
+    return "\n".join(statements), capacity, snakeparams
+
+
+def generate_service(f, resource, methods, discdoc, generate_subresources=True, reprs=None):
+    """Generate the code for all methods in a resource, and write it to `f`.
+
+    Services for subresources are written after the service itself.
     """
     service = capitalize_first(snake_to_camel(rust_identifier(resource)))
     # Source code fragments implementing the methods.
     method_fragments = []
-    # Source code fragments for impls of subordinate resources.
-    subresource_fragments = []
-
-    # Generate methods for subresources.
-    if generate_subresources:
-        for subresname, subresource in sorted(methods.get("resources", {}).items()):
-            subresource_fragments.append(generate_service(service + capitalize_first(subresname), subresource, discdoc))
+    # Source code fragments queueing method calls in a batch.
+    batch_fragments = []
 
     for methodname, method in sorted(methods.get("methods", {}).items()):
         # Goal: Instantiate the templates for upload and non-upload methods.
@@ -388,13 +746,12 @@ def generate_service(resource, methods, discdoc, generate_subresources=True):
         # This relies on URL path parameters being required parameters (not
         # optional). If this invariant is not fulfilled, the Rust code may not
         # compile.
-        formatted_path, required_params = resolve_parameters(method["path"])
-        formatted_simple_upload_path, required_params = resolve_parameters(simple_upload_path)
-        formatted_resumable_upload_path, required_params = resolve_parameters(resumable_upload_path)
+        url_path, url_capacity, required_params = resolve_parameters(method["path"], discdoc)
+        simple_url_path, simple_url_capacity, _ = resolve_parameters(simple_upload_path, discdoc)
+        resumable_url_path, resumable_url_capacity, _ = resolve_parameters(resumable_upload_path, discdoc)
 
         # Guess default scope.
-        scopetype, scopeval = scopes_url_to_enum_val(discdoc["name"], method.get("scopes", [""])[-1])
-        scope_enum = scopetype + "::" + scopeval
+        scope_url = method.get("scopes", [""])[-1]
 
         if is_download:
             data_download = {
@@ -412,8 +769,10 @@ def generate_service(resource, methods, discdoc, generate_subresources=True):
                 discdoc["baseUrl"],
                 "root_path":
                 discdoc["rootUrl"],
-                "rel_path_expr":
-                formatted_path,
+                "url_path":
+                url_path,
+                "url_capacity":
+                url_capacity,
                 "params": [{
                     "param": p,
                     "snake_param": sp
@@ -425,7 +784,7 @@ def generate_service(resource, methods, discdoc, generate_subresources=True):
                 "global_params_name":
                 rust_identifier(global_params_name(discdoc.get("name", ""))) if has_global_params else None,
                 "scopes": [{
-                    "scope": scope_enum,
+                    "url": scope_url,
                 }],
                 "description":
                 method.get("description", "").replace("\n", "\n/// "),
@@ -434,7 +793,7 @@ def generate_service(resource, methods, discdoc, generate_subresources=True):
                 "wants_auth":
                 is_authd,
             }
-            method_fragments.append(chevron.render(DownloadMethodTmpl, data_download))
+            method_fragments.append(render(DownloadMethodTmpl, data_download))
         else:
             data_normal = {
                 "name":
@@ -449,8 +808,10 @@ def generate_service(resource, methods, discdoc, generate_subresources=True):
                 discdoc["baseUrl"],
                 "root_path":
                 discdoc["rootUrl"],
-                "rel_path_expr":
-                formatted_path,
+                "url_path":
+                url_path,
+                "url_capacity":
+                url_capacity,
                 "params": [{
                     "param": p,
                     "snake_param": sp
@@ -462,7 +823,7 @@ def generate_service(resource, methods, discdoc, generate_subresources=True):
                     "snake_param": sp
                 } for (p, sp) in sorted(required_parameters.items())],
                 "scopes": [{
-                    "scope": scope_enum,
+                    "url": scope_url,
                 }],
                 "description":
                 method.get("description", "").replace("\n", "\n/// "),
@@ -471,7 +832,20 @@ def generate_service(resource, methods, discdoc, generate_subresources=True):
                 "wants_auth":
                 is_authd,
             }
-            method_fragments.append(chevron.render(NormalMethodTmpl, data_normal))
+            method_fragments.append(render(NormalMethodTmpl, data_normal))
+            paged = page_items(discdoc, method, reprs=reprs)
+            if paged:
+                method_fragments.append(
+                    render(StreamMethodTmpl, dict(data_normal, items_field=paged[0], item_type=paged[1])))
+            if "batchPath" in discdoc:
+                batch_url_path, _, _ = resolve_parameters(method["path"], discdoc, service="self.service")
+                data_batch = dict(data_normal,
+                                  service=service,
+                                  method_name=data_normal["name"],
+                                  url_path=batch_url_path)
+                if data_batch["name"] in BATCH_RESERVED_NAMES:
+                    data_batch["name"] += "_call"
+                batch_fragments.append(render(BatchMethodTmpl, data_batch))
 
         # We generate an additional implementation with the option of uploading data.
         data_upload = {
@@ -481,8 +855,10 @@ def generate_service(resource, methods, discdoc, generate_subresources=True):
             "out_type": out_type,
             "base_path": discdoc["baseUrl"],
             "root_path": discdoc["rootUrl"],
-            "simple_rel_path_expr": formatted_simple_upload_path.lstrip("/"),
-            "resumable_rel_path_expr": formatted_resumable_upload_path.lstrip("/"),
+            "simple_url_path": simple_url_path,
+            "simple_url_capacity": simple_url_capacity,
+            "resumable_url_path": resumable_url_path,
+            "resumable_url_capacity": resumable_url_capacity,
             "global_params_name":
             rust_identifier(global_params_name(discdoc.get("name", ""))) if has_global_params else None,
             "params": [{
@@ -494,28 +870,37 @@ def generate_service(resource, methods, discdoc, generate_subresources=True):
                 "snake_param": sp
             } for (p, sp) in sorted(required_parameters.items())],
             "scopes": [{
-                "scope": scope_enum,
+                "url": scope_url,
             }],
             "description": method.get("description", "").replace("\n", "\n/// "),
             "http_method": http_method,
             "wants_auth": is_authd,
         }
         if "simple" in supported_uploads:
-            method_fragments.append(chevron.render(UploadMethodTmpl, data_upload))
+            method_fragments.append(render(UploadMethodTmpl, data_upload))
         if "resumable" in supported_uploads:
-            method_fragments.append(chevron.render(ResumableUploadMethodTmpl, data_upload))
+            method_fragments.append(render(ResumableUploadMethodTmpl, data_upload))
+
+    f.write(
+        render(
+            ServiceImplementationTmpl, {
+                "service": service,
+                "name": capitalize_first(snake_to_camel(discdoc.get("name", ""))),
+                "base_path": discdoc["baseUrl"] if discdoc["baseUrl"].endswith("/") else discdoc["baseUrl"] + "/",
+                "root_path": discdoc["rootUrl"].rstrip("/"),
+                "wants_auth": "auth" in discdoc,
+                "batch_path": discdoc["batchPath"].strip("/") if batch_fragments else None,
+                "methods": [{
+                    "text": t
+                } for t in method_fragments]
+            }))
+    if batch_fragments:
+        f.write(render(ServiceBatchTmpl, {"service": service, "methods": [{"text": t} for t in batch_fragments]}))
 
-    return chevron.render(
-        ServiceImplementationTmpl, {
-            "service": service,
-            "name": capitalize_first(snake_to_camel(discdoc.get("name", ""))),
-            "base_path": discdoc["baseUrl"],
-            "root_path": discdoc["rootUrl"],
-            "wants_auth": "auth" in discdoc,
-            "methods": [{
-                "text": t
-            } for t in method_fragments]
-        }) + "\n".join(subresource_fragments)
+    # Generate methods for subresources.
+    if generate_subresources:
+        for subresname, subresource in sorted(methods.get("resources", {}).items()):
+            generate_service(f, service + capitalize_first(subresname), subresource, discdoc, reprs=reprs)
 
 
 def scopes_url_to_enum_val(apiname, url):
@@ -538,7 +923,7 @@ def generate_scopes_type(name, scopes):
         enum_type_name, fancy_name = scopes_url_to_enum_val(name, url)
         parameters["name"] = enum_type_name
         parameters["scopes"].append({"scope_name": fancy_name, "desc": desc.get("description", ""), "url": url})
-    return chevron.render(OauthScopesType, parameters)
+    return render(OauthScopesType, parameters)
 
 
 def struct_inline_comments(s):
@@ -558,124 +943,883 @@ def enum_inline_comments(e):
         if value.get("desc", None):
             value["desc"] = value.get("desc", "").replace("\n", "\n/// ")
 
-def generate_all(discdoc):
-    """Generate all structs and impls, and render them into a file."""
-    print("Processing:", discdoc.get("id", ""))
-    schemas = discdoc.get("schemas", {})
-    resources = discdoc.get("resources", {})
-    # Generate scopes.
-    scopes_type = generate_scopes_type(discdoc["name"], discdoc.get("auth", {}).get("oauth2", {}).get("scopes", {}))
+def write_alias(f, a):
+    f.write(render(TypeAliasTmpl, a))
 
-    # Generate parameter types (*Params - those are used as "side inputs" to requests)
-    params_struct_name = global_params_name(discdoc.get("name"))
-    parameter_types, parameter_enums = generate_params_structs(resources, global_params=params_struct_name)
 
-    # Generate service impls.
-    services = []
-    for resource, methods in sorted(resources.items()):
-        services.append(generate_service(resource, methods, discdoc))
-    if "methods" in discdoc:
-        services.append(generate_service("Global", discdoc, discdoc, generate_subresources=False))
+def write_struct(f, s, display=False):
+    """Render a struct dict (and optionally its Display impl) to `f`."""
+    if "alias" in s:
+        return write_alias(f, s)
+    struct_inline_comments(s)
+    if not s["name"]:
+        print("WARN", s)
+    f.write(render(SchemaStructTmpl, s))
+    if display:
+        f.write(render(SchemaDisplayTmpl, s))
+
+
+# Methods of field mask builders; fields of the same name get a `_field` suffix.
+FIELD_MASK_RESERVED_NAMES = {"new"}
+
+
+def field_mask_type(typ):
+    """Return the struct type within a field type like Option<Vec<Box<T>>> (but not maps)."""
+    for wrapper in ("Option<", "Vec<", "Box<"):
+        if typ.startswith(wrapper):
+            return field_mask_type(typ[len(wrapper):-len(">")])
+    return typ
 
-    # Generate schema types.
-    structs = []
-    enums = []
-    for name, desc in sorted(schemas.items()):
-        typ, substructs, subenums = parse_schema_types(name, desc)
-        structs.extend(substructs)
-        enums.extend(subenums)
+
+def write_field_mask(f, s, builders):
+    """Render the field mask builder for the struct dict `s` to `f`.
+
+    `builders` is the set of types having a field mask builder, which `s` is added to. Fields of
+    those types can be selected partially.
+    """
+    if "alias" in s:
+        if s["alias"] in builders:
+            f.write(render(TypeAliasTmpl, {"name": s["name"] + "Fields", "alias": s["alias"] + "Fields"}))
+            builders.add(s["name"])
+        return
+    fields = []
+    for field in s["fields"]:
+        nested = field_mask_type(field["typ"])
+        fields.append({
+            "name": field["name"] + ("_field" if field["name"] in FIELD_MASK_RESERVED_NAMES else ""),
+            "original_name": field["original_name"],
+            "nested": nested + "Fields" if nested in builders else None,
+        })
+    builders.add(s["name"])
+    f.write(render(FieldMaskTmpl, {"name": s["name"], "fields": fields}))
+
+
+def write_enum(f, e):
+    """Render an enum dict to `f`."""
+    if "alias" in e:
+        return write_alias(f, e)
+    enum_inline_comments(e)
+    f.write(render(SchemaEnumTmpl, e))
+
+
+# Estimated (size, alignment, niche) of Rust types on 64-bit targets. A type has a niche if
+# Option<T> is as large as T.
+TYPE_LAYOUTS = {
+    "bool": (1, 1, True),
+    "i32": (4, 4, False),
+    "u32": (4, 4, False),
+    "f32": (4, 4, False),
+    "i64": (8, 8, False),
+    "u64": (8, 8, False),
+    "f64": (8, 8, False),
+    "DateTime<Utc>": (12, 4, False),
+    "String": (24, 8, True),
+    "Box<str>": (16, 8, True),
+    "std::sync::Arc<str>": (16, 8, True),
+}
+# Layouts of generic types, which don't depend on the type parameters.
+GENERIC_LAYOUTS = {
+    "Box": (8, 8, True),
+    "Vec": (24, 8, True),
+    "HashMap": (48, 8, True),
+    "std::collections::BTreeMap": (24, 8, True),
+    "VecMap": (24, 8, True),
+}
+# Assumed for types not generated from the same document.
+UNKNOWN_LAYOUT = (24, 8, True)
+# Generated enums are fieldless, with fewer than 256 variants.
+ENUM_LAYOUT = (1, 1, True)
+
+
+def type_layout(typ, layouts):
+    """Estimate the layout (size, alignment, niche) of the Rust type `typ`.
+
+    `layouts` maps the names of generated types to their layouts.
+    """
+    if typ in TYPE_LAYOUTS:
+        return TYPE_LAYOUTS[typ]
+    if typ in layouts:
+        return layouts[typ]
+    outer, _, inner = typ.partition("<")
+    if outer == "Option":
+        size, align, niche = type_layout(inner[:-len(">")], layouts)
+        # Without a niche, the discriminant is padded to the alignment.
+        return (size, align, niche) if niche else (size + align, align, True)
+    return GENERIC_LAYOUTS.get(outer, UNKNOWN_LAYOUT)
+
+
+def struct_layout(fields, layouts):
+    """Estimate the layout of a struct with `fields`, which Rust orders to minimize padding."""
+    field_layouts = [type_layout(field["typ"], layouts) for field in fields]
+    align = max((a for (_, a, _) in field_layouts), default=1)
+    size = sum(s for (s, _, _) in field_layouts)
+    return (-(-size // align) * align, align, any(n for (_, _, n) in field_layouts))
+
+
+def box_large_fields(structs, enums, threshold):
+    """Box optional struct fields larger than `threshold` bytes, i.e. change their type from
+    Option<T> to Option<Box<T>>.
+
+    Absent fields then only take the space of a pointer, instead of the size of T, in every value of
+    the containing struct. `structs` and `enums` are all struct and enum dicts (as returned by
+    parse_schema_types()) of a document; the structs are changed in place.
+
+    Returns:
+        [(name, size, boxed size)] of the structs that were shrunk, with their estimated sizes in
+        bytes before and after boxing their fields.
+    """
+    by_name = {s["name"]: s for s in structs}
+    layouts = {e["name"]: ENUM_LAYOUT for e in enums}
+    shrunk = []
+
+    def layout(name):
+        if name in layouts:
+            return layouts[name]
+        s = by_name[name]
+        if "alias" in s:
+            layouts[name] = layout(s["alias"]) if s["alias"] in by_name else UNKNOWN_LAYOUT
+            return layouts[name]
+        candidates = []
+        for field in s["fields"]:
+            if field["typ"].startswith("Option<") and field["typ"][len("Option<"):-len(">")] in by_name:
+                # Structs contained by value don't form cycles (see recursive_refs()).
+                layout(field["typ"][len("Option<"):-len(">")])
+                candidates.append(field)
+        before = struct_layout(s["fields"], layouts)
+        for field in candidates:
+            if type_layout(field["typ"], layouts)[0] > threshold:
+                field["typ"] = "Option<Box<{}>>".format(field["typ"][len("Option<"):-len(">")])
+        layouts[name] = struct_layout(s["fields"], layouts)
+        if layouts[name] != before:
+            shrunk.append((name, before[0], layouts[name][0]))
+        return layouts[name]
+
+    for name in sorted(by_name):
+        layout(name)
+    return shrunk
+
+
+# Size of the write buffer for generated files.
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def schema_type_names(name, schema):
+    """Return the names of the structs and enums that parse_schema_types() generates for `schema`,
+    without parsing it. A few more names may be returned, e.g. for enums that aren't generated.
+    """
+    if "$ref" in schema:
+        return []
+    if schema.get("type") == "object":
+        if "properties" in schema:
+            name = replace_keywords(name)
+            return [name] + [
+                n for (pn, pp) in schema["properties"].items()
+                for n in schema_type_names(name + capitalize_first(pn), pp)
+            ]
+        return schema_type_names(name, schema.get("additionalProperties", {}))
+    if schema.get("type") == "array":
+        return schema_type_names(name, schema.get("items", {}))
+    if schema.get("type") == "string" and "enum" in schema and name:
+        return [sanitize_id(name)]
+    return []
+
+
+def write_schemas(f, schemas, types=None, features=None, reprs=None):
+    """Generate the types for all `schemas` of a discovery document, and write them to `f`.
+
+    If `features` (see schema_features()) is given, schemas are grouped into modules that are only
+    compiled if one of the features using them is enabled. Large optional fields are boxed according
+    to `reprs` (see box_large_fields()).
+    """
+    boxed_refs = recursive_refs(schemas)
+    features = features or {}
+    # Names of all generated types, including nested ones. Field mask builders are omitted if their
+    # name is taken by one of them.
+    names = set(schemas)
+    for name, desc in schemas.items():
+        names.update(schema_type_names(name, desc))
+    # Schemas with field mask builders; nested structs are added as they are written, before the
+    # structs containing them.
+    builders = {
+        name
+        for name, desc in schemas.items()
+        if desc.get("type") == "object" and "properties" in desc and name + "Fields" not in names
+    }
+    gates = sorted({features.get(name, frozenset()) for name in schemas}, key=sorted)
+
+    def parse_gate(gate):
+        """Parse the schemas compiled with `gate`, yielding (substructs, subenums) for each."""
+        for name, desc in sorted(schemas.items()):
+            if features.get(name, frozenset()) != gate:
+                continue
+            with profile_item("schema", name):
+                typ, substructs, subenums = parse_schema_types(name,
+                                                               desc,
+                                                               boxed_refs=boxed_refs[name],
+                                                               types=types,
+                                                               reprs=reprs)
+                yield substructs, subenums
+
+    def write_types(substructs, subenums):
+        for s in substructs:
+            write_struct(f, s)
+            if s["name"] + "Fields" not in names:
+                write_field_mask(f, s, builders)
+        for e in subenums:
+            write_enum(f, e)
+
+    threshold = (reprs or DEFAULT_REPRS)["box"]
+    if not threshold:
+        # Types are written as they are parsed.
+        for i, gate in enumerate(gates):
+            with cfg_module(f, "schemas_{}".format(i), gate, types=types):
+                for (substructs, subenums) in parse_gate(gate):
+                    write_types(substructs, subenums)
+        return
+
+    # Boxing fields depends on the sizes of the types referenced, so all types are parsed before
+    # writing them.
+    parsed = {}
+    for gate in gates:
+        with type_gate(types, gate):
+            parsed[gate] = list(parse_gate(gate))
+    all_types = [types for gate in gates for types in parsed[gate]]
+    shrunk = box_large_fields([s for (substructs, _) in all_types for s in substructs],
+                              [e for (_, subenums) in all_types for e in subenums], threshold)
+    for (name, size, boxed_size) in shrunk:
+        print("Boxed fields of {}: {} -> {} bytes".format(name, size, boxed_size))
+    for i, gate in enumerate(gates):
+        with cfg_module(f, "schemas_{}".format(i), gate):
+            for (substructs, subenums) in parsed[gate]:
+                write_types(substructs, subenums)
+
+
+def write_params(f, discdoc, types=None, features=False, reprs=None):
+    """Generate the *Params types of all methods and the global parameters struct, and write them to `f`.
+
+    If `features`, the *Params types of each resource are only compiled if its feature is enabled.
+    """
+    # Generate parameter types (*Params - those are used as "side inputs" to requests)
+    params_struct_name = global_params_name(discdoc.get("name"))
+    for resource, methods in sorted(discdoc.get("resources", {}).items()):
+        gate = frozenset([feature_name(resource)]) if features else frozenset()
+        with cfg_module(f, feature_name(resource) + "_params", gate, types=types), profile_item("resource", resource):
+            generate_params_structs(f, {resource: methods},
+                                    global_params=params_struct_name,
+                                    types=types,
+                                    reprs=reprs)
 
     # Generate global parameters struct and its Display impl.
     if "parameters" in discdoc:
         schema = {"type": "object", "properties": discdoc["parameters"]}
         name = replace_keywords(snake_to_camel(params_struct_name))
-        typ, substructs, subenums = parse_schema_types(name, schema)
+        typ, substructs, subenums = parse_schema_types(name, schema, types=types, reprs=reprs)
+        for e in subenums:
+            write_enum(f, e)
         for s in substructs:
             s["optional_fields"] = s["fields"]
-        parameter_types.extend(substructs)
-        parameter_enums.extend(subenums)
+            write_struct(f, s, display=True)
+
+
+def generate_all(discdoc, split=False, features=False, jobs=1, reprs=None):
+    """Generate all structs and impls, and render them into a file (or a module tree, if `split`;
+    see generate_modules()).
+
+    If `features`, the services and *Params types of each resource, and the schemas they use, are
+    only compiled if the Cargo feature of the resource is enabled; the features are listed in a
+    Cargo.toml snippet next to the output (see write_features()). `reprs` selects the Rust types of
+    strings and maps (see DEFAULT_REPRS).
+
+    Every type and service is written out as soon as it has been generated, so that memory usage
+    doesn't grow with the size of the generated code.
+
+    Returns the paths of the unformatted files, which are to be passed to install_outputs().
+    """
+    print("Processing:", discdoc.get("id", ""))
+    if features:
+        write_features(discdoc)
+    if split:
+        return generate_modules(discdoc, features=features, jobs=jobs, reprs=reprs)
+    resources = discdoc.get("resources", {})
+
+    # The file is written next to the output file first, and only moved into place by
+    # install_outputs() after formatting, if it differs from the existing output; this keeps cargo
+    # from rebuilding crates depending on unchanged code.
+    types = new_type_cache()
+    tmp_path = output_path(discdoc) + ".new"
+    with open(tmp_path, "w", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(RustHeader)
+        # Generate scopes.
+        f.write(
+            generate_scopes_type(discdoc["name"],
+                                 discdoc.get("auth", {}).get("oauth2", {}).get("scopes", {})))
+
+        write_schemas(f,
+                      discdoc.get("schemas", {}),
+                      types=types,
+                      features=features and schema_features(discdoc),
+                      reprs=reprs)
+        write_params(f, discdoc, types=types, features=features, reprs=reprs)
+
+        # Generate service impls.
+        for resource, methods in sorted(resources.items()):
+            gate = frozenset([feature_name(resource)]) if features else frozenset()
+            with cfg_module(f, feature_name(resource) + "_service", gate), profile_item("resource", resource):
+                generate_service(f, resource, methods, discdoc, reprs=reprs)
+        if "methods" in discdoc:
+            generate_service(f, "Global", discdoc, discdoc, generate_subresources=False, reprs=reprs)
+    print("Deduplicated types:", types["deduplicated"])
+    return [tmp_path]
+
 
-    # Assemble everything into a file.
-    modname = (discdoc["id"] + "_types").replace(":", "_")
-    out_path = path.join("gen", modname + ".rs")
-    with open(out_path, "w") as f:
+def write_service_module(tmp_path, resource, methods, discdoc, generate_subresources=True, reprs=None):
+    """Write the service for `resource` (see generate_service()) to its own module file."""
+    with open(tmp_path, "w", buffering=WRITE_BUFFER_SIZE) as f, profile_item("resource", resource):
+        f.write(RustModuleHeader)
+        generate_service(f, resource, methods, discdoc, generate_subresources=generate_subresources, reprs=reprs)
+
+
+def generate_modules(discdoc, features=False, jobs=1, reprs=None):
+    """Generate all structs and impls into a module tree instead of a single file.
+
+    The module directory (module_dir()) contains a mod.rs declaring and re-exporting the modules
+    `scopes`, `schemas` (schema types), `params` (*Params types) and `<resource>_service` (one per
+    resource, including its subresources). This lets rustc compile the modules in parallel and
+    rebuild only those that changed. The services are rendered by `jobs` processes in parallel.
+
+    If `features`, the service modules are only compiled if the feature of their resource is
+    enabled (see generate_all()).
+
+    Returns the paths of the unformatted files, which are to be passed to install_outputs().
+    """
+    directory = module_dir(discdoc)
+    os.makedirs(directory, exist_ok=True)
+
+    def module_path(name):
+        return path.join(directory, name + ".rs.new")
+
+    with open(module_path("scopes"), "w") as f:
+        f.write(RustModuleHeader)
+        f.write(
+            generate_scopes_type(discdoc["name"],
+                                 discdoc.get("auth", {}).get("oauth2", {}).get("scopes", {})))
+
+    # Schemas and params share the type cache, so that params can refer to identical schema types.
+    types = new_type_cache()
+    with open(module_path("schemas"), "w", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(RustModuleHeader)
+        write_schemas(f,
+                      discdoc.get("schemas", {}),
+                      types=types,
+                      features=features and schema_features(discdoc),
+                      reprs=reprs)
+    with open(module_path("params"), "w", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(RustModuleHeader)
+        write_params(f, discdoc, types=types, features=features, reprs=reprs)
+    print("Deduplicated types:", types["deduplicated"])
+
+    # Services only need the top-level fields of the discovery document (and their resource); the
+    # schemas are not sent to worker processes.
+    service_doc = {k: v for (k, v) in discdoc.items() if k not in ("schemas", "resources")}
+    services = [(feature_name(resource) + "_service", resource, methods, True)
+                for resource, methods in sorted(discdoc.get("resources", {}).items())]
+    if "methods" in discdoc:
+        services.append(("global_service", "Global", service_doc, False))
+    tasks = [(module_path(name), resource, methods, service_doc, subresources, reprs)
+             for (name, resource, methods, subresources) in services]
+    if jobs > 1 and len(tasks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(write_service_module, *zip(*tasks)))
+    else:
+        for task in tasks:
+            write_service_module(*task)
+
+    modules = ["scopes", "schemas", "params"] + [name for (name, _, _, _) in services]
+    with open(module_path("mod"), "w") as f:
         f.write(RustHeader)
-        f.write(scopes_type)
-        # Render resource structs.
-        for s in structs:
-            struct_inline_comments(s)
-            if not s["name"]:
-                print("WARN", s)
-            f.write(chevron.render(SchemaStructTmpl, s))
-        for e in enums:
-            enum_inline_comments(e)
-            f.write(chevron.render(SchemaEnumTmpl, e))
-        for e in parameter_enums:
-            enum_inline_comments(e)
-            f.write(chevron.render(SchemaEnumTmpl, e))
-        # Render *Params structs.
-        for pt in parameter_types:
-            struct_inline_comments(pt)
-            f.write(chevron.render(SchemaStructTmpl, pt))
-            f.write(chevron.render(SchemaDisplayTmpl, pt))
-        # Render service impls.
-        for s in services:
-            f.write(s)
+        for name in modules:
+            module = {"name": name}
+            if features and name.endswith("_service") and name != "global_service":
+                module["cfg"] = cfg_features([name[:-len("_service")]])
+            f.write(render(ModuleTmpl, module))
+
+    # Remove modules of resources that don't exist anymore.
+    for name in os.listdir(directory):
+        if name.endswith(".rs") and name[:-len(".rs")] not in modules + ["mod"]:
+            print("Removing stale module:", path.join(directory, name))
+            os.remove(path.join(directory, name))
+    return [module_path(name) for name in ["mod"] + modules]
+
+
+def replace_if_changed(new_path, dest_path):
+    """Move `new_path` to `dest_path`, unless `dest_path` already has the same contents.
+
+    Returns True if `dest_path` was replaced.
+    """
     try:
-        subprocess.run(["rustfmt", out_path, "--edition=2018"])
-    except:
-        return
+        with open(new_path, "rb") as new, open(dest_path, "rb") as old:
+            unchanged = new.read() == old.read()
+    except FileNotFoundError:
+        unchanged = False
+    if unchanged:
+        print("Output unchanged:", dest_path)
+        os.remove(new_path)
+        return False
+    os.replace(new_path, dest_path)
+    return True
+
 
+RUSTFMT_CACHE = path.join("cache", "rustfmt")
 
 
-def from_cache(apiId):
+def run_rustfmt(paths):
+    """Format `paths` (in place) with a single rustfmt invocation.
+
+    Returns (success, error output).
+    """
     try:
-        with open(path.join("cache", apiId + ".json"), "r") as f:
-            print("Found API description in cache for", apiId)
-            return json.load(f)
-    except Exception as e:
-        print("Fetching description from cache failed:", e)
-        return None
+        p = subprocess.run(["rustfmt", "--edition=2018"] + paths, capture_output=True, text=True)
+    except OSError as e:
+        return False, str(e)
+    return p.returncode == 0, p.stderr
+
+
+def format_files(paths, jobs=1):
+    """Format the generated files at `paths` in place.
+
+    Files are formatted by `jobs` concurrent rustfmt processes, each of which is given a batch of
+    files. Results are cached by the hash of the unformatted file, so that an unchanged file doesn't
+    need to be formatted again.
+
+    Returns a dict mapping paths that couldn't be formatted to rustfmt's error output.
+    """
+    before = time.monotonic()
+    os.makedirs(RUSTFMT_CACHE, exist_ok=True)
+    cache_paths = {}
+    todo = []
+    for p in paths:
+        with open(p, "rb") as f:
+            cache_paths[p] = path.join(RUSTFMT_CACHE, hashlib.sha256(f.read()).hexdigest() + ".rs")
+        if path.exists(cache_paths[p]):
+            shutil.copyfile(cache_paths[p], p)
+        else:
+            todo.append(p)
+
+    failures = {}
+    if todo:
+        batches = [todo[i::jobs] for i in range(min(jobs, len(todo)))]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(batches)) as pool:
+            for batch, (ok, stderr) in zip(batches, pool.map(run_rustfmt, batches)):
+                if ok:
+                    continue
+                # Find out which files of the batch are to blame.
+                for p in batch:
+                    ok, stderr = run_rustfmt([p])
+                    if not ok:
+                        failures[p] = stderr
+        for p in todo:
+            if p not in failures:
+                shutil.copyfile(p, cache_paths[p])
+
+    print("rustfmt: formatted {} files ({} cached, {} failed) in {:.1f} s".format(
+        len(paths), len(paths) - len(todo), len(failures), time.monotonic() - before))
+    for p, stderr in sorted(failures.items()):
+        print("rustfmt failed for", p, ":", stderr)
+    return failures
+
+
+def install_outputs(paths, fmt=True, jobs=1):
+    """Format the files written by generate_all() and move them to their final location.
+
+    Returns a dict mapping paths of files that couldn't be formatted to rustfmt's error output.
+    Such files are still installed, unformatted.
+    """
+    # mod.rs only declares the modules of a module tree, and rustfmt fails on it because they are not
+    # in place yet.
+    to_format = [p for p in paths if path.basename(p) != "mod.rs.new"]
+    failures = format_files(to_format, jobs=jobs) if fmt and to_format else {}
+    for p in paths:
+        replace_if_changed(p, p[:-len(".new")])
+    return failures
+
+
+def output_path(discdoc):
+    return path.join("gen", (discdoc["id"] + "_types").replace(":", "_") + ".rs")
+
+
+def features_path(discdoc):
+    """Path of the Cargo.toml snippet written with --features."""
+    return output_path(discdoc)[:-len(".rs")] + "_features.toml"
 
 
-def to_cache(apiId, doc):
+def write_features(discdoc):
+    """Write the [features] table for the features of `discdoc` (one per resource; see
+    generate_all()) to features_path(). All features are enabled by default.
+    """
+    features = sorted(feature_name(resource) for resource in discdoc.get("resources", {}))
+    with open(features_path(discdoc), "w") as f:
+        f.write(render(CargoFeaturesTmpl, {"features": features, "default": ", ".join('"{}"'.format(ft) for ft in features)}))
+
+
+def module_dir(discdoc):
+    """Directory of the module tree generated with --split."""
+    return output_path(discdoc)[:-len(".rs")]
+
+
+def hash_files(*names):
+    h = hashlib.sha256()
+    for name in names:
+        with open(path.join(path.dirname(path.abspath(__file__)), name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# Changes to any of these invalidate all generated files.
+TEMPLATES_HASH = hash_files("templates.py")
+GENERATOR_HASH = hash_files("generate.py", "mustache.py")
+MANIFEST_PATH = path.join("gen", ".manifest.json")
+
+
+def fingerprint(discdoc, fmt=True, split=False, features=False, reprs=None):
+    """Return a dict identifying the inputs from which code for `discdoc` is generated."""
+    doc = json.dumps(discdoc, sort_keys=True).encode()
+    return {
+        "discovery": hashlib.sha256(doc).hexdigest(),
+        "templates": TEMPLATES_HASH,
+        "generator": GENERATOR_HASH,
+        "rustfmt": fmt,
+        "split": split,
+        "features": features,
+        "reprs": reprs or DEFAULT_REPRS,
+    }
+
+
+def load_manifest():
+    """Load the manifest of previously generated APIs, mapping API IDs to fingerprints."""
     try:
-        os.makedirs("cache", exist_ok=True)
-        with open(path.join("cache", apiId + ".json"), "w") as f:
-            json.dump(doc, f)
-    except Exception as e:
-        print(e)
-        return None
-    return None
+        with open(MANIFEST_PATH, "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def update_manifest(manifest, api_id, fp, outputs, fmt_failures):
+    """Record the fingerprint `fp` of the API `api_id`, whose `outputs` were installed by
+    install_outputs(). If any of them couldn't be formatted, the API is removed from the manifest
+    instead, so that it is generated and formatted again by the next run.
+    """
+    if any(p in fmt_failures for p in outputs):
+        manifest.pop(api_id, None)
+    else:
+        manifest[api_id] = fp
+
+
+def save_manifest(manifest):
+    with open(MANIFEST_PATH + ".new", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(MANIFEST_PATH + ".new", MANIFEST_PATH)
+
+
+def generate_if_changed(discdoc,
+                        manifest,
+                        force=False,
+                        fmt=True,
+                        split=False,
+                        features=False,
+                        jobs=1,
+                        reprs=None):
+    """Generate code for `discdoc`, unless it was generated from the same inputs before.
+
+    Returns the fingerprint of `discdoc` and the paths of the unformatted outputs (see
+    generate_all()), which are empty if nothing was generated.
+    """
+    reprs = api_reprs(reprs, discdoc["id"])
+    fp = fingerprint(discdoc, fmt=fmt, split=split, features=features, reprs=reprs)
+    output = path.join(module_dir(discdoc), "mod.rs") if split else output_path(discdoc)
+    if not force and manifest.get(discdoc["id"]) == fp and path.exists(output):
+        print("Unchanged, skipping:", discdoc["id"])
+        return fp, []
+    return fp, generate_all(discdoc, split=split, features=features, jobs=jobs, reprs=reprs)
+
+
+
+_cache = None
+
+
+def discovery_cache():
+    """Return the cache for discovery documents (see cache.py)."""
+    global _cache
+    if _cache is None:
+        _cache = cache.Cache()
+    return _cache
+
+
+# Cached discovery documents older than this (in seconds) are revalidated.
+CACHE_MAX_AGE = 3600
+# Cached discovery documents not used for this long (in seconds) are evicted.
+CACHE_MAX_UNUSED = 30 * 86400
+
 
+def save_cache():
+    """Evict unused entries from the discovery cache and write its index."""
+    c = discovery_cache()
+    evicted = c.evict(CACHE_MAX_UNUSED)
+    if evicted:
+        print("Evicted", evicted, "unused discovery documents from cache")
+    c.save()
 
-def fetch_discovery_base(url, apis):
+
+# Maximum number of concurrent requests for discovery documents.
+FETCH_CONCURRENCY = 8
+
+_session = None
+
+
+def http_session(pool_size=FETCH_CONCURRENCY):
+    """Return a requests session shared by all fetches, so that connections are reused.
+
+    `pool_size` is the maximum number of connections per host; it only has an effect on the first call.
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def fetch_cached(url, max_age=CACHE_MAX_AGE):
+    """Fetch the JSON document at `url`, using the cache.
+
+    If the document is cached and older than `max_age` seconds, it is revalidated using a
+    conditional request (If-None-Match/If-Modified-Since). If that fails (no response, an error
+    status, or an invalid document), the cached document is used. Error responses are never cached.
+    With a `max_age` of None, cached documents are never revalidated.
+
+    Raises:
+        requests.HTTPError if the response has an error status (and nothing is cached).
+    """
+    c = discovery_cache()
+    cached = c.get(url)
+    if cached is not None and (max_age is None or not c.is_stale(url, max_age)):
+        return cached
+    headers = {}
+    if cached is not None:
+        meta = c.meta(url)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        resp = http_session().get(url, headers=headers, timeout=60)
+        if resp.status_code == 304 and cached is not None:
+            print("Not modified:", url)
+            c.touch(url)
+            return cached
+        if resp.status_code == 200:
+            js = json.loads(resp.text)
+            c.put(url, js, etag=resp.headers.get("ETag"), last_modified=resp.headers.get("Last-Modified"))
+            return js
+        # Don't cache error responses, nor use them instead of the cached document. Their body may
+        # not be JSON (e.g. an HTML error page), so it isn't parsed.
+        raise requests.HTTPError("HTTP status {} for {}".format(resp.status_code, url), response=resp)
+    except (requests.RequestException, ValueError) as exc:
+        if cached is None:
+            raise
+        e = exc
+    print("Revalidating", url, "failed, using cached document:", e)
+    return cached
+
+
+def fetch_discovery_base(url, apis, max_age=CACHE_MAX_AGE):
     """Fetch the discovery base document from `url`. Return api documents for APIs with IDs in `apis`.
 
+    The list of APIs is kept in the cache index for each `url`, so the document itself is only
+    loaded if it needs to be revalidated.
+
     Returns:
-        List of API JSON documents.
+        List of API JSON documents (containing at least id, title, and discoveryRestUrl).
     """
-    doc = from_cache("_global_discovery")
-    if not doc:
-        doc = json.loads(requests.get(url).text)
-        to_cache("_global_discovery", doc)
-    return [it for it in doc["items"] if (not apis or it["id"] in apis)]
+    c = discovery_cache()
+    items = c.apis(url)
+    # Check the presence of the document using its metadata, so that it isn't loaded needlessly.
+    if items is None or not c.meta(url) or (max_age is not None and c.is_stale(url, max_age)):
+        items = fetch_cached(url, max_age=max_age)["items"]
+        c.set_apis(url, items)
+    return [it for it in items if (not apis or it["id"] in apis)]
 
 
-def fetch_discovery_doc(url_or_path):
-    """Fetch discovery document for a given (short) API doc from the overall discovery document."""
-    cachekey = url_or_path.replace("/", "_")
-    cached = from_cache(cachekey)
-    if cached:
-        return cached
+def fetch_discovery_doc(url_or_path, max_age=None):
+    """Fetch discovery document for a given (short) API doc from the overall discovery document.
 
+    By default, a cached document is used without revalidating it (see fetch_cached()).
+    """
     if url_or_path.startswith("http"):
-        js = json.loads(requests.get(url_or_path).text)
-        to_cache(cachekey, js)
-    else:
-        with open(url_or_path, "r") as f:
-            js = json.load(f)
-    return js
+        return fetch_cached(url_or_path, max_age=max_age)
+    with open(url_or_path, "r") as f:
+        return json.load(f)
+
+
+def fetch_discovery_docs(urls, max_age=CACHE_MAX_AGE, concurrency=FETCH_CONCURRENCY):
+    """Fetch (or revalidate) the discovery documents at `urls` concurrently, storing them in the cache.
+
+    Returns a dict mapping the URLs that couldn't be fetched to the exception or error response.
+    """
+    before = time.monotonic()
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(fetch_discovery_doc, url, max_age=max_age): url for url in urls}
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception():
+                errors[futures[future]] = future.exception()
+            elif "error" in future.result():
+                errors[futures[future]] = future.result()["error"]
+    print("Fetched {} discovery documents ({} failed) in {:.1f} s".format(len(urls), len(errors),
+                                                                       time.monotonic() - before))
+    return errors
+
+
+# Phases recorded for each API by --profile, by the functions implementing them (see phases.py). Time
+# not spent in any of them is attributed to `other`.
+PROFILED_PHASES = {
+    "fetch_cached": "fetch",
+    "parse_schema_types": "schemas",
+    "generate_params_structs": "params",
+    "generate_service": "services",
+    "render": "render",
+    "write_struct": "write",
+    "write_enum": "write",
+    "write_alias": "write",
+}
+# Number of slowest schemas and resources reported by --profile.
+PROFILE_TOP_N = 10
+
+# The PhaseTimer of the API currently being generated, if profiling (see profiling()).
+_profile = None
+
+
+def profile_item(kind, name):
+    """Record the time spent within the context for `name` (a schema or resource), if profiling."""
+    return _profile.item(kind, name) if _profile is not None else contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def profiling(timer):
+    """Record the phases (PROFILED_PHASES, and `load` for reading cached documents) and items
+    (profile_item()) of everything run within the context in `timer`.
+
+    The PhaseTimer is not thread-safe, so this must not be used around code running in threads.
+    Allocations are traced (see phases.py) within the context, if `timer` traces memory.
+    """
+    global _profile
+    _profile = timer
+    start_tracing = timer.trace_memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    try:
+        with timer.instrument(sys.modules[__name__], PROFILED_PHASES), \
+                timer.instrument(cache.Cache, {"get": "load"}), timer.phase("other"):
+            yield
+    finally:
+        _profile = None
+        if start_tracing:
+            tracemalloc.stop()
+
+
+def profile_report(timer):
+    return {
+        "phases": timer.report(),
+        "slowest_schemas": timer.slowest("schema", PROFILE_TOP_N),
+        "slowest_resources": timer.slowest("resource", PROFILE_TOP_N),
+    }
+
+
+def write_profile(path_, timer, results, elapsed):
+    """Write the profile collected by --profile as JSON to `path_`.
+
+    `timer` holds the phases of the main process (fetching, generating, formatting), and `results`
+    are returned by generate_api().
+    """
+    profile = {
+        "elapsed": elapsed,
+        "phases": timer.report(),
+        "apis": {r["id"]: dict(r["profile"], elapsed=r["elapsed"]) for r in results if r.get("profile")},
+    }
+    with open(path_, "w") as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    print("Profile written to", path_)
+
+
+def generate_api(doc,
+                 manifest,
+                 force=False,
+                 fmt=True,
+                 split=False,
+                 features=False,
+                 methods=None,
+                 jobs=1,
+                 reprs=None,
+                 profile=False,
+                 capture_output=False):
+    """Fetch the discovery document for an entry of the global discovery document, and generate
+    code for it if it has changed since the last run (according to `manifest`).
+
+    This is run in a worker process if --jobs is given, and therefore doesn't raise exceptions;
+    errors are reported in the returned dict instead. If `methods` patterns are given, only these
+    methods are generated (see prune_discdoc()).
+
+    Returns:
+        dict with elements id, error (message or None), elapsed (seconds), outputs (paths of the
+        unformatted outputs, empty if nothing was generated), fingerprint (for the manifest),
+        log (output if `capture_output`), and profile (see profile_report(), if `profile`).
+    """
+    result = {"id": doc["id"], "error": None, "outputs": [], "fingerprint": None}
+    log = io.StringIO()
+    before = time.monotonic()
+    timer = phases.PhaseTimer(trace_memory=profile)
+    with contextlib.redirect_stdout(log) if capture_output else contextlib.nullcontext(), \
+            profiling(timer) if profile else contextlib.nullcontext():
+        try:
+            discdoc = fetch_discovery_doc(doc["discoveryRestUrl"])
+            if "methods" in discdoc:
+                raise NotImplementedError("top-level methods are not yet implemented properly. Please take care.")
+            if "error" in discdoc:
+                print("Error while fetching document for", doc["id"], ":", discdoc)
+                result["error"] = "Error while fetching document: {}".format(discdoc["error"])
+            else:
+                if methods:
+                    discdoc = prune_discdoc(discdoc, methods)
+                result["fingerprint"], result["outputs"] = generate_if_changed(discdoc,
+                                                                               manifest,
+                                                                               force=force,
+                                                                               fmt=fmt,
+                                                                               split=split,
+                                                                               features=features,
+                                                                               jobs=jobs,
+                                                                               reprs=reprs)
+        except Exception as e:
+            print("Error while processing discovery doc for", doc["id"], ":", repr(e))
+            result["error"] = repr(e)
+    result["elapsed"] = time.monotonic() - before
+    result["log"] = log.getvalue()
+    if profile:
+        result["profile"] = profile_report(timer)
+    return result
+
+
+def print_summary(results, elapsed, fmt_failures={}):
+    """Print an overview of the results returned by generate_api() and install_outputs()."""
+    failed = [r for r in results if r["error"]]
+    unchanged = [r for r in results if not r["error"] and not r["outputs"]]
+    print()
+    print("Generated {} of {} APIs ({} unchanged) in {:.1f} s (sum over all APIs: {:.1f} s).".format(
+        len(results) - len(failed) - len(unchanged), len(results), len(unchanged), elapsed,
+        sum(r["elapsed"] for r in results)))
+    for r in failed:
+        print("FAILED:", r["id"], ":", r["error"])
+    for p in sorted(fmt_failures):
+        print("NOT FORMATTED:", p[:-len(".new")])
 
 
 def main():
@@ -686,45 +1830,192 @@ def main():
     p.add_argument("--apis", default="drive:v3", help="Only process APIs with these IDs (comma-separated)")
     p.add_argument("--doc", default="", help="Directly process Discovery document from this URL")
     p.add_argument("--list", default=False, help="List available APIs", action="store_true")
+    p.add_argument("--resources",
+                   default="",
+                   help="Only generate these resources (comma-separated), and the schemas they use")
+    p.add_argument("--methods",
+                   default="",
+                   help="Only generate these methods (comma-separated patterns like files.*,permissions.list), "
+                   "and the schemas they use")
+    p.add_argument("--jobs", default=1, type=int, help="Generate this many APIs in parallel")
+    p.add_argument("--force",
+                   default=False,
+                   help="Regenerate APIs even if their inputs haven't changed",
+                   action="store_true")
+    p.add_argument("--no-fmt", dest="fmt", default=True, help="Don't run rustfmt on output", action="store_false")
+    p.add_argument("--split",
+                   default=False,
+                   help="Generate a module tree (gen/<api>_types/) with a module per resource instead of a single file",
+                   action="store_true")
+    p.add_argument("--features",
+                   default=False,
+                   help="Only compile resources whose Cargo feature is enabled (see gen/<api>_types_features.toml)",
+                   action="store_true")
+    p.add_argument("--string-repr",
+                   default=DEFAULT_REPRS["string"],
+                   choices=sorted(STRING_REPRS),
+                   help="Rust type of strings: String, Box<str> (smaller), or Arc<str> (cheap to clone; requires "
+                   "Rust 1.80 for Params with required string parameters)")
+    p.add_argument("--map-repr",
+                   default=DEFAULT_REPRS["map"],
+                   choices=sorted(MAP_REPRS),
+                   help="Rust type of maps: HashMap, BTreeMap, or VecMap (a vector of entries, for small maps)")
+    p.add_argument("--box-threshold",
+                   default=str(DEFAULT_REPRS["box"]),
+                   type=parse_box_thresholds,
+                   help="Box optional struct fields estimated to be larger than this many bytes, so that they "
+                   "only take the size of a pointer if absent. This changes their types from Option<T> to "
+                   "Option<Box<T>>. Either a threshold for all APIs, or comma-separated API=threshold for "
+                   "single APIs, e.g. drive:v3=128 (default: 0, never)")
+    p.add_argument("--no-revalidate",
+                   dest="revalidate",
+                   default=True,
+                   help="Use cached discovery documents without checking for updates",
+                   action="store_false")
+    p.add_argument("--cache_max_age",
+                   default=CACHE_MAX_AGE,
+                   type=int,
+                   help="Check cached discovery documents older than this (in seconds) for updates")
+    p.add_argument("--fetch_jobs",
+                   default=FETCH_CONCURRENCY,
+                   type=int,
+                   help="Fetch this many discovery documents concurrently")
+    p.add_argument("--profile",
+                   default="",
+                   help="Write the time and allocated memory (traced, which slows down generation) of each phase and "
+                   "API, and the slowest schemas and resources, as JSON to this file")
+    p.add_argument("--profile_trace",
+                   default="",
+                   help="Write a cProfile trace (e.g. for snakeviz or flameprof) to this file. Use with --jobs=1.")
 
     args = p.parse_args()
 
+    profiler = cProfile.Profile() if args.profile_trace else None
+    if profiler:
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile_trace)
+            print("cProfile trace written to", args.profile_trace)
+
+
+def run(args):
+
     if args.apis:
         apilist = args.apis.split(",")
     else:
         apilist = []
 
+    methods = [m for m in args.methods.split(",") if m] + [r + ".*" for r in args.resources.split(",") if r]
+    reprs = {"string": args.string_repr, "map": args.map_repr, "box": args.box_threshold}
+
+    http_session(pool_size=args.fetch_jobs)
+    max_age = args.cache_max_age if args.revalidate else None
+
     if args.list:
-        docs = fetch_discovery_base(args.discovery_base, [])
+        docs = fetch_discovery_base(args.discovery_base, [], max_age=max_age)
         for doc in docs:
             print("API:", doc["title"], "ID:", doc["id"])
+        save_cache()
         return
 
-    if args.doc:
-        discdoc = fetch_discovery_doc(args.doc)
-        if "error" in discdoc:
-            print("Error while fetching document for", doc["id"], ":", discdoc)
-            return
-        if "methods" in discdoc:
-            #raise NotImplementedError("top-level methods are not yet implemented properly. Please take care.")
-            pass
-        generate_all(discdoc)
-        return
+    manifest = load_manifest()
 
-    docs = fetch_discovery_base(args.discovery_base, apilist)
+    timer = phases.PhaseTimer(trace_memory=bool(args.profile))
+    if args.profile:
+        tracemalloc.start()
+    before = time.monotonic()
 
-    for doc in docs:
-        try:
-            discdoc = fetch_discovery_doc(doc["discoveryRestUrl"])
-            if "methods" in discdoc:
-                raise NotImplementedError("top-level methods are not yet implemented properly. Please take care.")
+    if args.doc:
+        api_timer = phases.PhaseTimer(trace_memory=True)
+        with timer.phase("generate"), profiling(api_timer) if args.profile else contextlib.nullcontext():
+            discdoc = fetch_discovery_doc(args.doc, max_age=max_age)
+            save_cache()
             if "error" in discdoc:
                 print("Error while fetching document for", doc["id"], ":", discdoc)
-                continue
-            generate_all(discdoc)
-        except Exception as e:
-            print("Error while processing discovery doc")
-            continue
+                return
+            if "methods" in discdoc:
+                #raise NotImplementedError("top-level methods are not yet implemented properly. Please take care.")
+                pass
+            if methods:
+                discdoc = prune_discdoc(discdoc, methods)
+            fp, outputs = generate_if_changed(discdoc,
+                                              manifest,
+                                              force=args.force,
+                                              fmt=args.fmt,
+                                              split=args.split,
+                                              features=args.features,
+                                              jobs=args.jobs,
+                                              reprs=reprs)
+        fmt_failures = {}
+        if outputs:
+            with timer.phase("rustfmt"):
+                fmt_failures = install_outputs(outputs, fmt=args.fmt, jobs=args.jobs)
+        update_manifest(manifest, discdoc["id"], fp, outputs, fmt_failures)
+        save_manifest(manifest)
+        if args.profile:
+            result = {"id": discdoc["id"], "elapsed": time.monotonic() - before, "profile": profile_report(api_timer)}
+            write_profile(args.profile, timer, [result], time.monotonic() - before)
+        return
+
+    # Fetch all documents up front; the generators then use the cached documents. Fetch errors
+    # are reported by generate_api().
+    with timer.phase("fetch"):
+        docs = fetch_discovery_base(args.discovery_base, apilist, max_age=max_age)
+        fetch_discovery_docs([doc["discoveryRestUrl"] for doc in docs],
+                             max_age=max_age,
+                             concurrency=args.fetch_jobs)
+        # Worker processes read the cache from disk.
+        save_cache()
+    timer.enter("generate")
+    if args.jobs > 1 and len(docs) > 1:
+        # Each worker buffers its own log output, which is printed in the original order of APIs.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = []
+            worker = functools.partial(generate_api,
+                                       manifest=manifest,
+                                       force=args.force,
+                                       fmt=args.fmt,
+                                       split=args.split,
+                                       features=args.features,
+                                       methods=methods,
+                                       reprs=reprs,
+                                       profile=bool(args.profile),
+                                       capture_output=True)
+            for result in pool.map(worker, docs):
+                print(result["log"], end="")
+                results.append(result)
+    else:
+        # With a single API, the modules of a module tree are generated in parallel instead.
+        results = [
+            generate_api(doc,
+                         manifest,
+                         force=args.force,
+                         fmt=args.fmt,
+                         split=args.split,
+                         features=args.features,
+                         methods=methods,
+                         jobs=args.jobs,
+                         reprs=reprs,
+                         profile=bool(args.profile))
+            for doc in docs
+        ]
+    timer.leave()
+
+    outputs = [p for r in results for p in r["outputs"]]
+    with timer.phase("rustfmt"):
+        fmt_failures = install_outputs(outputs, fmt=args.fmt, jobs=args.jobs)
+    for result in results:
+        if result["fingerprint"]:
+            update_manifest(manifest, result["id"], result["fingerprint"], result["outputs"], fmt_failures)
+    save_manifest(manifest)
+    print_summary(results, time.monotonic() - before, fmt_failures)
+    if args.profile:
+        write_profile(args.profile, timer, results, time.monotonic() - before)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,117 @@
+#
+# (c) 2020, 2021 Lewin Bormann <lbo@spheniscida.de>
+#
+# A compiling renderer for the mustache templates in templates.py.
+#
+# chevron.render() tokenizes its template string again on every call, and then re-slices the
+# token stream for every iteration of a section. The generator renders the same handful of
+# templates tens of thousands of times per API, so most of the rendering time was spent in the
+# tokenizer. Here, every template is tokenized once (using chevron's own tokenizer, so that
+# whitespace handling stays identical) and turned into a tree of nodes which is then rendered
+# directly. Lookup semantics follow chevron's, so that output is byte-identical.
+
+from collections.abc import Iterator, Sequence
+
+import chevron.tokenizer
+
+_html_codes = (('"', '&quot;'), ('<', '&lt;'), ('>', '&gt;'))
+
+
+def _html_escape(s):
+    s = s.replace('&', '&amp;')
+    for char, code in _html_codes:
+        s = s.replace(char, code)
+    return s
+
+
+def _lookup(key, scopes):
+    """Resolve `key` in `scopes` (innermost first) the same way chevron does."""
+    if key == ".":
+        return scopes[0]
+    for scope in scopes:
+        try:
+            for child in key.split("."):
+                try:
+                    scope = scope[child]
+                except (TypeError, AttributeError):
+                    try:
+                        scope = getattr(scope, child)
+                    except (TypeError, AttributeError):
+                        scope = scope[int(child)]
+        except (AttributeError, KeyError, IndexError, ValueError):
+            continue
+        # Falsy values are rendered as empty strings, except for 0 and False.
+        if scope in (0, False):
+            return scope
+        return scope or ""
+    return ""
+
+
+def _compile(tokens, until=None):
+    """Turn a chevron token stream into a list of (tag, key, children) nodes."""
+    nodes = []
+    for tag, key in tokens:
+        if tag == "end":
+            if key != until:
+                raise ValueError("unexpected end of section {} (in {})".format(key, until))
+            return nodes
+        if tag in ("section", "inverted section"):
+            nodes.append((tag, key, _compile(tokens, until=key)))
+        elif tag in ("literal", "variable", "no escape"):
+            nodes.append((tag, key, None))
+        else:
+            raise ValueError("unsupported mustache tag: {} {}".format(tag, key))
+    if until is not None:
+        raise ValueError("unclosed section: {}".format(until))
+    return nodes
+
+
+def _render(nodes, scopes, out):
+    for tag, key, children in nodes:
+        if tag == "literal":
+            out.append(key)
+        elif tag == "no escape":
+            thing = _lookup(key, scopes)
+            out.append(thing if isinstance(thing, str) else str(thing))
+        elif tag == "variable":
+            thing = _lookup(key, scopes)
+            if thing is True and key == ".":
+                thing = scopes[1]
+            out.append(_html_escape(thing if isinstance(thing, str) else str(thing)))
+        elif tag == "section":
+            scope = _lookup(key, scopes)
+            if isinstance(scope, (Sequence, Iterator)) and not isinstance(scope, str):
+                for thing in scope:
+                    if thing:
+                        _render(children, [thing] + scopes, out)
+            elif scope:
+                _render(children, [scope] + scopes, out)
+        else:  # inverted section
+            if not _lookup(key, scopes):
+                _render(children, [True] + scopes, out)
+
+
+class Template:
+    """A mustache template that has been compiled once and can be rendered many times."""
+    def __init__(self, template):
+        self.nodes = _compile(chevron.tokenizer.tokenize(template))
+
+    def render(self, data):
+        out = []
+        _render(self.nodes, [data], out)
+        return "".join(out)
+
+
+_compiled = {}
+
+
+def render(template, data):
+    """Drop-in replacement for `chevron.render(template, data)`.
+
+    Templates are compiled on first use and cached by their source text.
+    """
+    try:
+        compiled = _compiled[template]
+    except KeyError:
+        compiled = _compiled[template] = Template(template)
+    return compiled.render(data)
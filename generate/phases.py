@@ -0,0 +1,141 @@
+#
+# (c) 2020, 2021 Lewin Bormann <lbo@spheniscida.de>
+#
+# Attributing the generator's run time to phases.
+#
+# Functions of a module are replaced by wrappers which enter a phase when they are called and
+# leave it when they return. Phases nest: time spent in a phase entered from another phase is only
+# counted for the inner one, so that, e.g., rendering done by generate_service() doesn't count as
+# time spent in generate_service().
+#
+# The net change in the number of memory blocks allocated by the interpreter
+# (sys.getallocatedblocks()) is recorded for each phase; this is cheap, but misses short-lived
+# blocks and may be negative. With `trace_memory`, the memory allocated in each phase is measured
+# using tracemalloc, which must be tracing: the net change of allocated bytes and the peak, i.e.
+# the most bytes allocated on top of what was allocated when the phase was entered (or resumed),
+# including memory freed before leaving it. Tracing slows down everything, so times are inflated.
+
+import collections
+import contextlib
+import functools
+import sys
+import time
+import tracemalloc
+
+
+class PhaseTimer:
+    """Measures the (exclusive) wall time, memory allocated, and number of calls of nested phases.
+
+    Additionally, the (inclusive) time spent on individual items, such as schemas or resources, can
+    be recorded using item().
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.times = collections.defaultdict(float)
+        self.net_blocks = collections.Counter()
+        self.net_bytes = collections.Counter()
+        self.peak_bytes = collections.Counter()
+        self.calls = collections.Counter()
+        self.items = collections.defaultdict(float)
+        # [phase, time, allocated blocks, and allocated bytes when the phase was entered or last resumed]
+        self.stack = []
+
+    def _sample(self):
+        """Return the current time, allocated blocks, allocated bytes, and the peak of allocated
+        bytes since the last sample."""
+        now, blocks = time.perf_counter(), sys.getallocatedblocks()
+        if not self.trace_memory:
+            return now, blocks, 0, 0
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        return now, blocks, current, peak
+
+    def _account(self, entry, sample):
+        """Attribute everything since `entry` (a stack entry) was last resumed to its phase."""
+        phase, since, since_blocks, since_bytes = entry
+        now, blocks, current, peak = sample
+        self.times[phase] += now - since
+        self.net_blocks[phase] += blocks - since_blocks
+        self.net_bytes[phase] += current - since_bytes
+        self.peak_bytes[phase] = max(self.peak_bytes[phase], peak - since_bytes)
+
+    def enter(self, phase):
+        sample = self._sample()
+        if self.stack:
+            self._account(self.stack[-1], sample)
+        self.stack.append([phase, sample[0], sample[1], sample[2]])
+        self.calls[phase] += 1
+
+    def leave(self):
+        sample = self._sample()
+        entry = self.stack.pop()
+        self._account(entry, sample)
+        if self.stack:
+            self.stack[-1][1:] = sample[:3]
+        return entry[0]
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        self.enter(phase)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    @contextlib.contextmanager
+    def item(self, kind, name):
+        """Record the time spent within the context for the item `name` of `kind`."""
+        before = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.items[(kind, name)] += time.perf_counter() - before
+
+    def slowest(self, kind, n=10):
+        """Return the `n` slowest items of `kind` as list of (name, seconds)."""
+        items = [(name, t) for ((k, name), t) in self.items.items() if k == kind]
+        return sorted(items, key=lambda it: -it[1])[:n]
+
+    def wrap(self, phase, fn):
+        """Return a wrapper of `fn` that runs it within `phase`."""
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.enter(phase)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.leave()
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def instrument(self, module, phases):
+        """Within the context, run the functions of `module` named in `phases` (a dict mapping
+        function names to phase names) within their phase.
+
+        As the functions are replaced in the module's namespace, calls from within the module are
+        instrumented, too.
+        """
+        originals = {name: getattr(module, name) for name in phases}
+        for name, phase in phases.items():
+            setattr(module, name, self.wrap(phase, originals[name]))
+        try:
+            yield
+        finally:
+            for name, fn in originals.items():
+                setattr(module, name, fn)
+
+    def report(self):
+        """Return a dict mapping each phase to a dict with its total time (seconds), net allocated
+        blocks, and calls; with `trace_memory`, also the net allocated bytes and the peak of
+        allocated bytes (see above)."""
+        report = {}
+        for phase in sorted(self.calls):
+            report[phase] = {
+                "time": self.times[phase],
+                "net_blocks": self.net_blocks[phase],
+                "calls": self.calls[phase]
+            }
+            if self.trace_memory:
+                report[phase].update(net_bytes=self.net_bytes[phase], peak_bytes=self.peak_bytes[phase])
+        return report
@@ -22,6 +22,54 @@ use async_google_apis_common::*;
 
 '''
 
+# Header of the files in a module tree (generate.py --split). Everything is imported from the parent
+# module, which re-exports all modules.
+RustModuleHeader = '''
+#![allow(unused_imports)]
+//! This file was generated by async-google-apis. (https://github.com/dermesser/async-google-apis)
+//!
+//! THIS FILE HAS BEEN GENERATED -- SAVE ANY MODIFICATIONS BEFORE REPLACING.
+
+use super::*;
+
+'''
+
+# Dict contents --
+# name (of module)
+# cfg (optional; condition for compiling the module)
+ModuleTmpl = '''{{#cfg}}#[cfg({{{cfg}}})]
+{{/cfg}}mod {{{name}}};
+{{#cfg}}#[cfg({{{cfg}}})]
+{{/cfg}}pub use {{{name}}}::*;
+'''
+
+# Modules wrapping feature-gated code (generate.py --features).
+#
+# Dict contents --
+# name (of module)
+# cfg (condition for compiling the module)
+CfgModuleBeginTmpl = '''
+#[cfg({{{cfg}}})]
+mod {{{name}}} {
+use super::*;
+'''
+
+CfgModuleEndTmpl = '''
+}
+#[cfg({{{cfg}}})]
+pub use {{{name}}}::*;
+'''
+
+# Dict contents --
+# features: [name]
+# default (comma-separated quoted features)
+CargoFeaturesTmpl = '''[features]
+default = [{{{default}}}]
+{{#features}}
+{{{.}}} = []
+{{/features}}
+'''
+
 # Dict contents --
 # name (of API, Capitalized)
 # scopes: [{name, url, desc}]
@@ -73,19 +121,33 @@ impl std::default::Default for {{{name}}} {
     }
 }
 
-impl std::fmt::Display for {{{name}}} {
-    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
-        let s = match self {
-            {{{name}}}::Undefined => write!(f, "undefined"),
+impl {{{name}}} {
+    /// The value of this variant as used by the API.
+    pub fn as_str(&self) -> &'static str {
+        match self {
+            {{{name}}}::Undefined => "undefined",
             {{#values}}
-            {{{name}}}::{{{line}}} => write!(f, "{{{jsonvalue}}}"),
+            {{{name}}}::{{{line}}} => "{{{jsonvalue}}}",
             {{/values}}
-        };
-        Ok(())
+        }
+    }
+}
+
+impl std::fmt::Display for {{{name}}} {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        f.write_str(self.as_str())
     }
 }
 '''
 
+# A type identical to another one, which is only generated once.
+#
+# fields: {name, alias}
+TypeAliasTmpl = '''
+/// Identical to `{{{alias}}}`.
+pub type {{{name}}} = {{{alias}}};
+'''
+
 # A struct for parameters or input/output API types.
 # Dict contents --
 # name
@@ -108,21 +170,73 @@ pub struct {{{name}}} {
 }
 '''
 
+# Builder of field masks for a struct.
+# Dict contents --
+# name
+# fields: [{name, original_name, nested}] (nested: field mask builder of the field's type, if any)
+FieldMaskTmpl = '''
+/// Builds a field mask selecting fields of `{{{name}}}`, e.g. for the `fields` parameter.
+#[derive(Debug, Clone, Default)]
+pub struct {{{name}}}Fields(FieldMask);
+
+impl {{{name}}}Fields {
+    pub fn new() -> {{{name}}}Fields {
+        {{{name}}}Fields(FieldMask::new())
+    }
+{{#fields}}
+    /// Select `{{{original_name}}}`.
+    pub fn {{{name}}}(mut self) -> Self {
+        self.0.push("{{{original_name}}}");
+        self
+    }
+    {{#nested}}
+    /// Select the fields of `{{{original_name}}}` selected by `fields`.
+    pub fn {{{name}}}_with(mut self, fields: {{{nested}}}) -> Self {
+        self.0.push_nested("{{{original_name}}}", &FieldMask::from(fields));
+        self
+    }
+    {{/nested}}
+{{/fields}}
+}
+
+impl From<{{{name}}}Fields> for FieldMask {
+    fn from(f: {{{name}}}Fields) -> FieldMask {
+        f.0
+    }
+}
+
+impl From<{{{name}}}Fields> for String {
+    fn from(f: {{{name}}}Fields) -> String {
+        f.0.into()
+    }
+}
+
+impl std::fmt::Display for {{{name}}}Fields {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        std::fmt::Display::fmt(&self.0, f)
+    }
+}
+'''
+
 # Serialize a global params struct to a URL query string.
 SchemaDisplayTmpl = '''
 impl std::fmt::Display for {{{name}}} {
     fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
         {{#required_fields}}
-        write!(f, "&{{{original_name}}}={}", percent_encode(format!("{}", self.{{{name}}}).as_bytes(), NON_ALPHANUMERIC).to_string())?;
+        f.write_str("&{{{original_name}}}=")?;
+        write_encoded(f, &self.{{{name}}})?;
         {{/required_fields}}
         {{#optional_fields}}
         if let Some(ref v) = self.{{{name}}} {
-            write!(f, "&{{{original_name}}}={}", percent_encode(format!("{}", v).as_bytes(), NON_ALPHANUMERIC).to_string())?;
+            f.write_str("&{{{original_name}}}=")?;
+            write_encoded(f, v)?;
         }
         {{/optional_fields}}
         {{#datetime_fields}}
         if let Some(ref v) = self.{{{name}}} {
-            write!(f, "&{{{original_name}}}={}", percent_encode(v.to_rfc3339().as_bytes(), NON_ALPHANUMERIC).to_string())?;
+            f.write_str("&{{{original_name}}}=")?;
+            // RFC 3339, like `to_rfc3339()`, but without allocating.
+            write_encoded(f, &v.format("%Y-%m-%dT%H:%M:%S%.f%:z"))?;
         }
         {{/datetime_fields}}
         Ok(())
@@ -140,12 +254,15 @@ ServiceImplementationTmpl = '''
 pub struct {{{service}}}Service {
     client: TlsClient,
     {{#wants_auth}}
-    authenticator: Box<dyn 'static + DerefAuth>,
-    scopes: Vec<String>,
+    tokens: TokenCache,
     {{/wants_auth}}
 
+    /// Ends with a '/'.
     base_url: String,
+    /// Doesn't end with a '/'.
     root_url: String,
+    /// Whether to ask for gzip-compressed responses.
+    gzip: bool,
 }
 
 impl {{{service}}}Service {
@@ -156,39 +273,22 @@ impl {{{service}}}Service {
     {{#wants_auth}}<A: 'static + DerefAuth>
     {{/wants_auth}}(client: TlsClient{{#wants_auth}}, auth: A{{/wants_auth}}) -> {{{service}}}Service {
         {{{service}}}Service { client: client
-            {{#wants_auth}}, authenticator: Box::new(auth), scopes: vec![]{{/wants_auth}},
-            base_url: "{{{base_path}}}".into(), root_url: "{{{root_path}}}".into() }
+            {{#wants_auth}}, tokens: TokenCache::new(auth){{/wants_auth}},
+            base_url: "{{{base_path}}}".into(), root_url: "{{{root_path}}}".into(), gzip: true }
     }
 
-    /// Provide the base URL of this API. The returned URL is guaranteed to end with a '/'.
-    fn base_url(&self) -> String {
-        if self.base_url.ends_with("/") {
-            return self.base_url.clone();
-        }
-        return self.base_url.clone() + "/";
-    }
-    /// Provide the root URL of this API. The returned URL is guaranteed to end with a '/'.
-    fn root_url(&self) -> String {
-        if self.root_url.ends_with("/") {
-            return self.root_url.clone();
-        }
-        return self.root_url.clone();
-    }
-    /// Returns appropriate URLs for relative and absolute paths.
-    fn format_path(&self, path: &str) -> String {
-        if path.starts_with("/") {
-            return self.root_url().trim_end_matches("/").to_string() + path;
-        } else {
-            return self.base_url() + path;
-        }
+    /// Select whether responses are requested gzip-compressed (the default), which saves bandwidth
+    /// at the expense of some CPU time. Compressed responses are decompressed transparently.
+    pub fn set_gzip(&mut self, gzip: bool) {
+        self.gzip = gzip;
     }
 
     #[cfg(test)]
     /// Override API URLs. `base` is the base path relative to which (relative) method paths are interpreted,
     /// whereas `root` is the URL relative to which absolute paths are interpreted.
     pub fn set_urls(&mut self, base: String, root: String) {
-        self.base_url = base;
-        self.root_url = root;
+        self.base_url = if base.ends_with("/") { base } else { base + "/" };
+        self.root_url = root.trim_end_matches("/").to_string();
     }
 
     {{#wants_auth}}
@@ -197,19 +297,89 @@ impl {{{service}}}Service {
     ///
     /// It is most convenient to supply a vec or slice of {{{name}}}Scopes enum values.
     pub fn set_scopes<S: AsRef<str>, T: AsRef<[S]>>(&mut self, scopes: T) {
-        self.scopes = scopes.as_ref().into_iter().map(|s| s.as_ref().to_string()).collect();
+        self.tokens.set_scopes(scopes.as_ref().into_iter().map(|s| s.as_ref().to_string()).collect());
     }
     {{/wants_auth}}
 
+    {{#batch_path}}
+    /// Start a batch of calls of this service's methods. They are sent together, as few HTTP
+    /// requests, once `execute()` is called on the returned object.
+    pub fn batch(&self) -> {{{service}}}Batch<'_> {
+        {{{service}}}Batch { service: self, batch: Batch::new(format!("{}/{{{batch_path}}}", self.root_url)) }
+    }
+    {{/batch_path}}
+
     {{#methods}}
     {{{text}}}
     {{/methods}}
 }
 '''
 
+# Takes dict contents:
+# service, methods: [{text}]
+ServiceBatchTmpl = '''
+/// Queues calls of {{{service}}}Service methods, which are sent as batch requests by `execute()`.
+/// Each queued call returns a handle for obtaining its response from the `BatchResponses`.
+pub struct {{{service}}}Batch<'a> {
+    service: &'a {{{service}}}Service,
+    batch: Batch,
+}
+
+impl<'a> {{{service}}}Batch<'a> {
+    /// Number of calls queued.
+    pub fn len(&self) -> usize {
+        self.batch.len()
+    }
+
+    /// Send all queued calls, in batch requests of up to 100 calls each.
+    pub async fn execute(self) -> Result<BatchResponses> {
+        self.batch.execute(&self.service.client).await
+    }
+
+    {{#methods}}
+    {{{text}}}
+    {{/methods}}
+}
+'''
+
+# Takes dict contents:
+# service, name, method_name, param_type, in_type, out_type
+# url_path, url_capacity, scopes: [{url}] (default scopes),
+# global_params_name, http_method
+BatchMethodTmpl = '''
+/// Queue a call of `{{{service}}}Service::{{{method_name}}}()`.
+pub async fn {{{name}}}(
+    &mut self, params: &{{{param_type}}}
+    {{#in_type}}, req: &{{{in_type}}}{{/in_type}}) -> Result<BatchHandle<{{{out_type}}}>> {
+
+    let mut url = String::with_capacity({{{url_capacity}}});
+    {{{url_path}}}
+
+    let mut headers: Vec<(hyper::header::HeaderName, hyper::header::HeaderValue)> = vec![];
+    {{#wants_auth}}
+    static SCOPES: &[&str] = &[{{#scopes}}"{{{url}}}", {{/scopes}}];
+    headers.push((hyper::header::AUTHORIZATION, self.service.tokens.header(SCOPES).await?));
+    {{/wants_auth}}
+
+    url.push_str("?");
+    write_display(&mut url, params)?;
+    {{#global_params_name}}
+    if let Some(ref api_params) = &params.{{{global_params_name}}} {
+        write_display(&mut url, api_params)?;
+    }
+    {{/global_params_name}}
+
+    let opt_request: Option<&EmptyRequest> = None;
+    {{#in_type}}
+    let opt_request = Some(req);
+    {{/in_type}}
+    self.batch.add(&url, &headers, "{{{http_method}}}", opt_request)
+  }
+'''
+
 # Takes dict contents:
 # name, description, param_type, in_type, out_type
-# base_path, rel_path_expr, scopes (string repr. of rust string array),
+# base_path, url_path, url_capacity, scopes: [{url}] (default scopes),
 # params: [{param, snake_param}]
 # http_method
 NormalMethodTmpl = '''
@@ -220,44 +390,63 @@ pub async fn {{{name}}}(
     &self, params: &{{{param_type}}}
     {{#in_type}}, req: &{{{in_type}}}{{/in_type}}) -> Result<{{{out_type}}}> {
 
-    let rel_path = {{{rel_path_expr}}};
-    let path = self.format_path(rel_path.as_str());
+    let mut url = String::with_capacity({{{url_capacity}}});
+    {{{url_path}}}
 
-    let mut headers = vec![];
+    let mut headers: Vec<(hyper::header::HeaderName, hyper::header::HeaderValue)> = vec![];
     {{#wants_auth}}
-    let tok;
-    if self.scopes.is_empty() {
-        let scopes = &[{{#scopes}}{{{scope}}}.as_ref().to_string(),
-        {{/scopes}}];
-        tok = self.authenticator.token(scopes).await?;
-    } else {
-        tok = self.authenticator.token(&self.scopes).await?;
-    }
-    headers.push((hyper::header::AUTHORIZATION, format!("Bearer {token}", token=tok.as_str())));
+    static SCOPES: &[&str] = &[{{#scopes}}"{{{url}}}", {{/scopes}}];
+    headers.push((hyper::header::AUTHORIZATION, self.tokens.header(SCOPES).await?));
     {{/wants_auth}}
+    if self.gzip {
+        accept_gzip(&mut headers);
+    }
 
-    let mut url_params = format!("?{params}", params=params);
+    url.push_str("?");
+    write_display(&mut url, params)?;
     {{#global_params_name}}
     if let Some(ref api_params) = &params.{{{global_params_name}}} {
-        url_params.push_str(&format!("{}", api_params));
+        write_display(&mut url, api_params)?;
     }
     {{/global_params_name}}
 
-    let full_uri = path + &url_params;
-
     let opt_request: Option<&EmptyRequest> = None;
     {{#in_type}}
     let opt_request = Some(req);
     {{/in_type}}
-    do_request(&self.client, &full_uri,
+    do_request(&self.client, &url,
         &headers,
         "{{{http_method}}}", opt_request).await
   }
 '''
 
+# Takes:
+# name, param_type, in_type, item_type, items_field
+StreamMethodTmpl = '''
+/// Returns the items of all pages returned by `{{{name}}}()` as stream, starting with the page
+/// `params.page_token` refers to. While the items of a page are consumed, up to `prefetch` further
+/// pages are fetched.
+pub fn {{{name}}}_stream<'a>(
+    &'a self, params: &{{{param_type}}}
+    {{#in_type}}, req: &'a {{{in_type}}}{{/in_type}}, prefetch: usize)
+    -> impl futures::Stream<Item = Result<{{{item_type}}}>> + Unpin + 'a {
+    let params = params.clone();
+    page_stream(prefetch, move |page_token| {
+        let mut params = params.clone();
+        if page_token.is_some() {
+            params.page_token = page_token.map(Into::into);
+        }
+        async move {
+            let page = self.{{{name}}}(&params{{#in_type}}, req{{/in_type}}).await?;
+            Ok((page.{{{items_field}}}.unwrap_or_default(), page.next_page_token.map(|t| t.to_string())))
+        }
+    })
+  }
+'''
+
 # Takes:
 # name, param_type, in_type, out_type
-# base_path, rel_path_expr
+# base_path, url_path, url_capacity
 # params: [{param, snake_param}]
 # http_method
 UploadMethodTmpl = '''
@@ -268,37 +457,72 @@ UploadMethodTmpl = '''
 /// This method is a variant of `{{{name}}}()`, taking data for upload. It performs a multipart upload.
 pub async fn {{{name}}}_upload(
     &self, params: &{{{param_type}}}, {{#in_type}}req: &{{{in_type}}},{{/in_type}} data: hyper::body::Bytes) -> Result<{{{out_type}}}> {
-    let rel_path = {{{simple_rel_path_expr}}};
-    let path = self.format_path(rel_path.as_str());
+    let mut url = String::with_capacity({{{simple_url_capacity}}});
+    {{{simple_url_path}}}
 
-    let mut headers = vec![];
+    let mut headers: Vec<(hyper::header::HeaderName, hyper::header::HeaderValue)> = vec![];
     {{#wants_auth}}
-    let tok;
-    if self.scopes.is_empty() {
-        let scopes = &[{{#scopes}}{{{scope}}}.as_ref().to_string(),
-        {{/scopes}}];
-        tok = self.authenticator.token(scopes).await?;
-    } else {
-        tok = self.authenticator.token(&self.scopes).await?;
+    static SCOPES: &[&str] = &[{{#scopes}}"{{{url}}}", {{/scopes}}];
+    headers.push((hyper::header::AUTHORIZATION, self.tokens.header(SCOPES).await?));
+    {{/wants_auth}}
+    if self.gzip {
+        accept_gzip(&mut headers);
+    }
+
+    url.push_str("?uploadType=multipart");
+    write_display(&mut url, params)?;
+
+    {{#global_params_name}}
+    if let Some(ref api_params) = &params.{{{global_params_name}}} {
+        write_display(&mut url, api_params)?;
     }
-    headers.push((hyper::header::AUTHORIZATION, format!("Bearer {token}", token=tok.as_str())));
+    {{/global_params_name}}
+
+    let opt_request: Option<&EmptyRequest> = None;
+    {{#in_type}}
+    let opt_request = Some(req);
+    {{/in_type}}
+
+    do_upload_multipart(&self.client, &url,
+        &headers,
+        "{{{http_method}}}", opt_request, data).await
+  }
+
+{{#description}}
+/// {{{description}}}
+///
+{{/description}}
+/// This method is a variant of `{{{name}}}()`, reading data for upload from `data`. It performs a
+/// multipart upload, sending the data in chunks while it is read.
+pub async fn {{{name}}}_upload_stream<R: tokio::io::AsyncRead + Send + 'static>(
+    &self, params: &{{{param_type}}}, {{#in_type}}req: &{{{in_type}}},{{/in_type}} data: R) -> Result<{{{out_type}}}> {
+    let mut url = String::with_capacity({{{simple_url_capacity}}});
+    {{{simple_url_path}}}
+
+    let mut headers: Vec<(hyper::header::HeaderName, hyper::header::HeaderValue)> = vec![];
+    {{#wants_auth}}
+    static SCOPES: &[&str] = &[{{#scopes}}"{{{url}}}", {{/scopes}}];
+    headers.push((hyper::header::AUTHORIZATION, self.tokens.header(SCOPES).await?));
     {{/wants_auth}}
+    if self.gzip {
+        accept_gzip(&mut headers);
+    }
 
-    let mut url_params = format!("?uploadType=multipart{params}", params=params);
+    url.push_str("?uploadType=multipart");
+    write_display(&mut url, params)?;
 
     {{#global_params_name}}
     if let Some(ref api_params) = &params.{{{global_params_name}}} {
-        url_params.push_str(&format!("{}", api_params));
+        write_display(&mut url, api_params)?;
     }
     {{/global_params_name}}
 
-    let full_uri = path + &url_params;
     let opt_request: Option<&EmptyRequest> = None;
     {{#in_type}}
     let opt_request = Some(req);
     {{/in_type}}
 
-    do_upload_multipart(&self.client, &full_uri,
+    do_upload_multipart_stream(&self.client, &url,
         &headers,
         "{{{http_method}}}", opt_request, data).await
   }
@@ -306,7 +530,7 @@ pub async fn {{{name}}}_upload(
 
 # Takes:
 # name, param_type, in_type, out_type
-# base_path, rel_path_expr
+# base_path, url_path, url_capacity
 # params: [{param, snake_param}]
 # http_method
 ResumableUploadMethodTmpl = '''
@@ -317,44 +541,47 @@ ResumableUploadMethodTmpl = '''
 /// This method is a variant of `{{{name}}}()`, taking data for upload.
 /// It returns a `ResumableUpload` upload manager which you can use to stream larger amounts
 /// of data to the API. The result of this call will be returned by the `ResumableUpload` method
-/// you choose for the upload.
+/// you choose for the upload. Chunks grow up to `RESUMABLE_MAX_CHUNKSIZE` bytes with the
+/// throughput; use `ResumableUpload::set_max_chunksize()` to limit them.
 pub async fn {{{name}}}_resumable_upload<'client>(
     &'client self, params: &{{{param_type}}}, {{#in_type}}req: &{{{in_type}}}{{/in_type}}) -> Result<ResumableUpload<'client, {{{out_type}}}>> {
+    self.{{{name}}}_resumable_upload_with_chunksize(params, {{#in_type}}req, {{/in_type}}RESUMABLE_CHUNKSIZE).await
+}
 
-    let rel_path = {{{resumable_rel_path_expr}}};
-    let path = self.format_path(rel_path.as_str());
+/// Like `{{{name}}}_resumable_upload()`, but the first chunk of the upload has `chunksize` bytes
+/// (a multiple of 256 KiB). The sizes of the following chunks are adapted to the throughput.
+pub async fn {{{name}}}_resumable_upload_with_chunksize<'client>(
+    &'client self, params: &{{{param_type}}}, {{#in_type}}req: &{{{in_type}}}, {{/in_type}}chunksize: usize) -> Result<ResumableUpload<'client, {{{out_type}}}>> {
 
-    let mut headers = vec![];
+    let mut url = String::with_capacity({{{resumable_url_capacity}}});
+    {{{resumable_url_path}}}
+
+    let mut headers: Vec<(hyper::header::HeaderName, hyper::header::HeaderValue)> = vec![];
     {{#wants_auth}}
-    let tok;
-    if self.scopes.is_empty() {
-        let scopes = &[{{#scopes}}{{{scope}}}.as_ref().to_string(),
-        {{/scopes}}];
-        tok = self.authenticator.token(scopes).await?;
-    } else {
-        tok = self.authenticator.token(&self.scopes).await?;
-    }
-    headers.push((hyper::header::AUTHORIZATION, format!("Bearer {token}", token=tok.as_str())));
+    static SCOPES: &[&str] = &[{{#scopes}}"{{{url}}}", {{/scopes}}];
+    headers.push((hyper::header::AUTHORIZATION, self.tokens.header(SCOPES).await?));
     {{/wants_auth}}
 
-    let mut url_params = format!("?uploadType=resumable{params}", params=params);
+    url.push_str("?uploadType=resumable");
+    write_display(&mut url, params)?;
     {{#global_params_name}}
     if let Some(ref api_params) = &params.{{{global_params_name}}} {
-        url_params.push_str(&format!("{}", api_params));
+        write_display(&mut url, api_params)?;
     }
     {{/global_params_name}}
 
-    let full_uri = path + &url_params;
-
     let opt_request: Option<&EmptyRequest> = None;
     {{#in_type}}
     let opt_request = Some(req);
     {{/in_type}}
     let (_resp, headers): (EmptyResponse, hyper::HeaderMap) = do_request_with_headers(
-        &self.client, &full_uri, &headers, "{{{http_method}}}", opt_request).await?;
+        &self.client, &url, &headers, "{{{http_method}}}", opt_request).await?;
     if let Some(dest) = headers.get(hyper::header::LOCATION) {
         use std::convert::TryFrom;
-        Ok(ResumableUpload::new(hyper::Uri::try_from(dest.to_str()?)?, &self.client, 5*1024*1024))
+        let mut upload = ResumableUpload::new(
+            hyper::Uri::try_from(dest.to_str()?)?, &self.client, std::cmp::max(chunksize, RESUMABLE_MAX_CHUNKSIZE));
+        upload.set_chunksize(chunksize)?;
+        Ok(upload)
     } else {
         Err(Error::from(ApiError::RedirectError(format!("Resumable upload response didn't contain Location: {:?}", headers)))
         .context(format!("{:?}", headers)))?
@@ -364,7 +591,7 @@ pub async fn {{{name}}}_resumable_upload<'client>(
 
 # Takes:
 # name, param_type, in_type, out_type
-# base_path, rel_path_expr
+# base_path, url_path, url_capacity
 # params: [{param, snake_param}]
 # http_method
 DownloadMethodTmpl = '''
@@ -377,36 +604,29 @@ pub async fn {{{name}}}<'a>(
     &'a self, params: &{{{param_type}}}, {{#in_type}}req: &'a {{{in_type}}}{{/in_type}})
     -> Result<Download<'a, {{{download_in_type}}}, {{{out_type}}}>> {
 
-    let rel_path = {{{rel_path_expr}}};
-    let path = self.format_path(rel_path.as_str());
+    let mut url = String::with_capacity({{{url_capacity}}});
+    {{{url_path}}}
 
-    let mut headers = vec![];
+    let mut headers: Vec<(hyper::header::HeaderName, hyper::header::HeaderValue)> = vec![];
     {{#wants_auth}}
-    let tok;
-    if self.scopes.is_empty() {
-        let scopes = &[{{#scopes}}{{{scope}}}.as_ref().to_string(),
-        {{/scopes}}];
-        tok = self.authenticator.token(scopes).await?;
-    } else {
-        tok = self.authenticator.token(&self.scopes).await?;
-    }
-    headers.push((hyper::header::AUTHORIZATION, format!("Bearer {token}", token=tok.as_str())));
+    static SCOPES: &[&str] = &[{{#scopes}}"{{{url}}}", {{/scopes}}];
+    headers.push((hyper::header::AUTHORIZATION, self.tokens.header(SCOPES).await?));
     {{/wants_auth}}
 
-    let mut url_params = format!("?{params}", params=params);
+    url.push_str("?");
+    write_display(&mut url, params)?;
     {{#global_params_name}}
     if let Some(ref api_params) = &params.{{{global_params_name}}} {
-        url_params.push_str(&format!("{}", api_params));
+        write_display(&mut url, api_params)?;
     }
     {{/global_params_name}}
 
-    let full_uri = path + &url_params;
     let opt_request: Option<&EmptyRequest> = None;
     {{#in_type}}
     let opt_request = Some(req);
     {{/in_type}}
 
-    do_download(&self.client, &full_uri,
+    do_download(&self.client, &url,
         headers,
         "{{{http_method}}}".into(), opt_request).await
   }